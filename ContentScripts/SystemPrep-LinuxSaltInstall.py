@@ -1,52 +1,1107 @@
 #!/usr/bin/env python
 import os
 import sys
+import json
+import fnmatch
+import hashlib
+import heapq
+import mmap
 import tempfile
 import urllib2
+import urlparse
 import shutil
+import pipes
+import subprocess
 import tarfile
 import zipfile
+import functools
+import threading
+import contextlib
+import time
 import re
+import random
+import zlib
 import boto
 
-from boto.exception import BotoClientError
+from multiprocessing.pool import ThreadPool
+
 from boto.exception import S3ResponseError
 
 
-def download_file(url, filename, sourceiss3bucket=None):
+_phases = {
+    'log': None,
+    'script': os.path.basename(__file__),
+    'lock': threading.Lock(),
+}
+
+
+def configure_phase_log(phaselog):
+    """
+    Configures the file to which `timed_phase` appends its timing records.
+    The master script collects the records from all scripts into its run
+    report.
+    :param phaselog: str, path to the phase log. 'none' or an empty string
+                     disables the phase log.
+    """
+    _phases['log'] = None if not phaselog or 'none' == phaselog.lower() \
+        else phaselog
+
+
+@contextlib.contextmanager
+def timed_phase(name, **details):
+    """
+    Times the enclosed block and appends a record of it to the phase log, as
+    a line of JSON. The block may add details to the record by updating the
+    yielded dictionary. If the details include `bytes`, the throughput is
+    added to the record, too.
+    :param name: str, name of the phase
+    :param details: dict, additional details to record
+    """
+    start = time.time()
+    details['status'] = 'failed'
+    try:
+        yield details
+        details['status'] = 'succeeded'
+    finally:
+        duration = time.time() - start
+        if _phases['log']:
+            details.update(name=name, script=_phases['script'],
+                           start=start, duration=duration)
+            if details.get('bytes') is not None and duration > 0:
+                details['bytes_per_second'] = details['bytes'] / duration
+            try:
+                with _phases['lock']:
+                    with open(_phases['log'], 'a') as f:
+                        f.write(json.dumps(details) + '\n')
+            except Exception as exc:
+                print('WARNING: Could not write to the phase log -- {0}\n'
+                      '    Exception: {1}'.format(_phases['log'], exc))
+
+
+_cache = {
+    'dir': None,
+    'maxbytes': 512 * 1024 * 1024,
+    'offline': False,
+}
+
+
+def configure_cache(cachedir=None, cachemaxsize=None, cacheoffline=None):
+    """
+    Configures the local artifact cache used by `download_file`. Cached
+    files are stored once per content hash, and each url is indexed to the
+    hash and ETag of the content last downloaded from it. Files are also
+    indexed by their SHA512 hash, to match published hash files.
+    :param cachedir: str, directory in which to store the cache. 'none' or an
+                     empty string disables the cache.
+    :param cachemaxsize: str, maximum size of the cache in MB. the least
+                         recently used files are evicted to stay under it.
+    :param cacheoffline: str, set to 'true' to serve files only from the
+                         cache, without contacting the source.
+    """
+    if cachedir is not None:
+        _cache['dir'] = None if cachedir.lower() in ('', 'none') else cachedir
+    if cachemaxsize is not None:
+        _cache['maxbytes'] = int(cachemaxsize) * 1024 * 1024
+    if cacheoffline is not None:
+        _cache['offline'] = 'true' == str(cacheoffline).lower()
+    if _cache['dir']:
+        for subdir in ('objects', 'index', 'digests', 'partial'):
+            path = os.sep.join((_cache['dir'], subdir))
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    print('WARNING: Could not create the cache directory, '
+                          'the cache is disabled -- {0}'.format(path))
+                    _cache['dir'] = None
+                    break
+
+
+def _cache_lookup(url):
+    """
+    Returns the cache entry for `url`, or None if `url` is not cached.
+    :param url: str, location of the file
+    :rtype : dict
+    """
+    indexfile = os.sep.join((
+        _cache['dir'], 'index',
+        hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json'))
+    try:
+        with open(indexfile, 'r') as f:
+            entry = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    entry['object'] = os.sep.join((_cache['dir'], 'objects', entry['sha256']))
+    if not os.path.isfile(entry['object']):
+        return None
+    return entry
+
+
+def _cache_find_digest(url, algorithm, hexdigest):
+    """
+    Returns a cache entry for the cached file with the hash `hexdigest`, or
+    None if there is no such file. The file may have been cached from any
+    url.
+    :param url: str, location of the file, used only in messages
+    :param algorithm: str, hashlib name of the hash algorithm
+    :param hexdigest: str, hex digest of the file
+    :rtype : dict
+    """
+    name = hexdigest
+    if 'sha256' != algorithm:
+        digestfile = os.sep.join((_cache['dir'], 'digests',
+                                  '{0}-{1}'.format(algorithm, hexdigest)))
+        try:
+            with open(digestfile, 'r') as f:
+                name = f.read().strip()
+        except (IOError, OSError):
+            return None
+    objectfile = os.sep.join((_cache['dir'], 'objects', name))
+    if not os.path.isfile(objectfile):
+        return None
+    return {'url': url, 'object': objectfile}
+
+
+def _cache_restore(entry, filename, expected=None):
+    """
+    Copies a cached file to `filename`, and marks it as recently used. The
+    copy is checked against the `expected` hash. A cached file that does not
+    match is removed from the cache.
+    :param entry: dict, as returned by `_cache_lookup`
+    :param filename: str, path where the file should be saved
+    :param expected: tuple, as returned by `_read_published_digest`, or None
+    :rtype : bool
+    """
+    try:
+        shutil.copyfile(entry['object'], filename)
+        os.utime(entry['object'], None)
+    except (IOError, OSError):
+        # Evicted by another download in the meantime
+        return False
+    if expected and \
+            _hash_file(filename, [expected[0]])[expected[0]] != expected[1]:
+        print('WARNING: The cached file does not match its published {0} '
+              'hash, removing it from the cache -- {1}'
+              .format(expected[0].upper(), entry['url']))
+        _cache_remove(entry)
+        os.remove(filename)
+        return False
+    print('Restored file from cache -- \n'
+          '    url      = {0}\n'
+          '    filename = {1}'.format(entry['url'], filename))
+    return True
+
+
+def _cache_remove(entry):
+    """
+    Removes a cached file, and the index entry of its url.
+    :param entry: dict, as returned by `_cache_lookup`
+    """
+    indexfile = os.sep.join((
+        _cache['dir'], 'index',
+        hashlib.sha256(entry['url'].encode('utf-8')).hexdigest() + '.json'))
+    for path in (entry['object'], indexfile):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _cache_store(url, filename, etag=None, last_modified=None,
+                 digests=None, published=True):
+    """
+    Adds the file `filename`, downloaded from `url`, to the cache. Then evicts
+    the least recently used files until the cache is under its size limit.
+    Errors are reported, but never fail the download.
+    :param url: str, location the file was downloaded from
+    :param filename: str, path to the downloaded file
+    :param etag: str, ETag returned by the source, if any
+    :param last_modified: str, Last-Modified date returned by the source
+    :param digests: dict, hex digests of the file computed while it was
+                    downloaded, keyed by hashlib algorithm name
+    :param published: bool, whether a hash file is published for `url`
+    """
+    try:
+        digests = dict(digests or {})
+        if 'sha256' not in digests:
+            digests.update(_hash_file(filename, ['sha256']))
+        entry = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'size': os.path.getsize(filename),
+        }
+        if not published:
+            entry['unpublished'] = time.time()
+        entry.update(digests)
+        objectfile = os.sep.join((_cache['dir'], 'objects', entry['sha256']))
+        indexfile = os.sep.join((
+            _cache['dir'], 'index',
+            hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json'))
+        # Write to temp files and rename, so readers never see partial files
+        if os.path.isfile(objectfile):
+            os.utime(objectfile, None)
+        else:
+            fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(objectfile))
+            os.close(fd)
+            shutil.copyfile(filename, tmpfile)
+            os.rename(tmpfile, objectfile)
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(indexfile))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmpfile, indexfile)
+        for algorithm, hexdigest in digests.items():
+            if 'sha256' == algorithm:
+                continue
+            digestfile = os.sep.join((_cache['dir'], 'digests',
+                                      '{0}-{1}'.format(algorithm, hexdigest)))
+            fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(digestfile))
+            with os.fdopen(fd, 'w') as f:
+                f.write(entry['sha256'])
+            os.rename(tmpfile, digestfile)
+        _cache_evict()
+    except Exception as exc:
+        print('WARNING: Could not add file to the cache.\n'
+              '    url = {0}\n'
+              '    Exception: {1}'.format(url, exc))
+
+
+def _cache_evict():
+    """
+    Removes the least recently used files from the cache until it is under
+    the configured size limit.
+    """
+    objectdir = os.sep.join((_cache['dir'], 'objects'))
+    objects = []
+    for name in os.listdir(objectdir):
+        path = os.sep.join((objectdir, name))
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        objects.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in objects)
+    for _, size, path in sorted(objects):
+        if total <= _cache['maxbytes']:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        print('Evicted file from cache -- {0}'.format(path))
+
+
+_s3 = {
+    'conn': None,
+    'buckets': {},
+    'lock': threading.Lock(),
+}
+
+# Matches the host of a virtual-hosted-style S3 url, e.g.
+# `bucket.s3.amazonaws.com` or `bucket.s3-us-west-2.amazonaws.com`.
+# Any other host is treated as a path-style endpoint.
+_match_s3_virtual_host = re.compile(r'^(?P<bucket>.+?)\.s3(?:[.-][a-z0-9-]+)?'
+                                    r'\.amazonaws\.com(?:\.cn)?$')
+
+
+def parse_s3_url(url):
+    """
+    Returns the bucket name and key name of an S3 url. Supports both the
+    path-style syntax, `https://<s3endpoint>/<bucket>/path/to/file`, and the
+    virtual-hosted-style syntax, `https://<bucket>.<s3endpoint>/path/to/file`.
+    :param url: str, location of the S3 object
+    :return: tuple, (bucket_name, key_name)
+    """
+    parts = url.split('/')
+    m = _match_s3_virtual_host.match(parts[2].split(':')[0].lower())
+    if m:
+        return m.group('bucket'), '/'.join(parts[3:])
+    return parts[3], '/'.join(parts[4:])
+
+
+def get_s3_key(bucket_name, key_name):
+    """
+    Returns a boto Key for the S3 object, without making any requests. All
+    keys share one S3 connection, which keeps its HTTP connections alive in
+    a pool, and each bucket is resolved only once.
+    :param bucket_name: str, name of the S3 bucket
+    :param key_name: str, name of the S3 key
+    :rtype : boto.s3.key.Key
+    """
+    with _s3['lock']:
+        if _s3['conn'] is None:
+            _s3['conn'] = boto.connect_s3()
+        bucket = _s3['buckets'].get(bucket_name)
+        if bucket is None:
+            # `validate=False` skips the request that checks the bucket exists
+            bucket = _s3['conn'].get_bucket(bucket_name, validate=False)
+            _s3['buckets'][bucket_name] = bucket
+    return bucket.new_key(key_name)
+
+
+_mirror = {
+    'url': None,
+    'available': None,
+    'lock': threading.Lock(),
+}
+
+
+def configure_mirror(mirrorurl=None):
+    """
+    Configures the content mirror used by `download_file`. See
+    Utils/systemprep-mirror.py. Each file is requested from the mirror as
+    `<mirrorurl>/<scheme>/<host>/<path>`, and from its source if the mirror
+    fails.
+    :param mirrorurl: str, base url of the mirror. 'none' or an empty string
+                      disables the mirror.
+    """
+    if mirrorurl is not None:
+        url = None if mirrorurl.lower() in ('', 'none') \
+            else mirrorurl.rstrip('/')
+        with _mirror['lock']:
+            if url != _mirror['url']:
+                _mirror['url'] = url
+                _mirror['available'] = None
+
+
+def _mirror_available(recheck=False):
+    """
+    Returns True if a mirror is configured and answers. The mirror is checked
+    once, with a short timeout, so an unreachable mirror does not cost a
+    timeout for every file. It is checked again if `recheck` is True, after a
+    download from the mirror fails.
+    :rtype : bool
+    """
+    with _mirror['lock']:
+        if _mirror['url'] and (recheck or _mirror['available'] is None):
+            try:
+                urllib2.urlopen(_mirror['url'] + '/', timeout=5).close()
+                _mirror['available'] = True
+            except Exception as exc:
+                print('WARNING: The mirror is not available, files will be '
+                      'downloaded from their source -- {0}\n'
+                      '    Exception: {1}'.format(_mirror['url'], exc))
+                _mirror['available'] = False
+        return bool(_mirror['url'] and _mirror['available'])
+
+
+def get_mirror_url(url):
+    """
+    Returns the location of `url` on the mirror, or None if the mirror cannot
+    serve it.
+    :param url: str, location of the file at its source
+    :rtype : str
+    """
+    parts = urlparse.urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.netloc or \
+            parts.query:
+        return None
+    return '/'.join((_mirror['url'], parts.scheme, parts.netloc,
+                     parts.path.lstrip('/')))
+
+
+_download = {
+    'chunksize': 8 * 1024 * 1024,
+    'workers': 4,
+    'retries': 5,
+    'backoff': 1.0,
+    # How long to trust that a url has no hash file, in seconds
+    'unpublishedttl': 24 * 60 * 60,
+    'unpublished': set(),
+}
+
+# Hash algorithm and suffix of the hash files published next to artifacts.
+# See Utils/CreateHashFiles.md.
+_published_digest = ('sha512', '.SHA512')
+
+# Download engine. Every request that `download_file` makes waits for a
+# connection slot, which is given to the most urgent waiting request whose
+# host is below its limit. Reads are throttled to a bandwidth budget, and
+# reported to the progress callbacks. The limits apply to this process. When
+# the master runs this script in-process, it replaces `_engine`, `_cache`,
+# `_mirror`, `_download` and `_s3` with its own.
+_engine = {
+    'condition': threading.Condition(threading.Lock()),
+    'maxconnections': 8,
+    'hostlimit': 4,
+    'active': {},
+    'waiting': [],
+    'sequence': 0,
+    'bandwidth': None,
+    'tokens': 0.0,
+    'updated': 0.0,
+    'cancelled': None,
+    'transfers': {},
+    'progress': [],
+    'progressinterval': 10,
+}
+
+
+def configure_downloads(maxconnections=None, hostlimit=None, bandwidth=None):
+    """
+    Configures the limits of the download engine.
+    :param maxconnections: str, the maximum number of requests open at once
+    :param hostlimit: str, the maximum number of requests open to one host.
+                      the buckets of S3 count as separate hosts.
+    :param bandwidth: str, the total download rate in MB per second, shared
+                      by the requests of this process. 'none' or 0 removes
+                      the limit.
+    """
+    if maxconnections is not None:
+        _engine['maxconnections'] = max(1, int(maxconnections))
+    if hostlimit is not None:
+        _engine['hostlimit'] = max(1, int(hostlimit))
+    if bandwidth is not None:
+        rate = 0 if str(bandwidth).lower() in ('', 'none') \
+            else float(bandwidth)
+        _engine['bandwidth'] = rate * 1024 * 1024 if rate > 0 else None
+
+
+def cancel_downloads(reason):
+    """
+    Cancels the open and waiting requests of the download engine, and any
+    made after. Call this on an error that fails the run, so the other
+    downloads stop rather than run to completion.
+    :param reason: str, the error, included in the errors of the cancelled
+                   requests
+    """
+    with _engine['condition']:
+        if not _engine['cancelled']:
+            _engine['cancelled'] = str(reason)
+        _engine['condition'].notify_all()
+
+
+def _check_cancelled():
+    if _engine['cancelled']:
+        raise SystemError('The download was cancelled after an error -- {0}'
+                          .format(_engine['cancelled']))
+
+
+def _next_connection():
+    """
+    Returns the waiting request to give the next connection slot to, or None.
+    Requests are ordered by priority, then by age. Call with the engine's
+    condition held.
+    """
+    if sum(_engine['active'].values()) >= _engine['maxconnections']:
+        return None
+    for waiter in sorted(_engine['waiting']):
+        if _engine['active'].get(waiter[2], 0) < _engine['hostlimit']:
+            return waiter
+    return None
+
+
+def _acquire_connection(host, priority):
+    """
+    Waits for a connection slot to `host`. Lower priorities go first.
+    """
+    condition = _engine['condition']
+    with condition:
+        _engine['sequence'] += 1
+        waiter = (priority, _engine['sequence'], host)
+        _engine['waiting'].append(waiter)
+        try:
+            while True:
+                _check_cancelled()
+                if waiter == _next_connection():
+                    break
+                condition.wait()
+            _engine['active'][host] = _engine['active'].get(host, 0) + 1
+        finally:
+            _engine['waiting'].remove(waiter)
+            # Another request may be able to go, too
+            condition.notify_all()
+
+
+def _release_connection(host):
+    condition = _engine['condition']
+    with condition:
+        _engine['active'][host] -= 1
+        condition.notify_all()
+
+
+def _throttle(size):
+    """
+    Takes `size` bytes from the bandwidth budget, a token bucket that holds
+    up to one second of the rate, and sleeps off any shortfall.
+    """
+    rate = _engine['bandwidth']
+    if not rate:
+        return
+    with _engine['condition']:
+        now = time.time()
+        _engine['tokens'] = min(
+            rate, _engine['tokens'] + (now - _engine['updated']) * rate)
+        _engine['updated'] = now
+        _engine['tokens'] -= size
+        delay = -_engine['tokens'] / rate
+    if delay > 0:
+        time.sleep(delay)
+
+
+def _report_progress(url, size, total):
+    with _engine['condition']:
+        received = _engine['transfers'].get(url, 0) + size
+        _engine['transfers'][url] = received
+        callbacks = list(_engine['progress'])
+    for callback in callbacks:
+        try:
+            callback(url, received, total)
+        except Exception as exc:
+            print('WARNING: Download progress callback failed -- {0}\n'
+                  '    Exception: {1}'.format(url, exc))
+
+
+_progress_reported = {}
+
+
+def log_download_progress(url, received, total):
+    """
+    Progress callback that prints the progress of each download to the run
+    log, at most once per `progressinterval` seconds.
+    """
+    now = time.time()
+    if now - _progress_reported.setdefault(url, now) < \
+            _engine['progressinterval']:
+        return
+    _progress_reported[url] = now
+    if total:
+        print('Downloading {0} of {1} bytes ({2:.0f}%) -- {3}'
+              .format(received, total, 100.0 * received / total, url))
+    else:
+        print('Downloading {0} bytes -- {1}'.format(received, url))
+
+
+_engine['progress'].append(log_download_progress)
+
+
+class _ScheduledResponse(object):
+    """
+    Response opened through the download engine. Reads are throttled and
+    reported as progress, and closing the response frees its connection
+    slot.
+    """
+    def __init__(self, response, url, host, total):
+        self.response = response
+        self.url = url
+        self.host = host
+        self.total = total
+
+    def read(self, size=-1):
+        _check_cancelled()
+        data = self.response.read() if size < 0 else self.response.read(size)
+        if data:
+            _throttle(len(data))
+            _report_progress(self.url, len(data), self.total)
+        return data
+
+    def close(self):
+        try:
+            self.response.close()
+        finally:
+            if self.host is not None:
+                _release_connection(self.host)
+                self.host = None
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+
+def _get_download_host(fetch, url):
+    """
+    Returns the host that `fetch` opens `url` from, to apply its limit.
+    """
+    if fetch is _open_s3_range:
+        return 's3://{0}'.format(parse_s3_url(url)[0])
+    if fetch is _open_mirror_range:
+        url = get_mirror_url(url)
+    return urlparse.urlparse(url).netloc
+
+
+def _schedule_fetch(fetch, priority=0):
+    """
+    Returns a version of `fetch`, e.g. `_open_http_range`, whose requests
+    are scheduled by the download engine with `priority`.
+    """
+    def scheduled(url, start=None, end=None, headers=None):
+        host = _get_download_host(fetch, url)
+        _acquire_connection(host, priority)
+        try:
+            result = fetch(url, start, end, headers)
+        except Exception:
+            _release_connection(host)
+            raise
+        response = _ScheduledResponse(result[0], url, host, result[1])
+        return (response,) + tuple(result[1:])
+    return scheduled
+
+
+
+def _get_status(exc):
+    """
+    Returns the HTTP status of a urllib2 or boto error, or None.
+    """
+    return getattr(exc, 'code', None) or getattr(exc, 'status', None)
+
+
+def _open_http_range(url, start=None, end=None, headers=None):
+    """
+    Opens a GET request for the bytes `start` to `end` of `url`, or for the
+    whole file if `start` is None.
+    :return: tuple, (response, size of the whole file or None if unknown,
+             whether the response is the requested range, ETag,
+             Last-Modified)
+    """
+    request = urllib2.Request(url)
+    for name, value in (headers or {}).items():
+        request.add_header(name, value)
+    if start is not None:
+        request.add_header('Range', 'bytes={0}-{1}'.format(start, end))
+    response = urllib2.urlopen(request, timeout=60)
+    info = response.info()
+    ranged = 206 == response.getcode()
+    if ranged:
+        size = int(info.getheader('Content-Range').split('/')[-1])
+    else:
+        size = info.getheader('Content-Length')
+        size = int(size) if size else None
+    return (response, size, ranged,
+            info.getheader('ETag'), info.getheader('Last-Modified'))
+
+
+def _open_s3_range(url, start=None, end=None, headers=None):
+    """
+    Opens a GET request for the bytes `start` to `end` of the S3 object at
+    `url`, or for the whole object if `start` is None.
+    :return: tuple, as returned by `_open_http_range`. the response is the
+             boto Key, which reads from the open request.
+    """
+    key = get_s3_key(*parse_s3_url(url))
+    headers = dict(headers or {})
+    if start is not None:
+        headers['Range'] = 'bytes={0}-{1}'.format(start, end)
+    key.open_read(headers=headers)
+    ranged = 206 == key.resp.status
+    if ranged:
+        size = int(key.resp.getheader('content-range').split('/')[-1])
+    else:
+        size = key.size
+    return key, size, ranged, key.etag, key.last_modified
+
+
+def _hash_file(filename, algorithms):
+    """
+    Returns the hex digests of the file `filename`, keyed by algorithm.
+    :param algorithms: list, hashlib names of the hash algorithms
+    :rtype : dict
+    """
+    hashes = dict((algorithm, hashlib.new(algorithm))
+                  for algorithm in algorithms)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            for digest in hashes.values():
+                digest.update(chunk)
+    return dict((algorithm, digest.hexdigest())
+                for algorithm, digest in hashes.items())
+
+
+def _open_mirror_range(url, start=None, end=None, headers=None):
+    """
+    Opens a GET request for the bytes `start` to `end` of `url` from the
+    mirror. See `_open_http_range`.
+    """
+    return _open_http_range(get_mirror_url(url), start, end, headers)
+
+
+def _copy_response(response, outfile, length=None, hashes=()):
+    """
+    Copies `length` bytes, or all of them if None, from `response` to
+    `outfile`, and updates each of `hashes` with the bytes as they are
+    copied.
+    :raise IOError: error raised if the response ends early
+    """
+    remaining = length
+    while remaining is None or remaining > 0:
+        data = response.read(1024 * 1024 if remaining is None
+                             else min(1024 * 1024, remaining))
+        if not data:
+            if remaining:
+                raise IOError('The connection closed with {0} bytes left '
+                              'to read.'.format(remaining))
+            break
+        outfile.write(data)
+        for digest in hashes:
+            digest.update(data)
+        if remaining is not None:
+            remaining -= len(data)
+
+
+def _partial_paths(url, filename):
+    """
+    Returns the paths of the partial file and of the record of its completed
+    chunks. These are kept in the cache, if there is one, so a later run can
+    resume the download.
+    :return: tuple, (partfile, statefile)
+    """
+    base = filename
+    if _cache['dir']:
+        base = os.sep.join((_cache['dir'], 'partial',
+                            hashlib.sha256(url.encode('utf-8')).hexdigest()))
+    return base + '.part', base + '.part.json'
+
+
+def _read_partial_state(partfile, statefile, url):
+    """
+    Returns the record of a partial download of `url`, or None if there is
+    no partial download that can be resumed.
+    """
+    try:
+        with open(statefile, 'r') as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if state.get('url') != url or \
+            state.get('chunksize') != _download['chunksize'] or \
+            not os.path.isfile(partfile):
+        return None
+    return state
+
+
+def _write_partial_state(statefile, state):
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(statefile) or '.')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmpfile, statefile)
+
+
+def _remove_partial(partfile, statefile):
+    for path in (partfile, statefile):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _download_chunk(fetch, url, partfile, start, end, etag):
+    """
+    Downloads the bytes `start` to `end` of `url` into `partfile`, retrying
+    with exponential backoff. The request is conditional on `etag`, so a file
+    that changes during the download is not mixed with its old version.
+    """
+    headers = {'If-Match': etag} if etag else {}
+    for attempt in range(_download['retries']):
+        try:
+            response, _, ranged, _, _ = fetch(url, start, end, headers)
+            try:
+                if not ranged:
+                    raise IOError('The source ignored the range request.')
+                with open(partfile, 'r+b') as f:
+                    f.seek(start)
+                    _copy_response(response, f, end - start + 1)
+            finally:
+                response.close()
+            return
+        except Exception as exc:
+            status = _get_status(exc)
+            # Client errors, such as a changed file, will not go away
+            retriable = status is None or status >= 500 or \
+                status in (408, 429)
+            if not retriable or attempt + 1 >= _download['retries'] or \
+                    _engine['cancelled']:
+                raise
+            delay = _download['backoff'] * (2 ** attempt + random.random())
+            print('WARNING: Retrying bytes {0}-{1} of {2} in {3:.1f}s -- {4}'
+                  .format(start, end, url, delay, exc))
+            time.sleep(delay)
+
+
+def _read_published_digest(fetch, url, entry=None):
+    """
+    Reads the hash file published next to `url`, named `<file>.SHA512` and
+    containing `<hexdigest> <file>`. See Utils/CreateHashFiles.md. A url
+    without a hash file is not asked again in this run, nor for a day if it
+    is cached.
+    :param entry: dict, the cache entry for `url`, or None
+    :return: tuple, (hashlib algorithm name, hex digest), or None if there is
+             no hash file
+    """
+    if url in _download['unpublished'] or \
+            entry and time.time() - entry.get('unpublished', 0) < \
+            _download['unpublishedttl']:
+        return None
+    algorithm, suffix = _published_digest
+    try:
+        response = fetch(url + suffix)[0]
+    except Exception as exc:
+        # A cancelled download is not a problem with the hash file
+        _check_cancelled()
+        if _get_status(exc) in (403, 404):
+            _download['unpublished'].add(url)
+        else:
+            print('WARNING: Could not read the hash file -- {0}\n'
+                  '    Exception: {1}'.format(url + suffix, exc))
+        return None
+    try:
+        fields = response.read(1024).split()
+    finally:
+        response.close()
+    length = hashlib.new(algorithm).digest_size * 2
+    if fields and re.match(r'^[0-9a-fA-F]{{{0}}}$'.format(length),
+                           fields[0]):
+        return algorithm, fields[0].lower()
+    print('WARNING: The hash file is not valid -- {0}'.format(url + suffix))
+    return None
+
+
+def _check_digests(url, digests, expected):
+    """
+    Raises an error if `digests` does not include the `expected` digest.
+    :param digests: dict, hex digests of the downloaded file
+    :param expected: tuple, as returned by `_read_published_digest`, or None
+    """
+    if expected and digests[expected[0]] != expected[1]:
+        raise SystemError('The downloaded file does not match its '
+                          'published {0} hash.\n'
+                          'url = {1}'.format(expected[0].upper(), url))
+
+
+def _download_ranged(fetch, url, filename, headers=None, expected=None):
+    """
+    Downloads `url` to `filename`, using `fetch` to open ranges of the file.
+    A file larger than one chunk is downloaded in parallel chunks, each with
+    its own retries. The chunks are written to a partial file, and each
+    completed chunk is recorded, so a failed download resumes where it left
+    off. The file is hashed as it is downloaded, and checked against the
+    `expected` hash.
+    :param fetch: function, `_open_http_range` or `_open_s3_range`
+    :param url: str, location of the file
+    :param filename: str, path to save the file
+    :param headers: dict, headers for the first request, such as the
+                    conditional headers that revalidate a cached file
+    :param expected: tuple, as returned by `_read_published_digest`, or None
+    :return: tuple, (ETag, Last-Modified, dict of hex digests) of the file
+    """
+    chunksize = _download['chunksize']
+    # SHA256 names the file in the cache
+    algorithms = set(['sha256'])
+    if expected:
+        algorithms.add(expected[0])
+    hashes = dict((algorithm, hashlib.new(algorithm))
+                  for algorithm in algorithms)
+    partfile, statefile = _partial_paths(url, filename)
+    state = _read_partial_state(partfile, statefile, url)
+
+    # Request the first missing chunk. The response also gives the size and
+    # version of the file.
+    first = 0
+    while state and first in state['done']:
+        first += 1
+    try:
+        response, size, ranged, etag, last_modified = fetch(
+            url, first * chunksize, (first + 1) * chunksize - 1, headers)
+    except Exception as exc:
+        # A range cannot be satisfied by an empty file, or past its end
+        if 416 != _get_status(exc):
+            raise
+        first = 0
+        state = None
+        response, size, ranged, etag, last_modified = fetch(
+            url, None, None, headers)
+
+    try:
+        if not ranged or (0 == first and size <= chunksize):
+            # The response holds the whole file
+            with open(filename, 'wb') as f:
+                _copy_response(response, f, size if ranged else None,
+                               hashes.values())
+            _remove_partial(partfile, statefile)
+            digests = dict((algorithm, digest.hexdigest())
+                           for algorithm, digest in hashes.items())
+            try:
+                _check_digests(url, digests, expected)
+            except SystemError:
+                os.remove(filename)
+                raise
+            return etag, last_modified, digests
+
+        if state is not None and \
+                (state['size'], state['etag']) == (size, etag):
+            print('Resuming download, {0} of {1} bytes done -- {2}'
+                  .format(len(state['done']) * chunksize, size, url))
+        else:
+            state = {
+                'url': url,
+                'size': size,
+                'etag': etag,
+                'last_modified': last_modified,
+                'chunksize': chunksize,
+                'done': [],
+            }
+            with open(partfile, 'wb') as f:
+                f.truncate(size)
+        try:
+            with open(partfile, 'r+b') as f:
+                f.seek(first * chunksize)
+                _copy_response(response, f,
+                               min(chunksize, size - first * chunksize))
+            state['done'].append(first)
+        except Exception as exc:
+            # Leave the chunk to be retried with the others
+            print('WARNING: Could not download the first chunk of {0} -- {1}'
+                  .format(url, exc))
+    finally:
+        response.close()
+
+    lock = threading.Lock()
+    hashed = [0]
+    _write_partial_state(statefile, state)
+
+    def hash_chunks():
+        # Hash the completed chunks in order, as soon as they are contiguous.
+        # They are read back while still in the page cache, so the file is
+        # not read again once the download finishes.
+        with open(partfile, 'rb') as f:
+            f.seek(hashed[0] * chunksize)
+            while hashed[0] in state['done']:
+                data = f.read(chunksize)
+                for digest in hashes.values():
+                    digest.update(data)
+                hashed[0] += 1
+
+    def download_chunk(n):
+        _download_chunk(fetch, url, partfile, n * chunksize,
+                        min(size, (n + 1) * chunksize) - 1, etag)
+        with lock:
+            state['done'].append(n)
+            _write_partial_state(statefile, state)
+            hash_chunks()
+
+    hash_chunks()
+    missing = [n for n in range((size + chunksize - 1) // chunksize)
+               if n not in state['done']]
+    if missing:
+        pool = ThreadPool(min(_download['workers'], len(missing)))
+        try:
+            pool.map(download_chunk, missing)
+        finally:
+            pool.close()
+            pool.join()
+
+    digests = dict((algorithm, digest.hexdigest())
+                   for algorithm, digest in hashes.items())
+    try:
+        _check_digests(url, digests, expected)
+    except SystemError:
+        _remove_partial(partfile, statefile)
+        raise
+    shutil.move(partfile, filename)
+    _remove_partial(partfile, statefile)
+    return etag, last_modified, digests
+
+
+def download_file(url, filename, sourceiss3bucket=None, priority=0):
     """
 Download the file from `url` and save it locally under `filename`.
+Uses the local artifact cache, if one is configured. See `configure_cache`.
+The download is timed and recorded in the phase log. See `timed_phase`.
+Its requests are scheduled by the download engine. See `configure_downloads`.
     :rtype : bool
     :param url:
     :param filename:
     :param sourceiss3bucket:
+    :param priority: int, lower priorities get connections first
     """
-    conn = None
+    with timed_phase('download_file', url=url, filename=filename) as phase:
+        phase['source'] = _download_file(url, filename, sourceiss3bucket,
+                                         priority)
+        phase['bytes'] = os.path.getsize(filename)
+    return True
 
-    if sourceiss3bucket:
-        bucket_name = url.split('/')[3]
-        key_name = '/'.join(url.split('/')[4:])
+
+def _download_file(url, filename, sourceiss3bucket=None, priority=0):
+    """
+    Does the work of `download_file`. Files are downloaded from the mirror,
+    if one is configured, and from their source if the mirror fails.
+    :return: str, where the file came from. one of 'local', 'cache',
+             'mirror', 's3' or 'web'
+    """
+    entry = _cache_lookup(url) if _cache['dir'] else None
+
+    if _cache['dir'] and _cache['offline']:
+        if entry and _cache_restore(entry, filename):
+            return 'cache'
+        raise SystemError('Unable to find file in the cache, and the cache '
+                          'is offline.\n'
+                          'url = {0}\n'
+                          'filename = {1}'.format(url, filename))
+
+    if _mirror_available() and get_mirror_url(url):
+        try:
+            return _download_from(url, filename, entry, mirror=True,
+                                  priority=priority)
+        except SystemError as exc:
+            print('WARNING: Could not download file from the mirror, trying '
+                  'its source.\n'
+                  '    Exception: {0}'.format(exc))
+            _mirror_available(recheck=True)
+    return _download_from(url, filename, entry, sourceiss3bucket,
+                          priority=priority)
+
+
+def _download_from(url, filename, entry, sourceiss3bucket=None,
+                   mirror=False, priority=0):
+    """
+    Downloads `url` to `filename` from the mirror, from S3, or from a web
+    server.
+    :param entry: dict, the cache entry for `url`, or None
+    :return: str, as returned by `_download_file`
+    """
+    if mirror:
+        fetch = _open_mirror_range
+    elif sourceiss3bucket:
+        fetch = _open_s3_range
+    else:
+        fetch = _open_http_range
+    fetch = _schedule_fetch(fetch, priority)
+    with _engine['condition']:
+        _engine['transfers'].pop(url, None)
+
+    # The published hash identifies the file, so a copy already on disk or in
+    # the cache is used without downloading it again
+    expected = _read_published_digest(fetch, url, entry)
+    if expected:
+        algorithm, hexdigest = expected
+        if os.path.isfile(filename) and \
+                _hash_file(filename, [algorithm])[algorithm] == hexdigest:
+            print('File already matches its published hash -- \n'
+                  '    url      = {0}\n'
+                  '    filename = {1}'.format(url, filename))
+            return 'local'
+        found = _cache_find_digest(url, algorithm, hexdigest) \
+            if _cache['dir'] else None
+        if found and _cache_restore(found, filename, expected):
+            return 'cache'
+
+    # Revalidate the cached file with a conditional GET
+    headers = {}
+    if entry and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+
+    if sourceiss3bucket and not mirror:
+        bucket_name, key_name = parse_s3_url(url)
         try:
-            conn = boto.connect_s3()
-            bucket = conn.get_bucket(bucket_name)
-            key = bucket.get_key(key_name)
-            key.get_contents_to_filename(filename=filename)
-        except (NameError, BotoClientError, S3ResponseError):
             try:
-                bucket_name = url.split('/')[2].split('.')[0]
-                key_name = '/'.join(url.split('/')[3:])
-                bucket = conn.get_bucket(bucket_name)
-                key = bucket.get_key(key_name)
-                key.get_contents_to_filename(filename=filename)
-            except Exception as exc:
-                raise SystemError('Unable to download file from S3 bucket.\n'
-                                  'url = {0}\n'
-                                  'bucket = {1}\n'
-                                  'key = {2}\n'
-                                  'file = {3}\n'
-                                  'Exception: {4}'
-                                  .format(url, bucket_name, key_name,
-                                          filename, exc))
+                etag, last_modified, digests = _download_ranged(
+                    fetch, url, filename, headers, expected)
+            except S3ResponseError as exc:
+                if 304 != exc.status:
+                    raise
+                if _cache_restore(entry, filename, expected):
+                    return 'cache'
+                # The cached file is gone or corrupt, so download it again
+                etag, last_modified, digests = _download_ranged(
+                    fetch, url, filename, None, expected)
         except Exception as exc:
             raise SystemError('Unable to download file from S3 bucket.\n'
                               'url = {0}\n'
@@ -60,21 +1115,86 @@ Download the file from `url` and save it locally under `filename`.
               '    url      = {0}\n'
               '    filename = {1}'.format(url, filename))
     else:
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
         try:
-            response = urllib2.urlopen(url)
-            with open(filename, 'wb') as outfile:
-                shutil.copyfileobj(response, outfile)
+            try:
+                etag, last_modified, digests = _download_ranged(
+                    fetch, url, filename, headers, expected)
+            except urllib2.HTTPError as exc:
+                if 304 != exc.code:
+                    raise
+                if _cache_restore(entry, filename, expected):
+                    return 'cache'
+                # The cached file is gone or corrupt, so download it again
+                etag, last_modified, digests = _download_ranged(
+                    fetch, url, filename, None, expected)
         except Exception as exc:
             # TODO: Update `except` logic
-            raise SystemError('Unable to download file from web server.\n'
-                              'url = {0}\n'
-                              'filename = {1}\n'
-                              'Exception: {2}'
-                              .format(url, filename, exc))
-        print('Downloaded file from web server -- \n'
+            raise SystemError('Unable to download file from {0}.\n'
+                              'url = {1}\n'
+                              'filename = {2}\n'
+                              'Exception: {3}'
+                              .format('mirror' if mirror else 'web server',
+                                      url, filename, exc))
+        print('Downloaded file from {0} -- \n'
+              '    url      = {1}\n'
+              '    filename = {2}'.format('mirror' if mirror else
+                                          'web server', url, filename))
+    if _cache['dir']:
+        _cache_store(url, filename, etag, last_modified, digests,
+                     expected is not None)
+    if mirror:
+        return 'mirror'
+    return 's3' if sourceiss3bucket else 'web'
+
+
+def get_prefetched_files(prefetchindex):
+    """
+    Reads the index of artifacts that the master script has already
+    downloaded, so they need not be downloaded again.
+    :param prefetchindex: str, path to the index file written by the master
+                          script. may be None.
+    :return: dict, maps each prefetched url to its local file path
+    """
+    if not prefetchindex:
+        return {}
+    try:
+        with open(prefetchindex, 'r') as f:
+            prefetched = json.load(f)
+    except Exception as exc:
+        print('WARNING: Could not read the prefetch index, artifacts will be '
+              'downloaded.\n'
+              '    prefetchindex = {0}\n'
+              '    Exception: {1}'.format(prefetchindex, exc))
+        return {}
+    # Only trust entries whose local file still exists
+    return dict((url, path) for url, path in prefetched.items()
+                if os.path.isfile(path))
+
+
+def get_content_file(url, workingdir, prefetched, sourceiss3bucket=None,
+                     priority=0):
+    """
+    Returns the path to a local copy of the file at `url`. Uses the copy
+    prefetched by the master script, if there is one. Otherwise, downloads
+    the file to `workingdir`.
+    :param url: str, location of the file
+    :param workingdir: str, directory in which to save the file
+    :param prefetched: dict, as returned by `get_prefetched_files`
+    :param sourceiss3bucket: bool, whether the file is hosted in an S3 bucket
+    :param priority: int, priority of the download. see `download_file`.
+    :return: str, path to the local file
+    """
+    filename = prefetched.get(url)
+    if filename:
+        print('Using prefetched file -- \n'
               '    url      = {0}\n'
               '    filename = {1}'.format(url, filename))
-    return True
+    else:
+        filename = os.sep.join((workingdir, url.split('/')[-1]))
+        download_file(url, filename, sourceiss3bucket, priority)
+    return filename
 
 
 def create_working_dir(basedir, dirprefix):
@@ -86,36 +1206,353 @@ Returns the path to the working directory.
     :param basedir: str, the directory in which to create the working directory
     :param dirprefix: str, prefix to prepend to the working directory
     """
-    workingdir = None
+    workingdir = None
+    try:
+        workingdir = tempfile.mkdtemp(prefix=dirprefix, dir=basedir)
+    except Exception as exc:
+        # TODO: Update `except` logic
+        raise SystemError('Could not create workingdir in {0}.\n'
+                          'Exception: {1}'.format(basedir, exc))
+
+    return workingdir
+
+
+def get_archive_opener(filepath):
+    """
+    Returns the function and mode used to open a compressed file, based on
+    its extension.
+    Supports files that end in .zip, .tar.gz, .tgz, tar.bz2, or tbz.
+    :param filepath: str, path or url of the compressed file
+    :return: tuple, (opener, mode)
+    :raise ValueError: error raised if file extension is not supported
+    """
+    if filepath.endswith('.zip'):
+        return zipfile.ZipFile, 'r'
+    elif filepath.endswith('.tar.gz') or filepath.endswith('.tgz'):
+        return tarfile.open, 'r:gz'
+    elif filepath.endswith('.tar.bz2') or filepath.endswith('.tbz'):
+        return tarfile.open, 'r:bz2'
+    else:
+        raise ValueError('Could not extract `"{0}`" as no appropriate '
+                         'extractor is found'.format(filepath))
+
+
+def match_archive_member(name, patterns):
+    """
+    Returns True if the archive member `name` matches any of `patterns`. A
+    pattern that ends in `/`, such as `_modules/`, matches the members under
+    a directory of that name, at any depth. Other patterns, such as `*.sls`,
+    match the file name of the member, or its whole path.
+    :param name: str, path of the member in the archive
+    :param patterns: list, fnmatch patterns
+    :rtype : bool
+    """
+    parts = name.rstrip('/').split('/')
+    for pattern in patterns:
+        if pattern.endswith('/'):
+            if any(fnmatch.fnmatch(x, pattern.rstrip('/'))
+                   for x in parts[:-1]):
+                return True
+        elif fnmatch.fnmatch(parts[-1], pattern) or \
+                fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+
+def select_archive_members(members, getname, include=None, exclude=None):
+    """
+    Returns the members of an archive that match the `include` patterns, if
+    any, and do not match the `exclude` patterns. See
+    `match_archive_member`.
+    :param members: list, the members of the archive
+    :param getname: function, returns the path of a member in the archive
+    :rtype : list
+    """
+    return [x for x in members
+            if (not include or match_archive_member(getname(x), include)) and
+            not (exclude and match_archive_member(getname(x), exclude))]
+
+
+def _get_member_path(to_directory, name):
+    """
+    Returns the path to which the archive member `name` is extracted, with
+    the same sanitizing as `zipfile.ZipFile.extract`.
+    """
+    name = os.path.splitdrive(name.replace('/', os.sep))[1]
+    parts = [x for x in name.split(os.sep)
+             if x not in ('', os.curdir, os.pardir)]
+    return os.sep.join([to_directory] + parts)
+
+
+def _file_matches_member(path, info):
+    """
+    Returns True if the file at `path` has the size and CRC of the zip
+    member `info`. Only files of the same size are read.
+    """
+    try:
+        if os.path.getsize(path) != info.file_size:
+            return False
+        crc = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                crc = zlib.crc32(chunk, crc)
+    except (IOError, OSError):
+        return False
+    return crc & 0xffffffff == info.CRC
+
+
+class _MappedFile(object):
+    """
+    File-like view of a memory map, for `zipfile`. A python 2 mmap cannot
+    read to the end without a size.
+    """
+    def __init__(self, mapped):
+        self.mapped = mapped
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.mapped) - self.mapped.tell()
+        return self.mapped.read(size)
+
+    def seek(self, offset, whence=0):
+        self.mapped.seek(offset, whence)
+
+    def tell(self):
+        return self.mapped.tell()
+
+    def close(self):
+        pass
+
+
+def extract_zip(filepath, to_directory, include=None, exclude=None,
+                previous=None):
+    """
+    Extracts the members of a zip archive that match the `include` and
+    `exclude` patterns. The archive is memory-mapped, and its central
+    directory is read once. A member whose size and CRC match the file
+    already at its destination is not extracted again. If `previous` is set,
+    a member that matches the file at the same path in a previous extraction
+    is hard linked from it, rather than extracted.
+    :param filepath: str, path to the zip archive
+    :param to_directory: str, path to the target directory
+    :param include: list, patterns of the members to extract. all members
+                    are extracted if empty.
+    :param exclude: list, patterns of the members to skip
+    :param previous: tuple, (member prefix, directory). the members under
+                     the prefix were extracted to the directory before.
+    :return: dict, the number of members `extracted`, `unchanged`, `linked`
+             from the previous extraction, and `filtered` by the patterns
+    """
+    counts = {'extracted': 0, 'unchanged': 0, 'linked': 0, 'filtered': 0}
+    with open(filepath, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        archive = zipfile.ZipFile(_MappedFile(mapped))
+        members = archive.infolist()
+        selected = select_archive_members(members, lambda x: x.filename,
+                                          include, exclude)
+        counts['filtered'] = len(members) - len(selected)
+        for info in selected:
+            path = _get_member_path(to_directory, info.filename)
+            if info.filename.endswith('/'):
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                continue
+            if _file_matches_member(path, info):
+                counts['unchanged'] += 1
+                continue
+            parent = os.path.dirname(path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            if os.path.lexists(path):
+                # Replace the file, rather than write through a hard link
+                os.remove(path)
+            if previous and info.filename.startswith(previous[0]):
+                previouspath = _get_member_path(
+                    previous[1], info.filename[len(previous[0]):])
+                if _file_matches_member(previouspath, info):
+                    try:
+                        os.link(previouspath, path)
+                        counts['linked'] += 1
+                        continue
+                    except OSError:
+                        pass
+            source = archive.open(info)
+            try:
+                with open(path, 'wb') as target:
+                    shutil.copyfileobj(source, target, 1024 * 1024)
+            finally:
+                source.close()
+            counts['extracted'] += 1
+        archive.close()
+    finally:
+        mapped.close()
+    return counts
+
+
+def _open_scheduled(url, host, priority, opener):
+    """
+    Calls `opener` to open `url` once the download engine gives it a
+    connection slot to `host`. The slot is freed when the response is closed.
+    :return: file-like object that streams the contents of the file
+    """
+    _acquire_connection(host, priority)
+    try:
+        response = opener()
+    except Exception:
+        _release_connection(host)
+        raise
+    return _ScheduledResponse(response, url, host, None)
+
+
+def open_url(url, sourceiss3bucket=None, priority=0):
+    """
+    Opens the file at `url` for reading, without saving it to disk. The
+    request is scheduled by the download engine. See `configure_downloads`.
+    :param url: str, location of the file
+    :param sourceiss3bucket: bool, whether the file is hosted in an S3 bucket
+    :param priority: int, lower priorities get connections first
+    :return: file-like object that streams the contents of the file
+    :raise SystemError: error raised if the file cannot be opened
+    """
+    if _mirror_available() and get_mirror_url(url):
+        try:
+            return _open_scheduled(
+                url, _get_download_host(_open_mirror_range, url), priority,
+                lambda: urllib2.urlopen(get_mirror_url(url), timeout=60))
+        except Exception as exc:
+            print('WARNING: Could not open file from the mirror, trying its '
+                  'source.\n'
+                  '    url = {0}\n'
+                  '    Exception: {1}'.format(url, exc))
+            _mirror_available(recheck=True)
+    if sourceiss3bucket:
+        bucket_name, key_name = parse_s3_url(url)
+
+        def open_key():
+            key = get_s3_key(bucket_name, key_name)
+            key.open_read()
+            return key
+        try:
+            return _open_scheduled(
+                url, _get_download_host(_open_s3_range, url), priority,
+                open_key)
+        except Exception as exc:
+            raise SystemError('Unable to open file from S3 bucket.\n'
+                              'url = {0}\n'
+                              'bucket = {1}\n'
+                              'key = {2}\n'
+                              'Exception: {3}'
+                              .format(url, bucket_name, key_name, exc))
+    else:
+        try:
+            return _open_scheduled(
+                url, _get_download_host(_open_http_range, url), priority,
+                lambda: urllib2.urlopen(url))
+        except Exception as exc:
+            raise SystemError('Unable to open file from web server.\n'
+                              'url = {0}\n'
+                              'Exception: {1}'.format(url, exc))
+
+
+def stream_extract_contents(url,
+                            to_directory='.',
+                            sourceiss3bucket=None,
+                            spooldir=None,
+                            spoolsize=64 * 1024 * 1024,
+                            include=None,
+                            exclude=None,
+                            priority=0):
+    """
+    Extracts a compressed file to the specified directory while it is
+    downloaded, so the archive is never saved to disk first. Tar archives are
+    extracted straight from the response stream. Zip archives require random
+    access to their central directory, so they are spooled in memory, up to
+    `spoolsize` bytes, before being extracted. Larger zip archives overflow
+    to a temporary file in `spooldir`.
+    Archives extracted this way bypass the artifact cache.
+    :param url: str, location of the compressed file
+    :param to_directory: str, path to the target directory
+    :param sourceiss3bucket: bool, whether the file is hosted in an S3 bucket
+    :param spooldir: str, directory for zip archives larger than `spoolsize`
+    :param spoolsize: int, maximum bytes of a zip archive to hold in memory
+    :param include: list, patterns of the members to extract. see
+                    `select_archive_members`.
+    :param exclude: list, patterns of the members to skip
+    :param priority: int, priority of the download. see `open_url`.
+    :raise ValueError: error raised if file extension is not supported
+    """
+    opener, mode = get_archive_opener(url)
+
     try:
-        workingdir = tempfile.mkdtemp(prefix=dirprefix, dir=basedir)
-    except Exception as exc:
-        # TODO: Update `except` logic
-        raise SystemError('Could not create workingdir in {0}.\n'
-                          'Exception: {1}'.format(basedir, exc))
+        os.makedirs(to_directory)
+    except OSError:
+        if not os.path.isdir(to_directory):
+            raise
 
-    return workingdir
+    with timed_phase('stream_extract_contents', source=url,
+                     dest=to_directory):
+        response = open_url(url, sourceiss3bucket, priority)
+        try:
+            if opener is zipfile.ZipFile:
+                spool = tempfile.SpooledTemporaryFile(max_size=spoolsize,
+                                                      dir=spooldir)
+                try:
+                    shutil.copyfileobj(response, spool)
+                    spool.seek(0)
+                    openfile = opener(spool, mode)
+                    try:
+                        openfile.extractall(to_directory,
+                                            select_archive_members(
+                                                openfile.infolist(),
+                                                lambda x: x.filename,
+                                                include, exclude))
+                    finally:
+                        openfile.close()
+                finally:
+                    spool.close()
+            else:
+                # `r|gz` and `r|bz2` read the tar stream sequentially
+                openfile = opener(fileobj=response, mode=mode.replace(':', '|'))
+                try:
+                    # A tar stream is read once, so members are filtered as
+                    # they are read
+                    for member in openfile:
+                        if select_archive_members([member],
+                                                  lambda x: x.name,
+                                                  include, exclude):
+                            openfile.extract(member, to_directory)
+                finally:
+                    openfile.close()
+        finally:
+            response.close()
+
+    print('Extracted file while downloading -- \n'
+          '    source = {0}\n'
+          '    dest   = {1}'.format(url, to_directory))
+    return True
 
 
 def extract_contents(filepath,
                      to_directory='.',
-                     createdirfromfilename=None):
+                     createdirfromfilename=None,
+                     include=None,
+                     exclude=None,
+                     previous=None):
     """
     Extracts a compressed file to the specified directory.
     Supports files that end in .zip, .tar.gz, .tgz, tar.bz2, or tbz.
+    Zip archives are extracted incrementally, see `extract_zip`.
     :param filepath: str, path to the compressed file
     :param to_directory: str, path to the target directory
+    :param include: list, patterns of the members to extract. see
+                    `select_archive_members`.
+    :param exclude: list, patterns of the members to skip
+    :param previous: tuple, (member prefix, directory) of a previous
+                     extraction of the archive. see `extract_zip`.
     :raise ValueError: error raised if file extension is not supported
     """
-    if filepath.endswith('.zip'):
-        opener, mode = zipfile.ZipFile, 'r'
-    elif filepath.endswith('.tar.gz') or filepath.endswith('.tgz'):
-        opener, mode = tarfile.open, 'r:gz'
-    elif filepath.endswith('.tar.bz2') or filepath.endswith('.tbz'):
-        opener, mode = tarfile.open, 'r:bz2'
-    else:
-        raise ValueError('Could not extract `"{0}`" as no appropriate '
-                         'extractor is found'.format(filepath))
+    opener, mode = get_archive_opener(filepath)
 
     if createdirfromfilename:
         to_directory = os.sep.join((
@@ -128,24 +1565,1083 @@ def extract_contents(filepath,
         if not os.path.isdir(to_directory):
             raise
 
-    cwd = os.getcwd()
-    os.chdir(to_directory)
+    # Extract to an explicit path. Changing the working directory would
+    # affect every thread in the process.
+    with timed_phase('extract_contents', source=filepath,
+                     dest=to_directory) as phase:
+        if opener is zipfile.ZipFile:
+            phase.update(extract_zip(filepath, to_directory, include,
+                                     exclude, previous))
+        else:
+            openfile = opener(filepath, mode)
+            try:
+                openfile.extractall(to_directory, select_archive_members(
+                    openfile.getmembers(), lambda x: x.name,
+                    include, exclude))
+            finally:
+                openfile.close()
+
+    print('Extracted file -- \n'
+          '    source = {0}\n'
+          '    dest   = {1}'.format(filepath, to_directory))
+    return True
+
+
+def get_file_digest(filepath):
+    """
+    Returns the SHA256 digest of a file.
+    :param filepath: str, path to the file
+    :return: str, hex digest
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_tree_digest(path):
+    """
+    Returns a SHA256 digest of the relative paths and contents of all files
+    under a directory.
+    :param path: str, path to the directory
+    :return: str, hex digest, or None if the directory does not exist
+    """
+    if not os.path.isdir(path):
+        return None
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            filepath = os.path.join(root, name)
+            digest.update(os.path.relpath(filepath, path).encode('utf-8'))
+            if os.path.islink(filepath):
+                digest.update(os.readlink(filepath).encode('utf-8'))
+            else:
+                digest.update(get_file_digest(filepath).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def read_formula_manifest(saltformularoot):
+    """
+    Reads the manifest of formulas installed to `saltformularoot`.
+    :param saltformularoot: str, directory containing the salt formulas
+    :return: dict, maps each formula name to the source url, archive digest
+             and tree digest of the installed formula
+    """
+    manifestfile = os.sep.join((saltformularoot, '.systemprep-formulas.json'))
+    try:
+        with open(manifestfile, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_formula_manifest(saltformularoot, manifest):
+    """
+    Saves the manifest of formulas installed to `saltformularoot`.
+    :param saltformularoot: str, directory containing the salt formulas
+    :param manifest: dict, as returned by `read_formula_manifest`
+    """
+    manifestfile = os.sep.join((saltformularoot, '.systemprep-formulas.json'))
+    fd, tmpfile = tempfile.mkstemp(dir=saltformularoot)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(tmpfile, manifestfile)
+
+
+def get_installed_packages(packages):
+    """
+    Queries the rpm database for the installed version of each package.
+    :param packages: list, names of the packages to query
+    :return: dict, maps each installed package to its version
+    """
+    try:
+        proc = subprocess.Popen(
+            ['rpm', '-q', '--qf', '%{NAME} %{VERSION}\n'] + list(packages),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        output = proc.communicate()[0]
+    except OSError:
+        return {}
+    installed = {}
+    for line in output.splitlines():
+        # Missing packages are reported as `package <name> is not installed`
+        fields = line.split()
+        if len(fields) == 2 and fields[0] in packages:
+            installed[fields[0]] = fields[1]
+    return installed
+
+
+def yum_packages_installed(packages, saltversion):
+    """
+    Checks whether all of `packages` are installed, with a salt-minion that
+    satisfies `saltversion`. yum skips the packages it cannot find and still
+    exits 0, so this is checked after each yum install.
+    :param packages: list, names of the packages
+    :param saltversion: str, the requested salt version, or None
+    :return: dict, as returned by `get_installed_packages`, or None if a
+             package is missing or salt-minion does not match
+    """
+    installed = get_installed_packages(packages)
+    if len(installed) == len(packages) and \
+            salt_version_matches(installed.get('salt-minion'), saltversion):
+        return installed
+    return None
+
+
+def get_salt_call_version(saltcall):
+    """
+    Gets the version of an installed salt, from `salt-call --version`.
+    :param saltcall: str, path to salt-call
+    :return: str, the version, or None if salt is not installed
+    """
+    try:
+        proc = subprocess.Popen([saltcall, '--version'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        output = proc.communicate()[0]
+    except OSError:
+        return None
+    # The output looks like `salt-call 2015.5.3 (Lithium)`
+    m = re.match(r'^\S+\s+v?(\d\S*)', output)
+    return m.group(1) if proc.returncode == 0 and m else None
+
+
+def salt_version_matches(installedversion, saltversion):
+    """
+    Checks whether an installed salt satisfies the requested `saltversion`.
+    A requested version matches the same version or any release of it, so
+    `2015.5` matches `2015.5.3`. Any installed version satisfies an empty
+    `saltversion`. Git branches never match, so they are always installed.
+    :param installedversion: str, the installed version, or None
+    :param saltversion: str, the requested version or git tag
+    :return: bool
+    """
+    if not installedversion:
+        return False
+    if not saltversion:
+        return True
+    saltversion = saltversion.lstrip('v')
+    return installedversion == saltversion or \
+        installedversion.startswith(saltversion + '.')
+
+
+def read_host_facts(hostfactsfile):
+    """
+    Reads the host facts detected by the master script.
+    :param hostfactsfile: str, path to the host facts file
+    :return: dict, the host facts, or None if they are not available
+    """
+    if not hostfactsfile or 'none' == hostfactsfile.lower():
+        return None
+    try:
+        with open(hostfactsfile, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def read_yum_repo_status(statusfile):
+    """
+    Reads the status file written by the yum repo install script.
+    :param statusfile: str, path to the status file
+    :return: dict, lists of the `changed` and `unchanged` repo files, or None
+             if the status is not known
+    """
+    if not statusfile or 'none' == statusfile.lower():
+        return None
+    try:
+        with open(statusfile, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
 
+def read_install_record(recordfile):
+    """
+    Reads the record of the salt install and content left by a `full` or
+    `prebake` run.
+    :param recordfile: str, path to the install record
+    :return: dict, the install settings, or None if there is no record
+    """
     try:
-        openfile = opener(filepath, mode)
+        with open(recordfile, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_install_record(recordfile, record):
+    """
+    Saves the record of the salt install and content, so a later `finalize`
+    run can check that the system was prepared with the same settings.
+    :param recordfile: str, path to the install record
+    :param record: dict, the install settings
+    """
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(recordfile))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(record, f, indent=2, sort_keys=True)
+    os.rename(tmpfile, recordfile)
+
+
+def get_formula_name(formulasource, formulaterminationstrings):
+    """
+    Returns the name of the formula at `formulasource`, and the name of the
+    directory it is archived under.
+    :param formulasource: str, location of the compressed formula
+    :param formulaterminationstrings: list, strings that will be removed from
+                                      the end of the formula name
+    :return: tuple, (formula name, archived directory name)
+    """
+    formulafilename = formulasource.split('/')[-1]
+    formulafilebase = '.'.join(formulafilename.split('.')[:-1])
+    formulaname = formulafilebase
+    for string in formulaterminationstrings:
+        if formulafilebase.endswith(string):
+            formulaname = formulaname[:-len(string)]
+    return formulaname, formulafilebase
+
+
+def _formula_is_installed(installed, formulasource, filters, formuladir):
+    """
+    Returns whether the manifest entry `installed` shows the formula from
+    `formulasource` installed with `filters`, and unchanged since.
+    """
+    return installed.get('source') == formulasource and \
+        installed.get('filters', [[], []]) == filters and \
+        installed.get('tree_sha256') == get_tree_digest(formuladir)
+
+
+def get_url_etag(url):
+    """
+    Returns the ETag of the file at `url`, with a request for its first
+    byte. The mirror is asked first, if one is configured.
+    :return: str, the ETag, or None if there is none or the request fails
+    """
+    if _cache['offline']:
+        return None
+    fetches = [_open_http_range]
+    if _mirror_available() and get_mirror_url(url):
+        fetches.insert(0, _open_mirror_range)
+    for fetch in fetches:
         try:
-            openfile.extractall()
-        finally:
-            openfile.close()
+            response, _, _, etag, _ = _schedule_fetch(fetch)(url, 0, 0)
+        except Exception:
+            continue
+        response.close()
+        return etag
+    return None
+
+
+def install_formula(formulasource,
+                    saltformularoot,
+                    formulaterminationstrings,
+                    manifest,
+                    formulafile=None,
+                    workingdir=None,
+                    include=None,
+                    exclude=None,
+                    priority=0,
+                    etag=None):
+    """
+    Installs a salt formula to `saltformularoot`. The formula is skipped if
+    the manifest shows that the same archive from the same source is already
+    installed, with the same patterns, and that the installed files have not
+    changed since. Otherwise the formula is extracted to a staging directory,
+    and moved to `.versions/<name>/<version>` under `saltformularoot`. The
+    formula directory is a symlink to the installed version, and is replaced
+    with a single rename, so salt never sees a partially extracted or a
+    missing formula. Files that are the same as in the previous version are
+    linked from it instead of extracted. The manifest is updated
+    accordingly.
+    :param formulasource: str, location of the compressed formula
+    :param saltformularoot: str, directory containing the salt formulas
+    :param formulaterminationstrings: list, strings that will be removed from
+                                      the end of the formula name
+    :param manifest: dict, as returned by `read_formula_manifest`
+    :param formulafile: str, path to a local copy of the compressed formula.
+                        if None, the formula is extracted while it downloads.
+    :param workingdir: str, directory for temporary files
+    :param include: list, patterns of the archive members to extract. see
+                    `select_archive_members`.
+    :param exclude: list, patterns of the archive members to skip
+    :param priority: int, priority of the download, if it is streamed
+    :param etag: str, ETag of the archive at `formulasource`, if known
+    :return: str, path to the installed formula
+    """
+    formulaname, formulafilebase = get_formula_name(
+        formulasource, formulaterminationstrings)
+    formuladir = os.sep.join((saltformularoot, formulaname))
+
+    archivedigest = get_file_digest(formulafile) if formulafile else None
+    filters = [list(include or []), list(exclude or [])]
+    installed = manifest.get(formulaname, {})
+    if archivedigest and \
+            installed.get('archive_sha256') == archivedigest and \
+            _formula_is_installed(installed, formulasource, filters,
+                                  formuladir):
+        if etag:
+            installed['etag'] = etag
+        print('Formula is unchanged, skipping extraction -- \n'
+              '    source = {0}\n'
+              '    dest   = {1}'.format(formulasource, formuladir))
+        return formuladir
+
+    versionsdir = os.sep.join((saltformularoot, '.versions', formulaname))
+    stagingdir = tempfile.mkdtemp(prefix='.staging-', dir=saltformularoot)
+    try:
+        if formulafile:
+            previous = (formulafilebase + '/', formuladir) \
+                if os.path.isdir(formuladir) else None
+            extract_contents(filepath=formulafile,
+                             to_directory=stagingdir,
+                             include=include,
+                             exclude=exclude,
+                             previous=previous)
+        else:
+            stream_extract_contents(url=formulasource,
+                                    to_directory=stagingdir,
+                                    spooldir=workingdir,
+                                    include=include,
+                                    exclude=exclude,
+                                    priority=priority)
+        stagedformuladir = os.sep.join((stagingdir, formulafilebase))
+        if not os.path.isdir(stagedformuladir):
+            raise SystemError('Formula archive does not contain the expected '
+                              'directory.\n'
+                              'source = {0}\n'
+                              'directory = {1}'
+                              .format(formulasource, formulafilebase))
+        treedigest = get_tree_digest(stagedformuladir)
+        # Versions are named by their content, so an identical version that
+        # is already installed is reused
+        version = treedigest[:16]
+        versiondir = os.sep.join((versionsdir, version))
+        if os.path.isdir(versiondir) and \
+                get_tree_digest(versiondir) != treedigest:
+            shutil.rmtree(versiondir)
+        if not os.path.isdir(versiondir):
+            if not os.path.isdir(versionsdir):
+                os.makedirs(versionsdir)
+            os.rename(stagedformuladir, versiondir)
+        link = os.sep.join((stagingdir, '.link'))
+        os.symlink(os.path.relpath(versiondir, saltformularoot), link)
+        if os.path.isdir(formuladir) and not os.path.islink(formuladir):
+            # A formula installed before versions were kept is a directory,
+            # which a rename cannot replace with the link. It is moved aside
+            # first, so the formula is missing only during this migration.
+            os.rename(formuladir, os.sep.join((stagingdir, '.previous')))
+        # Swap the new version in place of the previous one
+        os.rename(link, formuladir)
     finally:
-        os.chdir(cwd)
+        shutil.rmtree(stagingdir, ignore_errors=True)
 
-    print('Extracted file -- \n'
+    # Remove the previous versions, and any left by an interrupted install
+    for name in os.listdir(versionsdir):
+        if name != version:
+            shutil.rmtree(os.sep.join((versionsdir, name)),
+                          ignore_errors=True)
+
+    manifest[formulaname] = {
+        'source': formulasource,
+        'archive_sha256': archivedigest,
+        'tree_sha256': treedigest,
+    }
+    if etag:
+        manifest[formulaname]['etag'] = etag
+    if include or exclude:
+        manifest[formulaname]['filters'] = filters
+    print('Installed formula -- \n'
           '    source = {0}\n'
-          '    dest   = {1}'.format(filepath, to_directory))
+          '    dest   = {1}'.format(formulasource, formuladir))
+    return formuladir
+
+
+def _install_formula_from_source(formulasource,
+                                 workingdir,
+                                 prefetched,
+                                 streamcontent,
+                                 priority=0,
+                                 **kwargs):
+    """
+    Gets a local copy of the formula at `formulasource`, unless it will be
+    streamed, and installs it. See `install_formula` for `kwargs`. A formula
+    that was not prefetched is not downloaded if its ETag matches the one in
+    the manifest, and it is installed and unchanged.
+    :return: str, path to the installed formula
+    """
+    etag = None
+    if formulasource not in prefetched:
+        formulaname = get_formula_name(
+            formulasource, kwargs['formulaterminationstrings'])[0]
+        formuladir = os.sep.join((kwargs['saltformularoot'], formulaname))
+        installed = kwargs['manifest'].get(formulaname, {})
+        filters = [list(kwargs.get('include') or []),
+                   list(kwargs.get('exclude') or [])]
+        etag = get_url_etag(formulasource)
+        if etag and installed.get('etag') == etag and \
+                _formula_is_installed(installed, formulasource, filters,
+                                      formuladir):
+            print('Formula is unchanged, skipping download -- \n'
+                  '    source = {0}\n'
+                  '    dest   = {1}'.format(formulasource, formuladir))
+            return formuladir
+    formulafile = None
+    if not streamcontent or formulasource in prefetched:
+        formulafile = get_content_file(formulasource, workingdir, prefetched,
+                                       priority=priority)
+    return install_formula(formulasource=formulasource,
+                           formulafile=formulafile,
+                           workingdir=workingdir,
+                           priority=priority,
+                           etag=etag,
+                           **kwargs)
+
+
+def install_formulas(formulastoinclude,
+                     saltformularoot,
+                     formulaterminationstrings,
+                     manifest,
+                     workingdir,
+                     prefetched,
+                     streamcontent=False,
+                     maxworkers=4,
+                     include=None,
+                     exclude=None):
+    """
+    Installs salt formulas in parallel, using a bounded pool of threads. Each
+    formula is downloaded (unless it was prefetched), extracted, renamed and
+    swapped into place independently of the others. See `install_formula`.
+    Formulas are downloaded in priority of their order. The first formula
+    that fails cancels the downloads of the others, since the run fails.
+    :param formulastoinclude: list, locations of the compressed formulas
+    :param saltformularoot: str, directory containing the salt formulas
+    :param formulaterminationstrings: list, strings that will be removed from
+                                      the end of the formula names
+    :param manifest: dict, as returned by `read_formula_manifest`
+    :param workingdir: str, directory for temporary files
+    :param prefetched: dict, as returned by `get_prefetched_files`
+    :param streamcontent: bool, whether to extract formulas that were not
+                          prefetched while they download
+    :param maxworkers: int, the maximum number of formulas to install at once
+    :param include: list, patterns of the archive members to extract
+    :param exclude: list, patterns of the archive members to skip
+    :return: list, path to each installed formula, in the same order as
+             `formulastoinclude`
+    """
+    if not formulastoinclude:
+        return []
+    install = functools.partial(
+        _install_formula_from_source,
+        workingdir=workingdir,
+        prefetched=prefetched,
+        streamcontent=streamcontent,
+        saltformularoot=saltformularoot,
+        formulaterminationstrings=formulaterminationstrings,
+        manifest=manifest,
+        include=include,
+        exclude=exclude)
+
+    def install_or_cancel(formula):
+        priority, formulasource = formula
+        try:
+            return install(formulasource, priority=priority)
+        except Exception as exc:
+            cancel_downloads('{0} -- {1}'.format(formulasource, exc))
+            raise
+
+    pool = ThreadPool(max(1, min(maxworkers, len(formulastoinclude))))
+    try:
+        return pool.map(install_or_cancel, list(enumerate(formulastoinclude)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+_match_config_key = re.compile(r'^(#?)([A-Za-z0-9_.-]+):')
+_match_config_continuation = re.compile(r'^(?:[ \t]+\S|-)')
+_match_commented_config_continuation = re.compile(r'^#[ \t]{2,}\S')
+
+
+def render_config_setting(key, value, indent=0):
+    """
+    Renders a setting as YAML lines, in the style of the salt config files.
+    Supports scalars, lists of scalars, and dictionaries of those.
+    :param key: str, name of the setting
+    :param value: the value of the setting
+    :param indent: int, number of spaces to indent the setting
+    :return: list, lines of YAML
+    """
+    prefix = ' ' * indent
+    if isinstance(value, dict):
+        lines = ['{0}{1}:\n'.format(prefix, key)]
+        for subkey in sorted(value):
+            lines += render_config_setting(subkey, value[subkey], indent + 2)
+        return lines
+    if isinstance(value, (list, tuple)):
+        return ['{0}{1}:\n'.format(prefix, key)] + \
+            ['{0}  - {1}\n'.format(prefix, item) for item in value]
+    return ['{0}{1}: {2}\n'.format(prefix, key, value)]
+
+
+def update_config_file(path, settings):
+    """
+    Sets top-level keys in a YAML config file, such as the salt minion conf,
+    in a single pass over the file. A key's section starts at a `key:` line,
+    or at a commented default, `#key:`, and includes the indented lines that
+    follow it. An uncommented section is replaced in preference to a
+    commented one. Keys that have no section are appended to the file.
+    The file is rewritten atomically, via a temp file and a rename, and only
+    if its content changes. The previous version is saved as `<path>.bak`.
+    :param path: str, path to the config file
+    :param settings: dict, maps each key to set to its value. see
+                     `render_config_setting` for the supported values.
+    :return: bool, whether the file was changed
+    """
+    with open(path, 'r') as f:
+        lines = f.readlines()
+
+    # Parse the file once, finding the section of each key to set
+    sections = {}
+    current = None
+    for n, line in enumerate(lines + ['']):
+        if current is not None:
+            key, start, commented = current
+            continuation = _match_commented_config_continuation \
+                if commented else _match_config_continuation
+            if line and continuation.match(line):
+                continue
+            # Prefer the first uncommented section, then the first commented
+            previous = sections.get(key)
+            if previous is None or (previous[2] and not commented):
+                sections[key] = (start, n, commented)
+            current = None
+        m = _match_config_key.match(line)
+        if m and m.group(2) in settings:
+            current = (m.group(2), n, bool(m.group(1)))
+
+    # Rebuild the file, replacing each section with its new setting
+    replacements = dict((start, (end, key))
+                        for key, (start, end, _) in sections.items())
+    newlines = []
+    n = 0
+    while n < len(lines):
+        if n in replacements:
+            end, key = replacements[n]
+            newlines += render_config_setting(key, settings[key])
+            n = end
+        else:
+            newlines.append(lines[n])
+            n += 1
+    for key in sorted(set(settings) - set(sections)):
+        if newlines and not newlines[-1].endswith('\n'):
+            newlines[-1] += '\n'
+        newlines += ['\n'] + render_config_setting(key, settings[key])
+
+    if newlines == lines:
+        return False
+
+    shutil.copyfile(path, '{0}.bak'.format(path))
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(newlines)
+        shutil.copymode(path, tmpfile)
+        os.rename(tmpfile, path)
+    except Exception:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
     return True
 
 
+_match_json_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def iter_salt_state_results(fileobj, chunksize=65536):
+    """
+    Yields the state results in a salt-call `--out json` results file one at
+    a time, reading the file in chunks so memory use does not grow with its
+    size. The file holds an object that maps each minion id, `local` for a
+    masterless salt-call, to an object that maps each state id to its result.
+    When salt cannot render the states, the minion id maps to a list of
+    errors instead, which is yielded with a state id of `None`. salt-call
+    appends to an existing results file, so consecutive objects are all read.
+    :param fileobj: file, open results file
+    :param chunksize: int, number of bytes to read at a time
+    :return: generator of (minion, stateid, result) tuples
+    """
+    decoder = json.JSONDecoder()
+    stream = {'buf': '', 'pos': 0, 'eof': False}
+
+    def fill(size):
+        # Drop the consumed part of the buffer before reading more
+        data = fileobj.read(size)
+        if not data:
+            stream['eof'] = True
+        stream['buf'] = stream['buf'][stream['pos']:] + data
+        stream['pos'] = 0
+
+    def peek():
+        while True:
+            stream['pos'] = _match_json_whitespace.match(
+                stream['buf'], stream['pos']).end()
+            if stream['pos'] < len(stream['buf']):
+                return stream['buf'][stream['pos']]
+            if stream['eof']:
+                return ''
+            fill(chunksize)
+
+    def expect(chars):
+        char = peek()
+        if not char or char not in chars:
+            raise ValueError('Expected one of {0!r} in the salt results, '
+                             'found {1!r}'.format(chars, char))
+        stream['pos'] += 1
+        return char
+
+    def decode():
+        peek()
+        size = chunksize
+        while True:
+            try:
+                value, end = decoder.raw_decode(stream['buf'], stream['pos'])
+            except ValueError:
+                # Most likely the value continues past the buffer
+                if stream['eof']:
+                    raise
+                fill(size)
+                size *= 2
+                continue
+            # A number ending the buffer may continue in the next chunk
+            if end == len(stream['buf']) and not stream['eof'] and \
+                    not isinstance(value, (dict, list, basestring)):
+                fill(size)
+                continue
+            stream['pos'] = end
+            return value
+
+    while peek():
+        expect('{')
+        if peek() == '}':
+            expect('}')
+            continue
+        while True:
+            minion = decode()
+            expect(':')
+            if peek() == '{':
+                expect('{')
+                if peek() == '}':
+                    expect('}')
+                else:
+                    while True:
+                        stateid = decode()
+                        expect(':')
+                        yield minion, stateid, decode()
+                        if expect(',}') == '}':
+                            break
+            else:
+                yield minion, None, decode()
+            if expect(',}') == '}':
+                break
+
+
+def get_salt_state_duration(result):
+    """
+    Gets the duration of a salt state, in milliseconds. Depending on the salt
+    version, the duration is a number or a string such as `12.3 ms`.
+    :param result: dict, result of the state from the salt-call output
+    :return: float
+    """
+    duration = result.get('duration') or 0
+    if isinstance(duration, basestring):
+        duration = duration.split()[0] if duration.split() else 0
+    try:
+        return float(duration)
+    except ValueError:
+        return 0.0
+
+
+def get_salt_state_start(result):
+    """
+    Gets the start time of a salt state, as seconds since midnight. salt
+    reports the start time as a local time of day, `HH:MM:SS.ffffff`.
+    :param result: dict, result of the state from the salt-call output
+    :return: float, or None if the state has no valid start time
+    """
+    try:
+        hours, minutes, seconds = str(result['start_time']).split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except (KeyError, ValueError):
+        return None
+
+
+def summarize_salt_results(resultsfile, top=10):
+    """
+    Summarizes a salt-call `--out json` results file. The file is streamed
+    with `iter_salt_state_results`, keeping only counts, the ids of failed
+    states, a heap of the slowest states, and the totals of each formula. A
+    state's formula is the first part of its sls name, so `ash-linux.stig`
+    belongs to the formula `ash-linux`.
+    :param resultsfile: str, path to the results file
+    :param top: int, number of the slowest states to include
+    :return: dict, with the number of succeeded, failed, unknown, and
+             changed states, the total duration of the states, in
+             milliseconds, the ids of the failed states, the `top` slowest
+             states, any errors that kept salt from running the states, and
+             the totals of each formula. The `start` and `end` of a formula
+             are seconds from the start of the first state in the run.
+    """
+    summary = {
+        'succeeded': 0,
+        'failed': 0,
+        'unknown': 0,
+        'changed': 0,
+        'duration': 0.0,
+        'failed_states': [],
+        'errors': [],
+        'formulas': {},
+    }
+    slowest = []
+    # Start times are a time of day, so the bounds of each formula are kept
+    # separately for the morning and the afternoon, in case a run wraps
+    # midnight
+    bounds = {}
+    with open(resultsfile, 'rb') as f:
+        for minion, stateid, result in iter_salt_state_results(f):
+            if stateid is None or not isinstance(result, dict):
+                errors = result if isinstance(result, list) else [result]
+                summary['errors'] += ['{0}: {1}'.format(minion, error)
+                                      for error in errors]
+                continue
+            if result.get('result') is True:
+                summary['succeeded'] += 1
+            elif result.get('result') is False:
+                summary['failed'] += 1
+                summary['failed_states'].append(stateid)
+            else:
+                # `None` means the state would have changed in a test run
+                summary['unknown'] += 1
+            if result.get('changes'):
+                summary['changed'] += 1
+            duration = get_salt_state_duration(result)
+            summary['duration'] += duration
+            sls = result.get('__sls__') or 'unknown'
+            entry = (duration, stateid, sls, result.get('start_time'))
+            if len(slowest) < top:
+                heapq.heappush(slowest, entry)
+            elif slowest:
+                heapq.heappushpop(slowest, entry)
+
+            formula = summary['formulas'].setdefault(sls.split('.')[0], {
+                'states': 0,
+                'failed': 0,
+                'changed': 0,
+                'duration': 0.0,
+            })
+            formula['states'] += 1
+            formula['failed'] += result.get('result') is False
+            formula['changed'] += bool(result.get('changes'))
+            formula['duration'] += duration
+            start = get_salt_state_start(result)
+            if start is not None:
+                half = bounds.setdefault(sls.split('.')[0], {}) \
+                    .setdefault(start >= 43200, [start, start])
+                half[0] = min(half[0], start)
+                half[1] = max(half[1], start + duration / 1000)
+
+    # Make the bounds relative to the start of the first state
+    starts = [half[0] for halves in bounds.values() for half in halves.values()]
+    wrapped = bool(starts) and max(starts) - min(starts) > 43200
+    runstart = min(half[0] for halves in bounds.values()
+                   for pm, half in halves.items() if pm or not wrapped) \
+        if starts else 0
+    for name, formula in summary['formulas'].items():
+        formula['duration'] = round(formula['duration'], 3)
+        halves = bounds.get(name, {})
+        if wrapped and False in halves:
+            halves[False] = [x + 86400 for x in halves[False]]
+        if halves:
+            formula['start'] = round(min(x[0] for x in halves.values()) -
+                                     runstart, 3)
+            formula['end'] = round(max(x[1] for x in halves.values()) -
+                                   runstart, 3)
+        else:
+            formula['start'] = formula['end'] = None
+    summary['duration'] = round(summary['duration'], 3)
+    summary['slowest'] = [{'state': stateid,
+                           'sls': sls,
+                           'start_time': start_time,
+                           'duration': duration}
+                          for duration, stateid, sls, start_time
+                          in sorted(slowest, reverse=True)]
+    return summary
+
+
+def write_salt_profile(summary, profilefile):
+    """
+    Writes a profile of a salt state run, ranking the formulas by the time
+    spent in their states. An existing profile is kept as `<profilefile>.prev`
+    so consecutive runs can be compared.
+    :param summary: dict, summary from `summarize_salt_results`
+    :param profilefile: str, path to the profile file
+    :return: dict, the profile
+    """
+    total = summary['duration']
+    formulas = []
+    for name, formula in summary['formulas'].items():
+        formula = dict(formula, formula=name)
+        formula['share'] = round(formula['duration'] / total, 4) \
+            if total else 0.0
+        formulas.append(formula)
+    formulas.sort(key=lambda x: x['duration'], reverse=True)
+    profile = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'states': summary['succeeded'] + summary['failed'] +
+        summary['unknown'],
+        'duration': total,
+        'formulas': formulas,
+        'slowest': summary['slowest'],
+    }
+
+    if os.path.exists(profilefile):
+        os.rename(profilefile, '{0}.prev'.format(profilefile))
+    tmpfile = '{0}.tmp'.format(profilefile)
+    with open(tmpfile, 'w') as f:
+        json.dump(profile, f, indent=4, sort_keys=True)
+    os.rename(tmpfile, profilefile)
+    return profile
+
+
+def compare_salt_profiles(profile, baseline):
+    """
+    Compares the formula durations of two salt state run profiles.
+    :param profile: dict, profile from `write_salt_profile`
+    :param baseline: dict, profile to compare against
+    :return: list of dicts, the `duration` and `states` of each formula in
+             either profile, the baseline `previous_duration` and
+             `previous_states`, and the `delta` in duration, sorted by the
+             largest increase first
+    """
+    current = dict((x['formula'], x) for x in profile['formulas'])
+    previous = dict((x['formula'], x) for x in baseline['formulas'])
+    comparison = []
+    for name in set(current) | set(previous):
+        now = current.get(name, {})
+        before = previous.get(name, {})
+        comparison.append({
+            'formula': name,
+            'duration': now.get('duration', 0.0),
+            'states': now.get('states', 0),
+            'previous_duration': before.get('duration', 0.0),
+            'previous_states': before.get('states', 0),
+            'delta': round(now.get('duration', 0.0) -
+                           before.get('duration', 0.0), 3),
+        })
+    comparison.sort(key=lambda x: x['delta'], reverse=True)
+    return comparison
+
+
+def report_salt_profile(summary, profilefile, baselinefile=None):
+    """
+    Writes the profile of a salt state run and prints the formulas that took
+    the most time, along with the change from a baseline profile. Profiling
+    is informational, so errors are printed rather than raised.
+    :param summary: dict, summary from `summarize_salt_results`
+    :param profilefile: str, path to the profile file
+    :param baselinefile: str, path to the profile to compare against.
+                         defaults to the previous profile, if there is one.
+    :return: None
+    """
+    try:
+        profile = write_salt_profile(summary, profilefile)
+    except Exception as exc:
+        print('WARNING: Could not write the salt profile, {0}: {1}'
+              .format(profilefile, exc))
+        return
+    print('Salt state profile by formula, saved to {0}:'.format(profilefile))
+    for formula in profile['formulas']:
+        print('    {0:>10.0f} ms  {1:>5.1%}  {2:>5} states  {3}'
+              .format(formula['duration'], formula['share'],
+                      formula['states'], formula['formula']))
+
+    baselinefile = baselinefile or '{0}.prev'.format(profilefile)
+    if not os.path.exists(baselinefile):
+        return
+    try:
+        with open(baselinefile) as f:
+            baseline = json.load(f)
+        comparison = compare_salt_profiles(profile, baseline)
+    except Exception as exc:
+        print('WARNING: Could not compare to the salt profile, {0}: {1}'
+              .format(baselinefile, exc))
+        return
+    print('Change in salt state time since {0} ({1}):'
+          .format(baselinefile, baseline.get('created')))
+    print('    {0:>+10.0f} ms  total'
+          .format(profile['duration'] - baseline.get('duration', 0.0)))
+    for formula in comparison:
+        print('    {0:>+10.0f} ms  {1}'.format(formula['delta'],
+                                               formula['formula']))
+
+
+def install_salt(saltinstallmethod,
+                 saltversion,
+                 saltbootstrapsource,
+                 saltgitrepo,
+                 saltcall,
+                 yum_pkgs,
+                 yumrepostatus,
+                 workingdir):
+    """
+    Installs salt via yum or git, unless a matching salt is already installed.
+    Runs in the background while the salt content and formulas download. See
+    `start_background`.
+    :param saltinstallmethod: str, 'yum' or 'git'. see `main`.
+    :param saltversion: str, version of salt to install, or None
+    :param saltbootstrapsource: str, location of the salt bootstrap installer
+    :param saltgitrepo: str, git repo containing the salt source files
+    :param saltcall: str, path to salt-call
+    :param yum_pkgs: list, packages to install via yum
+    :param yumrepostatus: str, path to the status file of the yum repo script
+    :param workingdir: str, directory for temporary files
+    :return: None
+    """
+    if 'yum' == saltinstallmethod.lower():
+        # Install salt-minion and dependencies for selinux python modules,
+        # unless a matching salt-minion and the dependencies are present
+        packages = list(yum_pkgs)
+        installed = yum_packages_installed(packages, saltversion)
+        if installed:
+            print('salt-minion {0} and its dependencies are already '
+                  'installed. Skipping the yum install.'
+                  .format(installed['salt-minion']))
+            install_result = 0
+        else:
+            if saltversion:
+                # A requested version matches any release of it, as in
+                # `salt_version_matches`, so salt-minion and salt are pinned
+                # to the version with a wildcard
+                version = saltversion.lstrip('v')
+                yum_pkgs = ['salt-minion-{0}*'.format(version)
+                            if 'salt-minion' == pkg else pkg
+                            for pkg in yum_pkgs]
+                yum_pkgs.append('salt-{0}*'.format(version))
+            yum_args = ' '.join(pipes.quote(pkg) for pkg in yum_pkgs)
+            # Cached yum metadata is stale when the repo files changed
+            repostatus = read_yum_repo_status(yumrepostatus)
+            reposchanged = repostatus is not None and \
+                bool(repostatus.get('changed'))
+            with timed_phase('yum_install', packages=yum_pkgs) as phase:
+                # Otherwise try the cached yum metadata first, and only
+                # refresh the metadata if the packages are not in it
+                phase['cacheonly'] = not reposchanged
+                install_result = None
+                if reposchanged:
+                    print('The yum repo files changed. Refreshing the '
+                          'yum metadata.')
+                    os.system('yum clean expire-cache')
+                else:
+                    install_result = os.system(
+                        'yum -C -y install {0}'.format(yum_args))
+                    if install_result == 0 and \
+                            not yum_packages_installed(packages, saltversion):
+                        print('The cached yum metadata is missing the salt '
+                              'packages. Refreshing the yum metadata.')
+                        install_result = None
+                if install_result != 0:
+                    phase['cacheonly'] = False
+                    install_result = os.system(
+                        'yum -y install {0}'.format(yum_args))
+                phase['returncode'] = install_result
+            print('Return code of yum install: {0}'.format(install_result))
+            if install_result != 0:
+                raise SystemError('Could not install the salt packages with '
+                                  'yum. Return code: {0}\n'
+                                  'packages = {1}'
+                                  .format(install_result, yum_args))
+            if not yum_packages_installed(packages, saltversion):
+                raise SystemError('yum did not install the salt packages. '
+                                  'Check the yum repos for them.\n'
+                                  'packages = {0}'.format(yum_args))
+    elif 'git' == saltinstallmethod.lower():
+        # Check required params for the `git` install method
+        if not saltbootstrapsource:
+            error_message = 'Detected `git` as the install method, but ' \
+                            'the required parameter ' \
+                            '`saltbootstrapsource` was not provided.'
+            raise SystemError(error_message)
+        if not saltgitrepo:
+            error_message = 'Detected `git` as the install method, but ' \
+                            'the required parameter `saltgitrepo` was ' \
+                            'not provided.'
+            raise SystemError(error_message)
+        # Skip the bootstrap if a matching salt is already installed
+        installedversion = get_salt_call_version(saltcall)
+        if salt_version_matches(installedversion, saltversion):
+            print('salt {0} is already installed. Skipping the salt '
+                  'bootstrap.'.format(installedversion))
+        else:
+            # Download the salt bootstrap installer and install salt
+            saltbootstrapfilename = saltbootstrapsource.split('/')[-1]
+            saltbootstrapfile = '/'.join((workingdir,
+                                          saltbootstrapfilename))
+            download_file(saltbootstrapsource, saltbootstrapfile)
+            with timed_phase('salt_bootstrap',
+                             version=saltversion) as phase:
+                if saltversion:
+                    phase['returncode'] = os.system(
+                        'sh {0} -g {1} git {2}'.format(saltbootstrapfile,
+                                                       saltgitrepo,
+                                                       saltversion))
+                else:
+                    phase['returncode'] = os.system(
+                        'sh {0} -g {1}'.format(saltbootstrapfile,
+                                               saltgitrepo))
+    else:
+        raise SystemError('Unrecognized `saltinstallmethod`! Must set '
+                          '`saltinstallmethod` to either "git" or "yum".')
+
+
+# Re-raises an exception from `sys.exc_info()` with its traceback. The
+# Python 2 form of `raise` is a syntax error on Python 3, so it is compiled
+# with exec, as in six.
+if sys.version_info[0] < 3:
+    exec('def _reraise(tp, value, tb):\n'
+         '    raise tp, value, tb\n')
+else:
+    def _reraise(tp, value, tb):
+        raise value.with_traceback(tb)
+
+
+def start_background(name, func, *args, **kwargs):
+    """
+    Starts `func` in a thread, to run alongside the caller.
+    :param name: str, name of the thread
+    :return: function that waits for `func` to finish, i.e. a barrier, and
+             returns its result or raises its exception
+    """
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = func(*args, **kwargs)
+        except BaseException:
+            outcome['error'] = sys.exc_info()
+
+    thread = threading.Thread(target=run, name=name)
+    thread.daemon = True
+    thread.start()
+
+    def wait():
+        thread.join()
+        if 'error' in outcome:
+            _reraise(*outcome['error'])
+        return outcome.get('result')
+    return wait
+
+
 def cleanup(workingdir):
     """
     Removes temporary files loaded to the system.
@@ -183,6 +2679,26 @@ def main(saltinstallmethod='git',
          admingroups=None,
          adminusers=None,
          sourceiss3bucket='false',
+         prefetchindex=None,
+         cachedir='/var/cache/systemprep',
+         cachemaxsize=None,
+         cacheoffline='false',
+         streamcontent='false',
+         pipelineinstall='true',
+         phaselog=None,
+         extractworkers='4',
+         extractinclude=None,
+         extractexclude=None,
+         saltprofile=None,
+         saltprofilebaseline=None,
+         provisionphase='full',
+         yumrepostatus='/var/run/systemprep-yumrepos.json',
+         hostfactsfile=None,
+         installrecordfile='/etc/salt/systemprep.install.json',
+         mirrorurl=None,
+         downloadconnections=None,
+         downloadhostlimit=None,
+         downloadbandwidth=None,
          **kwargs):
     """
     Manages the salt installation and configuration.
@@ -201,7 +2717,10 @@ def main(saltinstallmethod='git',
                         Example: "git://github.com/saltstack/salt.git"
     :param saltversion: str, optional. version of salt to install. if
                         `installmethod` is 'git', then this value must be a
-                        tag or branch in the git repo.
+                        tag or branch in the git repo. if `installmethod` is
+                        'yum', then the `salt-minion` package is pinned to
+                        this version. the install is skipped when a matching
+                        salt is already installed.
     :param saltcontentsource: str, location of additional salt content, must
                               be a compressed file
     :param formulastoinclude: list, locations of salt formulas to configure,
@@ -218,6 +2737,74 @@ def main(saltinstallmethod='git',
                            salt-call state run
     :param sourceiss3bucket: str, set to 'true' if saltcontentsource and
                              formulastoinclude are hosted in an S3 bucket.
+    :param prefetchindex: str, path to an index of artifacts already
+                          downloaded by the master script. prefetched
+                          artifacts are not downloaded again.
+    :param cachedir: str, directory of the local artifact cache shared by the
+                     systemprep scripts. 'none' disables the cache.
+    :param cachemaxsize: str, maximum size of the artifact cache in MB.
+    :param cacheoffline: str, set to 'true' to serve all downloads from the
+                         artifact cache only.
+    :param streamcontent: str, set to 'true' to extract saltcontentsource and
+                          formulastoinclude while they download, instead of
+                          saving the archives to disk first. prefetched
+                          archives are still extracted from disk.
+    :param pipelineinstall: str, set to 'false' to install salt before
+                            downloading the salt content and formulas,
+                            rather than alongside them.
+    :param phaselog: str, path to the file in which to record the timing of
+                     each phase. set by the master script, which collects
+                     the timings into its run report.
+    :param extractworkers: str, the maximum number of formulas to download
+                           and extract at the same time.
+    :param extractinclude: str, comma-separated patterns of the members of
+                           saltcontentsource and formulastoinclude to
+                           extract, e.g. '*.sls,*.jinja,_modules/,files/'.
+                           a pattern ending in '/' matches the members
+                           under a directory of that name. all members are
+                           extracted if not set.
+    :param extractexclude: str, comma-separated patterns of the members to
+                           skip, e.g. 'docs/,test/,*.md'.
+    :param saltprofile: str, path to the file to save the profile of the
+                        salt-call state run, ranking the formulas by the time
+                        spent in their states. defaults to
+                        `<salt_results_log>.profile.json`. the previous
+                        profile is kept as `<saltprofile>.prev`.
+    :param saltprofilebaseline: str, path to a profile to compare the state
+                                run against. defaults to the previous
+                                profile, if there is one.
+    :param provisionphase: str, the part of the provisioning to perform
+                           'full': install salt and the salt content, set the
+                                   grains, and apply the states
+                           'prebake': install salt and the salt content only.
+                                      use when building an image, and run
+                                      `finalize` on each instance.
+                           'finalize': set the grains and apply the states,
+                                       using the salt install and content of
+                                       a `prebake` run. falls back to `full`
+                                       if the system was not prebaked with
+                                       the same settings.
+    :param yumrepostatus: str, path to the status file written by the yum
+                          repo install script. when the repo files changed,
+                          the yum metadata is refreshed before the install.
+                          otherwise the cached metadata is tried first.
+    :param hostfactsfile: str, path to the host facts detected by the master
+                          script. the facts are set as the `systemprep:host`
+                          grain.
+    :param installrecordfile: str, path to the record of the salt install
+                              settings, written by the 'full' and 'prebake'
+                              phases and checked by the 'finalize' phase.
+                              set by the master script.
+    :param mirrorurl: str, base url of a content mirror, such as
+                      Utils/systemprep-mirror.py. salt content and formulas
+                      are downloaded from the mirror, and from their source
+                      if the mirror fails. 'none' disables the mirror.
+    :param downloadconnections: str, the maximum number of download requests
+                                open at once. defaults to 8.
+    :param downloadhostlimit: str, the maximum number of download requests
+                              open to one host. defaults to 4.
+    :param downloadbandwidth: str, the total download rate in MB per second.
+                              not limited by default.
     :param entenv: str, controls whether to set a custom grain in salt that
                    identifies the enterprise environment.
                    'false' does not set the custom grain
@@ -254,11 +2841,33 @@ def main(saltinstallmethod='git',
     formulastoinclude = [] if formulastoinclude is None else formulastoinclude
     formulaterminationstrings = [] if formulaterminationstrings is None else \
         formulaterminationstrings
+    # The master runs this script in-process with the parameters it was
+    # given, so lists set on its command line arrive as strings
+    if isinstance(formulastoinclude, basestring):
+        formulastoinclude = filter(None, (
+            x.strip() for x in
+            formulastoinclude.translate(None, '()[]').split(',')))
+    if isinstance(formulaterminationstrings, basestring):
+        formulaterminationstrings = filter(None, (
+            x.strip() for x in
+            formulaterminationstrings.translate(None, '()[]').split(',')))
     # Convert from string to bool
     sourceiss3bucket = 'true' == sourceiss3bucket.lower()
+    streamcontent = 'true' == streamcontent.lower()
+    pipelineinstall = 'true' == pipelineinstall.lower()
+    provisionphase = provisionphase.lower()
+    if provisionphase not in ('full', 'prebake', 'finalize'):
+        raise SystemError('Unrecognized `provisionphase`! Must set '
+                          '`provisionphase` to "full", "prebake", or '
+                          '"finalize".')
     # Handle entenv tri-state
     entenv = True if 'true' == entenv.lower() else False if 'false' == \
         entenv.lower() else entenv.lower()
+    # Convert the extraction patterns to lists
+    extractinclude = filter(None, extractinclude.split(',')) \
+        if extractinclude else []
+    extractexclude = filter(None, extractexclude.split(',')) \
+        if extractexclude else []
     # Convert admingroups and adminusers to lists
     admingroups = admingroups.split(':') if admingroups else None
     adminusers = adminusers.split(':') if adminusers else None
@@ -278,6 +2887,26 @@ def main(saltinstallmethod='git',
     print('    salt_results_log = {0}'.format(salt_results_log))
     print('    salt_debug_log = {0}'.format(salt_debug_log))
     print('    sourceiss3bucket = {0}'.format(sourceiss3bucket))
+    print('    prefetchindex = {0}'.format(prefetchindex))
+    print('    cachedir = {0}'.format(cachedir))
+    print('    cachemaxsize = {0}'.format(cachemaxsize))
+    print('    cacheoffline = {0}'.format(cacheoffline))
+    print('    streamcontent = {0}'.format(streamcontent))
+    print('    pipelineinstall = {0}'.format(pipelineinstall))
+    print('    phaselog = {0}'.format(phaselog))
+    print('    extractworkers = {0}'.format(extractworkers))
+    print('    extractinclude = {0}'.format(extractinclude))
+    print('    extractexclude = {0}'.format(extractexclude))
+    print('    saltprofile = {0}'.format(saltprofile))
+    print('    saltprofilebaseline = {0}'.format(saltprofilebaseline))
+    print('    provisionphase = {0}'.format(provisionphase))
+    print('    yumrepostatus = {0}'.format(yumrepostatus))
+    print('    hostfactsfile = {0}'.format(hostfactsfile))
+    print('    installrecordfile = {0}'.format(installrecordfile))
+    print('    mirrorurl = {0}'.format(mirrorurl))
+    print('    downloadconnections = {0}'.format(downloadconnections))
+    print('    downloadhostlimit = {0}'.format(downloadhostlimit))
+    print('    downloadbandwidth = {0}'.format(downloadbandwidth))
     print('    entenv = {0}'.format(entenv))
     print('    oupath = {0}'.format(oupath))
     print('    computername = {0}'.format(computername))
@@ -298,224 +2927,259 @@ def main(saltinstallmethod='git',
     saltformularoot = os.sep.join((saltsrv, 'formulas'))
     saltpillarroot = os.sep.join((saltsrv, 'pillar'))
     saltbaseenv = os.sep.join((saltfileroot, 'base'))
-    workingdir = create_working_dir('/usr/tmp/', 'saltinstall-')
+    configure_phase_log(phaselog)
+    configure_cache(cachedir, cachemaxsize, cacheoffline)
+    configure_mirror(mirrorurl)
+    configure_downloads(downloadconnections, downloadhostlimit,
+                        downloadbandwidth)
+    # Streaming needs the source, so it does not apply to an offline cache
+    streamcontent = streamcontent and not _cache['offline']
+    with timed_phase('create_working_dir'):
+        workingdir = create_working_dir('/usr/tmp/', 'saltinstall-')
+    prefetched = get_prefetched_files(prefetchindex)
     salt_results_logfile = salt_results_log or os.sep.join((
         workingdir,
         'saltcall.results.log'))
     salt_debug_logfile = salt_debug_log or os.sep.join((
         workingdir,
         'saltcall.debug.log'))
-    saltcall_arguments = '--out yaml --out-file {0} --return local ' \
+    salt_profilefile = saltprofile or '{0}.profile.json'.format(
+        salt_results_logfile)
+    saltcall_arguments = '--out json --out-file {0} --return local ' \
                          '--log-file {1} --log-file-level debug' \
                          .format(salt_results_logfile, salt_debug_logfile)
 
-    # Install salt via yum or git
-    if 'yum' == saltinstallmethod.lower():
-        # Install salt-minion and dependencies for selinux python modules
-        # TODO: Install salt version specified by `saltversion`
-        install_result = os.system(
-            'yum -y install {0}'.format(' '.join(yum_pkgs)))
-        print('Return code of yum install: {0}'.format(install_result))
-    elif 'git' == saltinstallmethod.lower():
-        # Check required params for the `git` install method
-        if not saltbootstrapsource:
-            error_message = 'Detected `git` as the install method, but the ' \
-                            'required parameter `saltbootstrapsource` was ' \
-                            'not provided.'
-            raise SystemError(error_message)
-        if not saltgitrepo:
-            error_message = 'Detected `git` as the install method, but the ' \
-                            'required parameter `saltgitrepo` was not ' \
-                            'provided.'
-            raise SystemError(error_message)
-        # Download the salt bootstrap installer and install salt
-        saltbootstrapfilename = saltbootstrapsource.split('/')[-1]
-        saltbootstrapfile = '/'.join((workingdir, saltbootstrapfilename))
-        download_file(saltbootstrapsource, saltbootstrapfile)
-        if saltversion:
-            os.system('sh {0} -g {1} git {2}'.format(saltbootstrapfile,
-                                                     saltgitrepo, saltversion))
+    # A finalize run reuses the salt install and content of a prebake run,
+    # so check the system was prebaked with the same settings
+    installrecord = {
+        'saltinstallmethod': saltinstallmethod.lower(),
+        'saltversion': saltversion,
+        'saltcontentsource': saltcontentsource,
+        'formulastoinclude': formulastoinclude,
+        'formulaterminationstrings': formulaterminationstrings,
+    }
+    if 'finalize' == provisionphase:
+        previousrecord = read_install_record(installrecordfile)
+        if previousrecord is None:
+            print('WARNING: No install record found at {0}. Running the '
+                  'full provisioning instead.'.format(installrecordfile))
+            provisionphase = 'full'
+        elif dict((k, previousrecord.get(k)) for k in installrecord) != \
+                installrecord:
+            print('WARNING: The system was prebaked with different install '
+                  'settings, {0}. Running the full provisioning instead.'
+                  .format(previousrecord))
+            provisionphase = 'full'
         else:
-            os.system('sh {0} -g {1}'.format(saltbootstrapfile, saltgitrepo))
-    else:
-        raise SystemError('Unrecognized `saltinstallmethod`! Must set '
-                          '`saltinstallmethod` to either "git" or "yum".')
+            print('Using the salt install and content prebaked on {0}.'
+                  .format(previousrecord.get('created')))
+
+    if 'finalize' != provisionphase:
+        # Install salt via yum or git, alongside the downloads of the salt
+        # content and formulas. Steps that need salt wait for it below.
+        waitforsalt = start_background(
+            'install_salt', install_salt,
+            saltinstallmethod=saltinstallmethod,
+            saltversion=saltversion,
+            saltbootstrapsource=saltbootstrapsource,
+            saltgitrepo=saltgitrepo,
+            saltcall=saltcall,
+            yum_pkgs=yum_pkgs,
+            yumrepostatus=yumrepostatus,
+            workingdir=workingdir)
+        if not pipelineinstall:
+            waitforsalt()
 
-    # Create directories for salt content and formulas
-    for saltdir in [saltfileroot, saltbaseenv, saltformularoot]:
         try:
-            os.makedirs(saltdir)
-        except OSError:
-            if not os.path.isdir(saltdir):
-                raise
+            # Create directories for salt content and formulas
+            for saltdir in [saltfileroot, saltbaseenv, saltformularoot]:
+                try:
+                    os.makedirs(saltdir)
+                except OSError:
+                    if not os.path.isdir(saltdir):
+                        raise
 
-    # Download and extract the salt content specified by saltcontentsource
-    if saltcontentsource:
-        saltcontentfilename = saltcontentsource.split('/')[-1]
-        saltcontentfile = os.sep.join((workingdir, saltcontentfilename))
-        download_file(saltcontentsource, saltcontentfile, sourceiss3bucket)
-        extract_contents(filepath=saltcontentfile,
-                         to_directory=saltsrv)
-
-    # Download and extract any salt formulas specified in formulastoinclude
-    saltformulaconf = []
-    for formulasource in formulastoinclude:
-        formulafilename = formulasource.split('/')[-1]
-        formulafile = os.sep.join((workingdir, formulafilename))
-        download_file(formulasource, formulafile)
-        extract_contents(filepath=formulafile,
-                         to_directory=saltformularoot)
-        formulafilebase = '.'.join(formulafilename.split('.')[:-1])
-        formuladir = os.sep.join((saltformularoot, formulafilebase))
-        for string in formulaterminationstrings:
-            if formulafilebase.endswith(string):
-                newformuladir = formuladir[:-len(string)]
-                if os.path.exists(newformuladir):
-                    shutil.rmtree(newformuladir)
-                shutil.move(formuladir, newformuladir)
-                formuladir = newformuladir
-        saltformulaconf += '    - {0}\n'.format(formuladir),
-
-    # Create a list that contains the new file_roots configuration
-    saltfilerootconf = []
-    saltfilerootconf += 'file_roots:\n',
-    saltfilerootconf += '  base:\n',
-    saltfilerootconf += '    - {0}\n'.format(saltbaseenv),
-    saltfilerootconf += saltformulaconf
-    saltfilerootconf += '\n',
-
-    # Create a list that contains the new pillar_roots configuration
-    saltpillarrootconf = []
-    saltpillarrootconf += 'pillar_roots:\n',
-    saltpillarrootconf += '  base:\n',
-    saltpillarrootconf += '    - {0}\n\n'.format(saltpillarroot),
-
-    # Backup the minionconf file
-    shutil.copyfile(minionconf, '{0}.bak'.format(minionconf))
-
-    # Read the minionconf file into a list
-    with open(minionconf, 'r') as f:
-        minionconflines = f.readlines()
-
-    # Find the file_roots section in the minion conf file
-    filerootsbegin = '^#file_roots:|^file_roots:'
-    filerootsend = '#$|^$'
-    beginindex = None
-    endindex = None
-    n = 0
-    for line in minionconflines:
-        if re.match(filerootsbegin, line):
-            beginindex = n
-        if beginindex and not endindex and re.match(filerootsend, line):
-            endindex = n
-        n += 1
-
-    # Update the file_roots section with the new configuration
-    minionconflines = minionconflines[0:beginindex] + \
-        saltfilerootconf + minionconflines[endindex + 1:]
-
-    # Find the pillar_roots section in the minion conf file
-    pillarrootsbegin = '^#pillar_roots:|^pillar_roots:'
-    pillarrootsend = '^#$|^$'
-    beginindex = None
-    endindex = None
-    n = 0
-    for line in minionconflines:
-        if re.match(pillarrootsbegin, line):
-            beginindex = n
-        if beginindex and not endindex and re.match(pillarrootsend, line):
-            endindex = n
-        n += 1
-
-    # Update the pillar_roots section with the new configuration
-    minionconflines = minionconflines[0:beginindex] + \
-        saltpillarrootconf + minionconflines[endindex + 1:]
-
-    # Write the new configuration to minionconf
-    try:
-        with open(minionconf, 'w') as f:
-            f.writelines(minionconflines)
-    except Exception as exc:
-        raise SystemError('Could not write to minion conf file: {0}\n'
-                          'Exception: {1}'.format(minionconf, exc))
-    else:
-        print('Saved the new minion configuration successfully.')
-
-    # Write custom grains
-    if entenv is True:
-        # TODO: Get environment from EC2 metadata or tags
-        entenv = entenv
-    print('Setting grain `systemprep`...')
-    grain = {"enterprise_environment": '{0}'.format(entenv)}
-    systemprepgrainresult = os.system(
-        '{0} --local grains.setval systemprep "{1}"'
-        .format(saltcall, grain))
-    if oupath or admingroups or adminusers:
-        print('Setting grain `join-domain`...')
-        grain = {}
-        if oupath:
-            grain['oupath'] = '{0}'.format(oupath)
-        if admingroups:
-            grain['admin_groups'] = admingroups
-        if adminusers:
-            grain['admin_users'] = adminusers
-        joindomaingrainresult = os.system(
-            '{0} --local grains.setval "join-domain" "{1}"'
-            .format(saltcall, grain))
-    if computername:
-        print('Setting grain `name-computer`...')
-        grain = {'computername': '{0}'.format(computername)}
-        namecomputergrainresult = os.system(
-            '{0} --local grains.setval "name-computer" "{1}"'
-            .format(saltcall, grain))
-
-    # Sync custom modules
-    print('Syncing custom salt modules...')
-    systemprepsyncresult = os.system(
-        '{0} --local saltutil.sync_all'.format(saltcall))
-
-    # Check whether we need to run salt-call
-    if 'none' == saltstates.lower():
-        print('No States were specified. Will not apply any salt states.')
+            # Download and extract the salt content specified by
+            # saltcontentsource
+            if saltcontentsource:
+                if streamcontent and saltcontentsource not in prefetched:
+                    stream_extract_contents(url=saltcontentsource,
+                                            to_directory=saltsrv,
+                                            sourceiss3bucket=sourceiss3bucket,
+                                            spooldir=workingdir,
+                                            include=extractinclude,
+                                            exclude=extractexclude)
+                else:
+                    saltcontentfile = get_content_file(saltcontentsource,
+                                                       workingdir, prefetched,
+                                                       sourceiss3bucket)
+                    extract_contents(filepath=saltcontentfile,
+                                     to_directory=saltsrv,
+                                     include=extractinclude,
+                                     exclude=extractexclude)
+
+            # Download and extract any salt formulas specified in
+            # formulastoinclude. Unchanged formulas are skipped, according
+            # to the formula manifest
+            formulamanifest = read_formula_manifest(saltformularoot)
+            formuladirs = install_formulas(
+                formulastoinclude=formulastoinclude,
+                saltformularoot=saltformularoot,
+                formulaterminationstrings=formulaterminationstrings,
+                manifest=formulamanifest,
+                workingdir=workingdir,
+                prefetched=prefetched,
+                streamcontent=streamcontent,
+                maxworkers=int(extractworkers),
+                include=extractinclude,
+                exclude=extractexclude)
+            write_formula_manifest(saltformularoot, formulamanifest)
+        except Exception:
+            # Let the salt install finish, rather than leave it running
+            error = sys.exc_info()
+            try:
+                waitforsalt()
+            except Exception as exc:
+                print('WARNING: The salt install failed, too -- {0}'
+                      .format(exc))
+            _reraise(*error)
+        with timed_phase('wait_salt_install'):
+            waitforsalt()
+
+        # Update the file_roots and pillar_roots sections of the minion conf
+        minionsettings = {
+            'file_roots': {
+                'base': [saltbaseenv] + formuladirs,
+            },
+            'pillar_roots': {
+                'base': [saltpillarroot],
+            },
+        }
+        with timed_phase('minion_conf', path=minionconf) as phase:
+            try:
+                phase['changed'] = update_config_file(minionconf,
+                                                      minionsettings)
+            except Exception as exc:
+                raise SystemError('Could not write to minion conf file: {0}\n'
+                                  'Exception: {1}'.format(minionconf, exc))
+            if phase['changed']:
+                print('Saved the new minion configuration successfully.')
+            else:
+                print('Minion configuration is already up to date.')
+
+        installrecord['created'] = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                                 time.gmtime())
+        write_install_record(installrecordfile, installrecord)
+
+    if 'prebake' == provisionphase:
+        print('Detected the `prebake` provisionphase. Grains and states will '
+              'be applied by the `finalize` provisionphase.')
     else:
-        # Apply the requested salt state(s)
-        result = None
-        if 'highstate' == saltstates.lower():
-            print('Detected the States parameter is set to `highstate`. '
-                  'Applying the salt `"highstate`" to the system.')
-            result = os.system('{0} --local state.highstate {1}'
-                               .format(saltcall, saltcall_arguments))
-        else:
-            print('Detected the States parameter is set to: {0}. '
-                  'Applying the user-defined list of states to the system.'
-                  .format(saltstates))
-            result = os.system(
-                '{0} --local state.sls {1} {2}'
-                .format(saltcall, saltstates, saltcall_arguments)
-            )
+        # Write custom grains
+        if entenv is True:
+            # TODO: Get environment from EC2 metadata or tags
+            entenv = entenv
+        # Collect the custom grains, so they are all set with one salt-call
+        grains = {
+            'systemprep': {
+                'enterprise_environment': '{0}'.format(entenv),
+            },
+        }
+        hostfacts = read_host_facts(hostfactsfile)
+        if hostfacts:
+            grains['systemprep']['host'] = hostfacts
+        if oupath or admingroups or adminusers:
+            grain = {}
+            if oupath:
+                grain['oupath'] = '{0}'.format(oupath)
+            if admingroups:
+                grain['admin_groups'] = admingroups
+            if adminusers:
+                grain['admin_users'] = adminusers
+            grains['join-domain'] = grain
+        if computername:
+            grains['name-computer'] = {
+                'computername': '{0}'.format(computername),
+            }
+        print('Setting grains `{0}`...'.format('`, `'.join(sorted(grains))))
+        with timed_phase('grains.setvals', grains=sorted(grains)) as phase:
+            # salt parses the argument as YAML, so pass the grains as JSON
+            grainsresult = os.system(
+                '{0} --local grains.setvals {1}'
+                .format(saltcall, pipes.quote(json.dumps(grains))))
+            phase['returncode'] = grainsresult
 
-        print('Return code of salt-call: {0}'.format(result))
+        # Sync custom modules. Custom grains and modules are used while the
+        # states render, so they are synced before any state run, too.
+        print('Syncing custom salt modules...')
+        with timed_phase('saltutil.sync_all') as phase:
+            systemprepsyncresult = os.system(
+                '{0} --local saltutil.sync_all'.format(saltcall))
+            phase['returncode'] = systemprepsyncresult
 
-        # Check for errors in the salt state execution
-        try:
-            with open(salt_results_logfile, 'rb') as f:
-                salt_results = f.read()
-        except Exception as exc:
-            error_message = 'Could open the salt results log file: {0}\n' \
-                            'Exception: {1}' \
-                            .format(salt_results_logfile, exc)
-            raise SystemError(error_message)
-        if (not re.search('result: false', salt_results)) and \
-           (re.search('result: true', salt_results)):
-            # At least one state succeeded, and no states failed, log success
-            print('Salt states applied successfully! Details are in the log, '
-                  '{0}'.format(salt_results_logfile))
+        # Check whether we need to run salt-call
+        if 'none' == saltstates.lower():
+            print('No States were specified. Will not apply any salt states.')
         else:
-            error_message = 'ERROR: There was a problem running the salt ' \
-                            'states! Check for errors and failed states in ' \
-                            'the log file: {0}' \
-                            .format(salt_results_logfile)
-            raise SystemError(error_message)
+            # Apply the requested salt state(s). salt-call appends to the
+            # results file, so empty it to summarize only this run
+            open(salt_results_logfile, 'w').close()
+            result = None
+            if 'highstate' == saltstates.lower():
+                print('Detected the States parameter is set to `highstate`. '
+                      'Applying the salt `"highstate`" to the system.')
+                with timed_phase('state.highstate') as phase:
+                    result = os.system('{0} --local state.highstate {1}'
+                                       .format(saltcall, saltcall_arguments))
+                    phase['returncode'] = result
+            else:
+                print('Detected the States parameter is set to: {0}. '
+                      'Applying the user-defined list of states to the system.'
+                      .format(saltstates))
+                with timed_phase('state.sls', states=saltstates) as phase:
+                    result = os.system(
+                        '{0} --local state.sls {1} {2}'
+                        .format(saltcall, saltstates, saltcall_arguments)
+                    )
+                    phase['returncode'] = result
+
+            print('Return code of salt-call: {0}'.format(result))
+
+            # Check for errors in the salt state execution
+            try:
+                with timed_phase('salt_results') as phase:
+                    summary = summarize_salt_results(salt_results_logfile)
+                    phase.update((k, summary[k]) for k in (
+                        'succeeded', 'failed', 'unknown', 'changed'))
+            except Exception as exc:
+                error_message = 'Could not read the salt results log ' \
+                                'file: {0}\nException: {1}' \
+                                .format(salt_results_logfile, exc)
+                raise SystemError(error_message)
+            print('Salt states: {0} succeeded, {1} failed, {2} unknown, '
+                  '{3} changed, {4:.0f} ms in total'
+                  .format(summary['succeeded'], summary['failed'],
+                          summary['unknown'], summary['changed'],
+                          summary['duration']))
+            for slow in summary['slowest']:
+                print('    {0:>10.0f} ms  {1}'.format(slow['duration'],
+                                                      slow['state']))
+            report_salt_profile(summary, salt_profilefile, saltprofilebaseline)
+            for error in summary['errors']:
+                print('Error: {0}'.format(error))
+            for stateid in summary['failed_states']:
+                print('Failed state: {0}'.format(stateid))
+            if not summary['failed'] and not summary['errors'] and \
+                    summary['succeeded']:
+                # At least one state succeeded, and no states failed
+                print('Salt states applied successfully! Details are in the '
+                      'log, {0}'.format(salt_results_logfile))
+            else:
+                error_message = 'ERROR: There was a problem running the ' \
+                                'salt states! Check for errors and failed ' \
+                                'states in the log file: {0}' \
+                                .format(salt_results_logfile)
+                raise SystemError(error_message)
 
     # Remove working files
     cleanup(workingdir)
@@ -534,12 +3198,13 @@ if __name__ == "__main__":
     # where the strings may have parentheses or brackets
     # First, remove any parentheses or brackets
     # Then, split the string on the comma to convert to a list,
+    # strip the space the master puts after each comma,
     # and remove empty strings with filter
     if 'formulastoinclude' in kwargs:
         kwargs['formulastoinclude'] = kwargs['formulastoinclude'].translate(None, '()[]')
-        kwargs['formulastoinclude'] = filter(None, kwargs['formulastoinclude'].split(','))
+        kwargs['formulastoinclude'] = filter(None, (x.strip() for x in kwargs['formulastoinclude'].split(',')))
     if 'formulaterminationstrings' in kwargs:
         kwargs['formulaterminationstrings'] = kwargs['formulaterminationstrings'].translate(None, '()[]')
-        kwargs['formulaterminationstrings'] = filter(None, kwargs['formulaterminationstrings'].split(','))
+        kwargs['formulaterminationstrings'] = filter(None, (x.strip() for x in kwargs['formulaterminationstrings'].split(',')))
 
     main(**kwargs)
@@ -1,34 +1,423 @@
 #!/usr/bin/env python
+import contextlib
+import filecmp
+import hashlib
+import json
+import os
 import re
 import shutil
 import sys
+import tempfile
+import threading
+import time
 import urllib2
+import urlparse
 
-from boto.exception import BotoClientError
+from multiprocessing.pool import ThreadPool
+
+
+_phases = {
+    'log': None,
+    'script': os.path.basename(__file__),
+    'lock': threading.Lock(),
+}
+
+
+def configure_phase_log(phaselog):
+    """
+    Configures the file to which `timed_phase` appends its timing records.
+    The master script collects the records from all scripts into its run
+    report.
+    :param phaselog: str, path to the phase log. 'none' or an empty string
+                     disables the phase log.
+    """
+    _phases['log'] = None if not phaselog or 'none' == phaselog.lower() \
+        else phaselog
+
+
+@contextlib.contextmanager
+def timed_phase(name, **details):
+    """
+    Times the enclosed block and appends a record of it to the phase log, as
+    a line of JSON. The block may add details to the record by updating the
+    yielded dictionary. If the details include `bytes`, the throughput is
+    added to the record, too.
+    :param name: str, name of the phase
+    :param details: dict, additional details to record
+    """
+    start = time.time()
+    details['status'] = 'failed'
+    try:
+        yield details
+        details['status'] = 'succeeded'
+    finally:
+        duration = time.time() - start
+        if _phases['log']:
+            details.update(name=name, script=_phases['script'],
+                           start=start, duration=duration)
+            if details.get('bytes') is not None and duration > 0:
+                details['bytes_per_second'] = details['bytes'] / duration
+            try:
+                with _phases['lock']:
+                    with open(_phases['log'], 'a') as f:
+                        f.write(json.dumps(details) + '\n')
+            except Exception as exc:
+                print('WARNING: Could not write to the phase log -- {0}\n'
+                      '    Exception: {1}'.format(_phases['log'], exc))
+
+
+# When the master runs this script in-process, it replaces `_cache` and
+# `_mirror` with its own.
+_cache = {
+    'dir': None,
+    'maxbytes': 512 * 1024 * 1024,
+    'offline': False,
+}
+
+
+def configure_cache(cachedir=None, cachemaxsize=None, cacheoffline=None):
+    """
+    Configures the local artifact cache used by `download_file`. Cached
+    files are stored once per content hash, and each url is indexed to the
+    hash and ETag of the content last downloaded from it.
+    :param cachedir: str, directory in which to store the cache. 'none' or an
+                     empty string disables the cache.
+    :param cachemaxsize: str, maximum size of the cache in MB. the least
+                         recently used files are evicted to stay under it.
+    :param cacheoffline: str, set to 'true' to serve files only from the
+                         cache, without contacting the source.
+    """
+    if cachedir is not None:
+        _cache['dir'] = None if cachedir.lower() in ('', 'none') else cachedir
+    if cachemaxsize is not None:
+        _cache['maxbytes'] = int(cachemaxsize) * 1024 * 1024
+    if cacheoffline is not None:
+        _cache['offline'] = 'true' == str(cacheoffline).lower()
+    if _cache['dir']:
+        for subdir in ('objects', 'index'):
+            path = os.sep.join((_cache['dir'], subdir))
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    print('WARNING: Could not create the cache directory, '
+                          'the cache is disabled -- {0}'.format(path))
+                    _cache['dir'] = None
+                    break
+
+
+def _cache_lookup(url):
+    """
+    Returns the cache entry for `url`, or None if `url` is not cached.
+    :param url: str, location of the file
+    :rtype : dict
+    """
+    indexfile = os.sep.join((
+        _cache['dir'], 'index',
+        hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json'))
+    try:
+        with open(indexfile, 'r') as f:
+            entry = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    entry['object'] = os.sep.join((_cache['dir'], 'objects', entry['sha256']))
+    if not os.path.isfile(entry['object']):
+        return None
+    return entry
+
+
+def _cache_restore(entry, filename):
+    """
+    Copies a cached file to `filename`, and marks it as recently used.
+    :param entry: dict, as returned by `_cache_lookup`
+    :param filename: str, path where the file should be saved
+    :rtype : bool
+    """
+    try:
+        shutil.copyfile(entry['object'], filename)
+        os.utime(entry['object'], None)
+    except (IOError, OSError):
+        # Evicted by another download in the meantime
+        return False
+    print('Restored file from cache -- \n'
+          '    url      = {0}\n'
+          '    filename = {1}'.format(entry['url'], filename))
+    return True
+
+
+def _cache_store(url, filename, etag=None, last_modified=None):
+    """
+    Adds the file `filename`, downloaded from `url`, to the cache. Then evicts
+    the least recently used files until the cache is under its size limit.
+    Errors are reported, but never fail the download.
+    :param url: str, location the file was downloaded from
+    :param filename: str, path to the downloaded file
+    :param etag: str, ETag returned by the source, if any
+    :param last_modified: str, Last-Modified date returned by the source
+    """
+    try:
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        entry = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'sha256': digest.hexdigest(),
+            'size': os.path.getsize(filename),
+        }
+        objectfile = os.sep.join((_cache['dir'], 'objects', entry['sha256']))
+        indexfile = os.sep.join((
+            _cache['dir'], 'index',
+            hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json'))
+        # Write to temp files and rename, so readers never see partial files
+        if os.path.isfile(objectfile):
+            os.utime(objectfile, None)
+        else:
+            fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(objectfile))
+            os.close(fd)
+            shutil.copyfile(filename, tmpfile)
+            os.rename(tmpfile, objectfile)
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(indexfile))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmpfile, indexfile)
+        _cache_evict()
+    except Exception as exc:
+        print('WARNING: Could not add file to the cache.\n'
+              '    url = {0}\n'
+              '    Exception: {1}'.format(url, exc))
+
+
+def _cache_evict():
+    """
+    Removes the least recently used files from the cache until it is under
+    the configured size limit.
+    """
+    objectdir = os.sep.join((_cache['dir'], 'objects'))
+    objects = []
+    for name in os.listdir(objectdir):
+        path = os.sep.join((objectdir, name))
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        objects.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in objects)
+    for _, size, path in sorted(objects):
+        if total <= _cache['maxbytes']:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        print('Evicted file from cache -- {0}'.format(path))
+
+
+_mirror = {
+    'url': None,
+    'available': None,
+    'lock': threading.Lock(),
+}
+
+
+def configure_mirror(mirrorurl=None):
+    """
+    Configures the content mirror used by `download_file`. See
+    Utils/systemprep-mirror.py. Each file is requested from the mirror as
+    `<mirrorurl>/<scheme>/<host>/<path>`, and from its source if the mirror
+    fails.
+    :param mirrorurl: str, base url of the mirror. 'none' or an empty string
+                      disables the mirror.
+    """
+    if mirrorurl is not None:
+        url = None if mirrorurl.lower() in ('', 'none') \
+            else mirrorurl.rstrip('/')
+        with _mirror['lock']:
+            if url != _mirror['url']:
+                _mirror['url'] = url
+                _mirror['available'] = None
+
+
+def _mirror_available(recheck=False):
+    """
+    Returns True if a mirror is configured and answers. The mirror is checked
+    once, with a short timeout, so an unreachable mirror does not cost a
+    timeout for every file. It is checked again if `recheck` is True, after a
+    download from the mirror fails.
+    :rtype : bool
+    """
+    with _mirror['lock']:
+        if _mirror['url'] and (recheck or _mirror['available'] is None):
+            try:
+                urllib2.urlopen(_mirror['url'] + '/', timeout=5).close()
+                _mirror['available'] = True
+            except Exception as exc:
+                print('WARNING: The mirror is not available, files will be '
+                      'downloaded from their source -- {0}\n'
+                      '    Exception: {1}'.format(_mirror['url'], exc))
+                _mirror['available'] = False
+        return bool(_mirror['url'] and _mirror['available'])
+
+
+def get_mirror_url(url):
+    """
+    Returns the location of `url` on the mirror, or None if the mirror cannot
+    serve it.
+    :param url: str, location of the file at its source
+    :rtype : str
+    """
+    parts = urlparse.urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.netloc or \
+            parts.query:
+        return None
+    return '/'.join((_mirror['url'], parts.scheme, parts.netloc,
+                     parts.path.lstrip('/')))
 
 
 def download_file(url, filename):
     """
 Download the file from `url` and save it locally under `filename`.
+Uses the local artifact cache, if one is configured. See `configure_cache`.
+The download is timed and recorded in the phase log. See `timed_phase`.
     :rtype : bool
     :param url:
     :param filename:
     """
+    with timed_phase('download_file', url=url, filename=filename) as phase:
+        phase['source'] = _download_file(url, filename)
+        phase['bytes'] = os.path.getsize(filename)
+    return True
+
+
+def _download_file(url, filename):
+    """
+    Does the work of `download_file`. Files are downloaded from the mirror,
+    if one is configured, and from their source if the mirror fails.
+    :return: str, where the file came from. one of 'cache', 'mirror' or 'web'
+    """
+    entry = _cache_lookup(url) if _cache['dir'] else None
+
+    if _cache['dir'] and _cache['offline']:
+        if entry and _cache_restore(entry, filename):
+            return 'cache'
+        raise SystemError('Unable to find file in the cache, and the cache '
+                          'is offline.\n'
+                          'url = {0}\n'
+                          'filename = {1}'.format(url, filename))
+
+    if _mirror_available() and get_mirror_url(url):
+        try:
+            return _download_from(url, filename, entry, mirror=True)
+        except SystemError as exc:
+            print('WARNING: Could not download file from the mirror, trying '
+                  'its source.\n'
+                  '    Exception: {0}'.format(exc))
+            _mirror_available(recheck=True)
+    return _download_from(url, filename, entry)
+
+
+def _download_from(url, filename, entry, mirror=False):
+    """
+    Downloads `url` to `filename` from the mirror or from a web server.
+    :param entry: dict, the cache entry for `url`, or None
+    :return: str, as returned by `_download_file`
+    """
+    request = urllib2.Request(get_mirror_url(url) if mirror else url)
+    # Revalidate the cached file with a conditional GET
+    if entry and entry.get('etag'):
+        request.add_header('If-None-Match', entry['etag'])
+    if entry and entry.get('last_modified'):
+        request.add_header('If-Modified-Since', entry['last_modified'])
     try:
-        response = urllib2.urlopen(url)
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError as exc:
+            if 304 != exc.code or not _cache_restore(entry, filename):
+                raise
+            return 'cache'
         with open(filename, 'wb') as outfile:
             shutil.copyfileobj(response, outfile)
     except Exception as exc:
         # TODO: Update `except` logic
-        raise SystemError('Unable to download file from web server.\n'
-                          'url = {0}\n'
-                          'filename = {1}\n'
-                          'Exception: {2}'
-                          .format(url, filename, exc))
-    print('Downloaded file from web server -- \n'
-          '    url      = {0}\n'
-          '    filename = {1}'.format(url, filename))
-    return True
+        raise SystemError('Unable to download file from {0}.\n'
+                          'url = {1}\n'
+                          'filename = {2}\n'
+                          'Exception: {3}'
+                          .format('mirror' if mirror else 'web server',
+                                  url, filename, exc))
+    etag = response.info().getheader('ETag')
+    last_modified = response.info().getheader('Last-Modified')
+    print('Downloaded file from {0} -- \n'
+          '    url      = {1}\n'
+          '    filename = {2}'.format('mirror' if mirror else 'web server',
+                                      url, filename))
+    if _cache['dir']:
+        _cache_store(url, filename, etag, last_modified)
+    return 'mirror' if mirror else 'web'
+
+
+def install_yum_repos(urls, repodir='/etc/yum.repos.d', maxworkers=4):
+    """
+    Downloads yum repo definition files to a staging directory in `repodir`,
+    in parallel, and moves each one into `repodir` only if it differs from
+    the installed file. yum only reads the files directly in `repodir`, so it
+    never sees the staging directory. Each replacement is an atomic rename.
+    :param urls: list, urls of the yum repo definition files
+    :param repodir: str, directory of the yum repo definition files
+    :param maxworkers: int, maximum number of files to download at a time
+    :return: dict, lists of the `changed` and `unchanged` repo files
+    :raise SystemError: error raised if two urls have the same file name,
+                        since they would install to the same repo file
+    """
+    status = {'changed': [], 'unchanged': []}
+    if not urls:
+        return status
+    names = [url.split('/')[-1] for url in urls]
+    duplicates = sorted(set(x for x in names if names.count(x) > 1))
+    if duplicates:
+        raise SystemError('Yum repo urls must have unique file names: {0}'
+                          .format(', '.join(duplicates)))
+    staging = tempfile.mkdtemp(prefix='.systemprep-staging-', dir=repodir)
+    try:
+        stagedfiles = [os.sep.join((staging, url.split('/')[-1]))
+                       for url in urls]
+        pool = ThreadPool(min(maxworkers, len(urls)))
+        try:
+            pool.map(lambda x: download_file(*x), zip(urls, stagedfiles))
+        finally:
+            pool.close()
+            pool.join()
+
+        for stagedfile in stagedfiles:
+            repofile = os.sep.join((repodir, os.path.basename(stagedfile)))
+            if os.path.isfile(repofile) and \
+                    filecmp.cmp(stagedfile, repofile, shallow=False):
+                status['unchanged'].append(repofile)
+            else:
+                os.chmod(stagedfile, 0o644)
+                os.rename(stagedfile, repofile)
+                status['changed'].append(repofile)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return status
+
+
+def write_yum_repo_status(statusfile, status):
+    """
+    Saves the result of `install_yum_repos`, so the salt install can tell
+    whether the yum metadata must be refreshed.
+    :param statusfile: str, path to the status file. 'none' disables it.
+    :param status: dict, as returned by `install_yum_repos`
+    """
+    if not statusfile or 'none' == statusfile.lower():
+        return
+    tmpfile = '{0}.tmp'.format(statusfile)
+    with open(tmpfile, 'w') as f:
+        json.dump(dict(status, created=time.time()), f, indent=2)
+    os.rename(tmpfile, statusfile)
 
 
 _supported_dists = ('amazon', 'centos', 'red hat')
@@ -45,7 +434,72 @@ _amazon_epel_versions = {
 }
 
 
+def read_host_facts(hostfactsfile):
+    """
+    Reads the host facts detected by the master script.
+    :param hostfactsfile: str, path to the host facts file
+    :return: dict, the host facts, or None if they are not available
+    """
+    if not hostfactsfile or 'none' == hostfactsfile.lower():
+        return None
+    try:
+        with open(hostfactsfile, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def get_dist_facts():
+    """
+    Detects the linux distribution, its version, and the matching epel
+    version from /etc/system-release.
+    :return: tuple, (dist, version, epel_version)
+    :raise SystemError: error raised if the distribution is not supported
+    """
+    # Read first line from /etc/system-release
+    release = None
+    try:
+        with open(name='/etc/system-release', mode='rb') as f:
+            release = f.readline().strip()
+    except Exception as exc:
+        raise SystemError('Could not read /etc/system-release. '
+                          'Error: {0}'.format(exc))
+
+    # Search the release file for a match against _supported_dists
+    m = _match_supported_dist.search(release.lower())
+    if m is None:
+        # Release not supported, exit with error
+        raise SystemError('Unsupported OS distribution. OS must be one of: '
+                          '{0}.'.format(', '.join(_supported_dists)))
+
+    # Assign dist,version from the match groups tuple, removing any spaces
+    dist,version = (x.translate(None, ' ') for x in m.groups())
+
+    # Determine epel_version
+    epel_version = None
+    if 'amazon' == dist:
+        epel_version = _amazon_epel_versions.get(version, None)
+    else:
+        epel_version = version.split('.')[0]
+
+    if epel_version is None:
+        raise SystemError('Unsupported OS version! dist = {0}, version = {1}.'
+                          .format(dist, version))
+
+    return dist, version, epel_version
+
+
 def main(yumrepomap=None,
+         cachedir='/var/cache/systemprep',
+         cachemaxsize=None,
+         cacheoffline='false',
+         phaselog=None,
+         provisionphase='full',
+         repoworkers='4',
+         yumrepostatus='/var/run/systemprep-yumrepos.json',
+         hostfactsfile=None,
+         installrecordfile=None,
+         mirrorurl=None,
          **kwargs):
     """
     Checks the distribution version and installs yum repo definition files
@@ -67,58 +521,101 @@ def main(yumrepomap=None,
                      'epel_version' : '6' or '7',
                    },
                  ]
+    :param cachedir: str, directory of the local artifact cache shared by the
+                     systemprep scripts. 'none' disables the cache.
+    :param cachemaxsize: str, maximum size of the artifact cache in MB.
+    :param cacheoffline: str, set to 'true' to serve all downloads from the
+                         artifact cache only.
+    :param phaselog: str, path to the file in which to record the timing of
+                     each phase. set by the master script, which collects
+                     the timings into its run report.
+    :param provisionphase: str, the part of the provisioning to perform. the
+                           yum repos are installed by the 'full' and
+                           'prebake' phases, and left as they are by the
+                           'finalize' phase, unless the system was not
+                           prebaked. see `installrecordfile`.
+    :param repoworkers: str, the maximum number of repo files to download at
+                        the same time.
+    :param yumrepostatus: str, path to the file in which to record which repo
+                          files changed. the salt install reads it to decide
+                          whether to refresh the yum metadata. 'none'
+                          disables it.
+    :param hostfactsfile: str, path to the host facts detected by the master
+                          script. the distribution is detected again if the
+                          facts are not available.
+    :param installrecordfile: str, path to the record of the salt install,
+                              written when the system is prebaked. set by
+                              the master script. a 'finalize' run installs
+                              the yum repos if it is not set, or the record
+                              does not exist.
+    :param mirrorurl: str, base url of a content mirror, such as
+                      Utils/systemprep-mirror.py. the repo files are
+                      downloaded from the mirror, and from their source if
+                      the mirror fails. 'none' disables the mirror.
     """
     scriptname = __file__
     print('+' * 80)
     print('Entering script -- {0}'.format(scriptname))
     print('Printing parameters...')
     print('    yumrepomap = {0}'.format(yumrepomap))
+    print('    cachedir = {0}'.format(cachedir))
+    print('    cachemaxsize = {0}'.format(cachemaxsize))
+    print('    cacheoffline = {0}'.format(cacheoffline))
+    print('    phaselog = {0}'.format(phaselog))
+    print('    provisionphase = {0}'.format(provisionphase))
+    print('    repoworkers = {0}'.format(repoworkers))
+    print('    yumrepostatus = {0}'.format(yumrepostatus))
+    print('    hostfactsfile = {0}'.format(hostfactsfile))
+    print('    installrecordfile = {0}'.format(installrecordfile))
+    print('    mirrorurl = {0}'.format(mirrorurl))
+
+    if 'finalize' == provisionphase.lower() and installrecordfile and \
+            os.path.exists(installrecordfile):
+        print('Detected the `finalize` provisionphase. The yum repos were '
+              'installed when the system was prebaked. Nothing to do!')
+        return None
 
     if not yumrepomap:
         print('`yumrepomap` is empty. Nothing to do!')
         return None
 
+    # The master runs this script in-process with the parameters it was
+    # given, so a yumrepomap set on its command line arrives as a string
+    if isinstance(yumrepomap, basestring):
+        yumrepomap = _convert_string_to_list_of_dicts(yumrepomap)
+
     if not isinstance(yumrepomap, list):
         raise SystemError('`yumrepomap` must be a list!')
 
-    # Read first line from /etc/system-release
-    release = None
-    try:
-        with open(name='/etc/system-release', mode='rb') as f:
-            release = f.readline().strip()
-    except Exception as exc:
-        raise SystemError('Could not read /etc/system-release. '
-                          'Error: {0}'.format(exc))
+    configure_phase_log(phaselog)
+    configure_cache(cachedir, cachemaxsize, cacheoffline)
+    configure_mirror(mirrorurl)
 
-    # Search the release file for a match against _supported_dists
-    m = _match_supported_dist.search(release.lower())
-    if m is None:
-        # Release not supported, exit with error
-        raise SystemError('Unsupported OS distribution. OS must be one of: '
-                          '{0}.'.format(', '.join(_supported_dists)))
-
-    # Assign dist,version from the match groups tuple, removing any spaces
-    dist,version = (x.translate(None, ' ') for x in m.groups())
-
-    # Determine epel_version
-    epel_version = None
-    if 'amazon' == dist:
-        epel_version = _amazon_epel_versions.get(version, None)
+    # Use the host facts detected by the master, if they are available
+    facts = read_host_facts(hostfactsfile) or {}
+    if facts.get('dist') and facts.get('epel_version'):
+        dist = facts['dist']
+        epel_version = facts['epel_version']
     else:
-        epel_version = version.split('.')[0]
-
-    if epel_version is None:
-        raise SystemError('Unsupported OS version! dist = {0}, version = {1}.'
-                          .format(dist, version))
+        dist, version, epel_version = get_dist_facts()
 
+    urls = []
     for repo in yumrepomap:
         # Test whether this repo should be installed to this system
         if repo['dist'] in [dist, 'all'] and repo.get('epel_version', 'all') \
                                                 in [epel_version, 'all']:
-            # Download the yum repo definition to /etc/yum.repos.d/
-            url = repo['url']
-            repofile = '/etc/yum.repos.d/{0}'.format(url.split('/')[-1])
-            download_file(url, repofile)
+            if repo['url'] not in urls:
+                urls.append(repo['url'])
+
+    # Download the yum repo definitions to /etc/yum.repos.d/
+    with timed_phase('install_yum_repos', count=len(urls)) as phase:
+        status = install_yum_repos(urls, maxworkers=int(repoworkers))
+        phase['changed'] = len(status['changed'])
+    write_yum_repo_status(yumrepostatus, status)
+    for repofile in status['changed']:
+        print('Installed yum repo file: {0}'.format(repofile))
+    for repofile in status['unchanged']:
+        print('Yum repo file is already up to date: {0}'.format(repofile))
 
     print('{0} complete!'.format(scriptname))
     print('-' * 80)
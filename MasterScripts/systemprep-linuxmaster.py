@@ -1,13 +1,25 @@
 #!/usr/bin/env python
 import os
 import sys
+import json
+import imp
+import time
+import Queue
+import re
+import hashlib
 import platform
+import random
 import tempfile
 import urllib2
+import urlparse
 import shutil
+import threading
+import zipfile
+import contextlib
 import boto
 
-from boto.exception import BotoClientError
+from boto.exception import S3ResponseError
+from multiprocessing.pool import ThreadPool
 
 def merge_dicts(a, b):
     """
@@ -36,6 +48,11 @@ def get_scripts_to_execute(system, workingdir, **scriptparams):
 Returns an array of hashtables. Each hashtable has two keys: 'ScriptUrl' and 'Parameters'.
 'ScriptSource' is the path to the script to be executed. Only supports http/s sources currently.
 'Parameters' is a hashtable of parameters to pass to the script.
+Optionally, a hashtable may also have the keys 'Name' and 'DependsOn'.
+'Name' identifies the script. Defaults to the filename of 'ScriptSource'.
+'DependsOn' is a list of the names of scripts that must complete before this
+script runs. Scripts whose dependencies are complete run in parallel. If
+'DependsOn' is not present, the script depends on all the scripts before it.
 Use `merge_dicts({yourdict}, scriptparams)` to merge command line parameters with a set of default parameters.
     :param system: str, the system type as returned from `platform.system`
     :param workingdir: str, the working directory where content should be saved
@@ -47,6 +64,8 @@ Use `merge_dicts({yourdict}, scriptparams)` to merge command line parameters wit
         scriptstoexecute = (
             {
                 'ScriptSource': "https://systemprep.s3.amazonaws.com/ContentScripts/systemprep-linuxyumrepoinstall.py",
+                'Name': 'yumrepoinstall',
+                'DependsOn': [],
                 'Parameters': merge_dicts({
                     'yumrepomap': [
                         {
@@ -79,6 +98,8 @@ Use `merge_dicts({yourdict}, scriptparams)` to merge command line parameters wit
             },
             {
                 'ScriptSource': "https://systemprep.s3.amazonaws.com/ContentScripts/SystemPrep-LinuxSaltInstall.py",
+                'Name': 'saltinstall',
+                'DependsOn': ['yumrepoinstall'],
                 'Parameters': merge_dicts({
                     'saltinstallmethod': 'yum',
                     'saltcontentsource': "https://systemprep-content.s3.amazonaws.com/linux/salt/salt-content.zip",
@@ -179,40 +200,1191 @@ Returns a dictionary of OS platform-specific parameters.
     return a
 
 
-def download_file(url, filename, sourceiss3bucket=None):
+_supported_dists = ('amazon', 'centos', 'red hat')
+_match_supported_dist = re.compile(r'^({0})'
+                                    '(?:[^0-9]+)'
+                                    '([\d]+[.][\d]+)'
+                                    '(?:.*)'
+                                    .format('|'.join(_supported_dists)))
+_amazon_epel_versions = {
+    '2014.03' : '6',
+    '2014.09' : '6',
+    '2015.03' : '6',
+    '2015.09' : '6',
+}
+_ec2_metadata_url = 'http://169.254.169.254/latest/meta-data/'
+_ec2_metadata_keys = (
+    'instance-id',
+    'instance-type',
+    'ami-id',
+    'placement/availability-zone',
+)
+
+
+def get_ec2_metadata(timeout=1):
+    """
+Returns a dictionary of the EC2 instance metadata used by the content scripts,
+or None if the system is not an EC2 instance. The metadata service is local to
+the instance, so proxies are bypassed and a short timeout is used.
+    :param timeout: float, seconds to wait for each metadata request
+    :rtype : dict
+    """
+    opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+    metadata = {}
+    for key in _ec2_metadata_keys:
+        try:
+            metadata[key] = opener.open(_ec2_metadata_url + key,
+                                        timeout=timeout).read()
+        except Exception:
+            # The first request fails quickly when not on EC2
+            if not metadata:
+                return None
+    return metadata
+
+
+def get_host_facts(system):
+    """
+Returns a dictionary of facts about the host, detected once per run so the
+content scripts do not need to probe the system again. On Linux, this includes
+the distribution, its version and matching epel version, the architecture, and
+the EC2 instance metadata.
+    :param system: str, the system type as returned by `platform.system`
+    :rtype : dict
+    """
+    facts = {
+        'system': system,
+        'arch': platform.machine(),
+        'kernel': platform.release(),
+        'dist': None,
+        'version': None,
+        'epel_version': None,
+    }
+    if 'Linux' in system:
+        try:
+            with open('/etc/system-release', 'rb') as f:
+                release = f.readline().strip()
+        except (IOError, OSError):
+            release = ''
+        m = _match_supported_dist.search(release.lower())
+        if m:
+            dist, version = (x.translate(None, ' ') for x in m.groups())
+            facts['dist'] = dist
+            facts['version'] = version
+            if 'amazon' == dist:
+                facts['epel_version'] = _amazon_epel_versions.get(version)
+            else:
+                facts['epel_version'] = version.split('.')[0]
+    facts['ec2'] = get_ec2_metadata()
+    return facts
+
+
+def load_host_facts(system, hostfactsfile):
+    """
+Returns the host facts saved in `hostfactsfile`, detecting and saving them
+first if the file does not exist. The default file is under /var/run, so the
+facts are detected once per boot.
+    :param system: str, the system type as returned by `platform.system`
+    :param hostfactsfile: str, path to the host facts file
+    :rtype : dict
+    """
+    try:
+        with open(hostfactsfile, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        pass
+    facts = get_host_facts(system)
+    facts['created'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    tmpfile = '{0}.tmp'.format(hostfactsfile)
+    with open(tmpfile, 'w') as f:
+        json.dump(facts, f, indent=2, sort_keys=True)
+    os.rename(tmpfile, hostfactsfile)
+    return facts
+
+
+_phases = {
+    'log': None,
+    'script': os.path.basename(sys.argv[0]),
+    'lock': threading.Lock(),
+}
+
+
+def configure_phase_log(phaselog):
+    """
+    Configures the file to which `timed_phase` appends its timing records.
+    The master script collects the records from all scripts into its run
+    report.
+    :param phaselog: str, path to the phase log. 'none' or an empty string
+                     disables the phase log.
+    """
+    _phases['log'] = None if not phaselog or 'none' == phaselog.lower() \
+        else phaselog
+
+
+@contextlib.contextmanager
+def timed_phase(name, **details):
+    """
+    Times the enclosed block and appends a record of it to the phase log, as
+    a line of JSON. The block may add details to the record by updating the
+    yielded dictionary. If the details include `bytes`, the throughput is
+    added to the record, too.
+    :param name: str, name of the phase
+    :param details: dict, additional details to record
+    """
+    start = time.time()
+    details['status'] = 'failed'
+    try:
+        yield details
+        details['status'] = 'succeeded'
+    finally:
+        duration = time.time() - start
+        if _phases['log']:
+            details.update(name=name, script=_phases['script'],
+                           start=start, duration=duration)
+            if details.get('bytes') is not None and duration > 0:
+                details['bytes_per_second'] = details['bytes'] / duration
+            try:
+                with _phases['lock']:
+                    with open(_phases['log'], 'a') as f:
+                        f.write(json.dumps(details) + '\n')
+            except Exception as exc:
+                print('WARNING: Could not write to the phase log -- {0}\n'
+                      '    Exception: {1}'.format(_phases['log'], exc))
+
+
+_cache = {
+    'dir': None,
+    'maxbytes': 512 * 1024 * 1024,
+    'offline': False,
+}
+
+
+def configure_cache(cachedir=None, cachemaxsize=None, cacheoffline=None):
+    """
+    Configures the local artifact cache used by `download_file`. Cached
+    files are stored once per content hash, and each url is indexed to the
+    hash and ETag of the content last downloaded from it. Files are also
+    indexed by their SHA512 hash, to match published hash files.
+    :param cachedir: str, directory in which to store the cache. 'none' or an
+                     empty string disables the cache.
+    :param cachemaxsize: str, maximum size of the cache in MB. the least
+                         recently used files are evicted to stay under it.
+    :param cacheoffline: str, set to 'true' to serve files only from the
+                         cache, without contacting the source.
+    """
+    if cachedir is not None:
+        _cache['dir'] = None if cachedir.lower() in ('', 'none') else cachedir
+    if cachemaxsize is not None:
+        _cache['maxbytes'] = int(cachemaxsize) * 1024 * 1024
+    if cacheoffline is not None:
+        _cache['offline'] = 'true' == str(cacheoffline).lower()
+    if _cache['dir']:
+        for subdir in ('objects', 'index', 'digests', 'partial'):
+            path = os.sep.join((_cache['dir'], subdir))
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    print('WARNING: Could not create the cache directory, '
+                          'the cache is disabled -- {0}'.format(path))
+                    _cache['dir'] = None
+                    break
+
+
+def _cache_lookup(url):
+    """
+    Returns the cache entry for `url`, or None if `url` is not cached.
+    :param url: str, location of the file
+    :rtype : dict
+    """
+    indexfile = os.sep.join((
+        _cache['dir'], 'index',
+        hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json'))
+    try:
+        with open(indexfile, 'r') as f:
+            entry = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    entry['object'] = os.sep.join((_cache['dir'], 'objects', entry['sha256']))
+    if not os.path.isfile(entry['object']):
+        return None
+    return entry
+
+
+def _cache_find_digest(url, algorithm, hexdigest):
+    """
+    Returns a cache entry for the cached file with the hash `hexdigest`, or
+    None if there is no such file. The file may have been cached from any
+    url.
+    :param url: str, location of the file, used only in messages
+    :param algorithm: str, hashlib name of the hash algorithm
+    :param hexdigest: str, hex digest of the file
+    :rtype : dict
+    """
+    name = hexdigest
+    if 'sha256' != algorithm:
+        digestfile = os.sep.join((_cache['dir'], 'digests',
+                                  '{0}-{1}'.format(algorithm, hexdigest)))
+        try:
+            with open(digestfile, 'r') as f:
+                name = f.read().strip()
+        except (IOError, OSError):
+            return None
+    objectfile = os.sep.join((_cache['dir'], 'objects', name))
+    if not os.path.isfile(objectfile):
+        return None
+    return {'url': url, 'object': objectfile}
+
+
+def _cache_restore(entry, filename, expected=None):
+    """
+    Copies a cached file to `filename`, and marks it as recently used. The
+    copy is checked against the `expected` hash. A cached file that does not
+    match is removed from the cache.
+    :param entry: dict, as returned by `_cache_lookup`
+    :param filename: str, path where the file should be saved
+    :param expected: tuple, as returned by `_read_published_digest`, or None
+    :rtype : bool
+    """
+    try:
+        shutil.copyfile(entry['object'], filename)
+        os.utime(entry['object'], None)
+    except (IOError, OSError):
+        # Evicted by another download in the meantime
+        return False
+    if expected and \
+            _hash_file(filename, [expected[0]])[expected[0]] != expected[1]:
+        print('WARNING: The cached file does not match its published {0} '
+              'hash, removing it from the cache -- {1}'
+              .format(expected[0].upper(), entry['url']))
+        _cache_remove(entry)
+        os.remove(filename)
+        return False
+    print('Restored file from cache -- \n'
+          '    url      = {0}\n'
+          '    filename = {1}'.format(entry['url'], filename))
+    return True
+
+
+def _cache_remove(entry):
+    """
+    Removes a cached file, and the index entry of its url.
+    :param entry: dict, as returned by `_cache_lookup`
+    """
+    indexfile = os.sep.join((
+        _cache['dir'], 'index',
+        hashlib.sha256(entry['url'].encode('utf-8')).hexdigest() + '.json'))
+    for path in (entry['object'], indexfile):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _cache_store(url, filename, etag=None, last_modified=None,
+                 digests=None, published=True):
+    """
+    Adds the file `filename`, downloaded from `url`, to the cache. Then evicts
+    the least recently used files until the cache is under its size limit.
+    Errors are reported, but never fail the download.
+    :param url: str, location the file was downloaded from
+    :param filename: str, path to the downloaded file
+    :param etag: str, ETag returned by the source, if any
+    :param last_modified: str, Last-Modified date returned by the source
+    :param digests: dict, hex digests of the file computed while it was
+                    downloaded, keyed by hashlib algorithm name
+    :param published: bool, whether a hash file is published for `url`
+    """
+    try:
+        digests = dict(digests or {})
+        if 'sha256' not in digests:
+            digests.update(_hash_file(filename, ['sha256']))
+        entry = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'size': os.path.getsize(filename),
+        }
+        if not published:
+            entry['unpublished'] = time.time()
+        entry.update(digests)
+        objectfile = os.sep.join((_cache['dir'], 'objects', entry['sha256']))
+        indexfile = os.sep.join((
+            _cache['dir'], 'index',
+            hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json'))
+        # Write to temp files and rename, so readers never see partial files
+        if os.path.isfile(objectfile):
+            os.utime(objectfile, None)
+        else:
+            fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(objectfile))
+            os.close(fd)
+            shutil.copyfile(filename, tmpfile)
+            os.rename(tmpfile, objectfile)
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(indexfile))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmpfile, indexfile)
+        for algorithm, hexdigest in digests.items():
+            if 'sha256' == algorithm:
+                continue
+            digestfile = os.sep.join((_cache['dir'], 'digests',
+                                      '{0}-{1}'.format(algorithm, hexdigest)))
+            fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(digestfile))
+            with os.fdopen(fd, 'w') as f:
+                f.write(entry['sha256'])
+            os.rename(tmpfile, digestfile)
+        _cache_evict()
+    except Exception as exc:
+        print('WARNING: Could not add file to the cache.\n'
+              '    url = {0}\n'
+              '    Exception: {1}'.format(url, exc))
+
+
+def _cache_evict():
+    """
+    Removes the least recently used files from the cache until it is under
+    the configured size limit.
+    """
+    objectdir = os.sep.join((_cache['dir'], 'objects'))
+    objects = []
+    for name in os.listdir(objectdir):
+        path = os.sep.join((objectdir, name))
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        objects.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in objects)
+    for _, size, path in sorted(objects):
+        if total <= _cache['maxbytes']:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        print('Evicted file from cache -- {0}'.format(path))
+
+
+_s3 = {
+    'conn': None,
+    'buckets': {},
+    'lock': threading.Lock(),
+}
+
+# Matches the host of a virtual-hosted-style S3 url, e.g.
+# `bucket.s3.amazonaws.com` or `bucket.s3-us-west-2.amazonaws.com`.
+# Any other host is treated as a path-style endpoint.
+_match_s3_virtual_host = re.compile(r'^(?P<bucket>.+?)\.s3(?:[.-][a-z0-9-]+)?'
+                                    r'\.amazonaws\.com(?:\.cn)?$')
+
+
+def parse_s3_url(url):
+    """
+    Returns the bucket name and key name of an S3 url. Supports both the
+    path-style syntax, `https://<s3endpoint>/<bucket>/path/to/file`, and the
+    virtual-hosted-style syntax, `https://<bucket>.<s3endpoint>/path/to/file`.
+    :param url: str, location of the S3 object
+    :return: tuple, (bucket_name, key_name)
+    """
+    parts = url.split('/')
+    m = _match_s3_virtual_host.match(parts[2].split(':')[0].lower())
+    if m:
+        return m.group('bucket'), '/'.join(parts[3:])
+    return parts[3], '/'.join(parts[4:])
+
+
+def get_s3_key(bucket_name, key_name):
+    """
+    Returns a boto Key for the S3 object, without making any requests. All
+    keys share one S3 connection, which keeps its HTTP connections alive in
+    a pool, and each bucket is resolved only once.
+    :param bucket_name: str, name of the S3 bucket
+    :param key_name: str, name of the S3 key
+    :rtype : boto.s3.key.Key
+    """
+    with _s3['lock']:
+        if _s3['conn'] is None:
+            _s3['conn'] = boto.connect_s3()
+        bucket = _s3['buckets'].get(bucket_name)
+        if bucket is None:
+            # `validate=False` skips the request that checks the bucket exists
+            bucket = _s3['conn'].get_bucket(bucket_name, validate=False)
+            _s3['buckets'][bucket_name] = bucket
+    return bucket.new_key(key_name)
+
+
+_mirror = {
+    'url': None,
+    'available': None,
+    'lock': threading.Lock(),
+}
+
+
+def configure_mirror(mirrorurl=None):
+    """
+    Configures the content mirror used by `download_file`. See
+    Utils/systemprep-mirror.py. Each file is requested from the mirror as
+    `<mirrorurl>/<scheme>/<host>/<path>`, and from its source if the mirror
+    fails.
+    :param mirrorurl: str, base url of the mirror. 'none' or an empty string
+                      disables the mirror.
+    """
+    if mirrorurl is not None:
+        url = None if mirrorurl.lower() in ('', 'none') \
+            else mirrorurl.rstrip('/')
+        with _mirror['lock']:
+            if url != _mirror['url']:
+                _mirror['url'] = url
+                _mirror['available'] = None
+
+
+def _mirror_available(recheck=False):
+    """
+    Returns True if a mirror is configured and answers. The mirror is checked
+    once, with a short timeout, so an unreachable mirror does not cost a
+    timeout for every file. It is checked again if `recheck` is True, after a
+    download from the mirror fails.
+    :rtype : bool
+    """
+    with _mirror['lock']:
+        if _mirror['url'] and (recheck or _mirror['available'] is None):
+            try:
+                urllib2.urlopen(_mirror['url'] + '/', timeout=5).close()
+                _mirror['available'] = True
+            except Exception as exc:
+                print('WARNING: The mirror is not available, files will be '
+                      'downloaded from their source -- {0}\n'
+                      '    Exception: {1}'.format(_mirror['url'], exc))
+                _mirror['available'] = False
+        return bool(_mirror['url'] and _mirror['available'])
+
+
+def get_mirror_url(url):
+    """
+    Returns the location of `url` on the mirror, or None if the mirror cannot
+    serve it.
+    :param url: str, location of the file at its source
+    :rtype : str
+    """
+    parts = urlparse.urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.netloc or \
+            parts.query:
+        return None
+    return '/'.join((_mirror['url'], parts.scheme, parts.netloc,
+                     parts.path.lstrip('/')))
+
+
+_download = {
+    'chunksize': 8 * 1024 * 1024,
+    'workers': 4,
+    'retries': 5,
+    'backoff': 1.0,
+    # How long to trust that a url has no hash file, in seconds
+    'unpublishedttl': 24 * 60 * 60,
+    'unpublished': set(),
+}
+
+# Hash algorithm and suffix of the hash files published next to artifacts.
+# See Utils/CreateHashFiles.md.
+_published_digest = ('sha512', '.SHA512')
+
+# Download engine. Every request that `download_file` makes waits for a
+# connection slot, which is given to the most urgent waiting request whose
+# host is below its limit. Reads are throttled to a bandwidth budget, and
+# reported to the progress callbacks. The limits apply to this process.
+# Content scripts run in-process are handed this engine, with the cache and
+# the mirror, see `run_script`. Content scripts run as separate processes
+# each have their own engine, configured with the same parameters.
+_engine = {
+    'condition': threading.Condition(threading.Lock()),
+    'maxconnections': 8,
+    'hostlimit': 4,
+    'active': {},
+    'waiting': [],
+    'sequence': 0,
+    'bandwidth': None,
+    'tokens': 0.0,
+    'updated': 0.0,
+    'cancelled': None,
+    'transfers': {},
+    'progress': [],
+    'progressinterval': 10,
+}
+
+
+def configure_downloads(maxconnections=None, hostlimit=None, bandwidth=None):
+    """
+    Configures the limits of the download engine.
+    :param maxconnections: str, the maximum number of requests open at once
+    :param hostlimit: str, the maximum number of requests open to one host.
+                      the buckets of S3 count as separate hosts.
+    :param bandwidth: str, the total download rate in MB per second, shared
+                      by the requests of this process. 'none' or 0 removes
+                      the limit.
+    """
+    if maxconnections is not None:
+        _engine['maxconnections'] = max(1, int(maxconnections))
+    if hostlimit is not None:
+        _engine['hostlimit'] = max(1, int(hostlimit))
+    if bandwidth is not None:
+        rate = 0 if str(bandwidth).lower() in ('', 'none') \
+            else float(bandwidth)
+        _engine['bandwidth'] = rate * 1024 * 1024 if rate > 0 else None
+
+
+def add_download_progress(callback):
+    """
+    Adds a progress callback to the download engine. It is called with
+    `(url, bytes received, size of the file or None)` after each read.
+    """
+    with _engine['condition']:
+        _engine['progress'].append(callback)
+
+
+def cancel_downloads(reason):
+    """
+    Cancels the open and waiting requests of the download engine, and any
+    made after. Call this on an error that fails the run, so the other
+    downloads stop rather than run to completion.
+    :param reason: str, the error, included in the errors of the cancelled
+                   requests
+    """
+    with _engine['condition']:
+        if not _engine['cancelled']:
+            _engine['cancelled'] = str(reason)
+        _engine['condition'].notify_all()
+
+
+def _check_cancelled():
+    if _engine['cancelled']:
+        raise SystemError('The download was cancelled after an error -- {0}'
+                          .format(_engine['cancelled']))
+
+
+def _next_connection():
+    """
+    Returns the waiting request to give the next connection slot to, or None.
+    Requests are ordered by priority, then by age. Call with the engine's
+    condition held.
+    """
+    if sum(_engine['active'].values()) >= _engine['maxconnections']:
+        return None
+    for waiter in sorted(_engine['waiting']):
+        if _engine['active'].get(waiter[2], 0) < _engine['hostlimit']:
+            return waiter
+    return None
+
+
+def _acquire_connection(host, priority):
+    """
+    Waits for a connection slot to `host`. Lower priorities go first.
+    """
+    condition = _engine['condition']
+    with condition:
+        _engine['sequence'] += 1
+        waiter = (priority, _engine['sequence'], host)
+        _engine['waiting'].append(waiter)
+        try:
+            while True:
+                _check_cancelled()
+                if waiter == _next_connection():
+                    break
+                condition.wait()
+            _engine['active'][host] = _engine['active'].get(host, 0) + 1
+        finally:
+            _engine['waiting'].remove(waiter)
+            # Another request may be able to go, too
+            condition.notify_all()
+
+
+def _release_connection(host):
+    condition = _engine['condition']
+    with condition:
+        _engine['active'][host] -= 1
+        condition.notify_all()
+
+
+def _throttle(size):
+    """
+    Takes `size` bytes from the bandwidth budget, a token bucket that holds
+    up to one second of the rate, and sleeps off any shortfall.
+    """
+    rate = _engine['bandwidth']
+    if not rate:
+        return
+    with _engine['condition']:
+        now = time.time()
+        _engine['tokens'] = min(
+            rate, _engine['tokens'] + (now - _engine['updated']) * rate)
+        _engine['updated'] = now
+        _engine['tokens'] -= size
+        delay = -_engine['tokens'] / rate
+    if delay > 0:
+        time.sleep(delay)
+
+
+def _report_progress(url, size, total):
+    with _engine['condition']:
+        received = _engine['transfers'].get(url, 0) + size
+        _engine['transfers'][url] = received
+        callbacks = list(_engine['progress'])
+    for callback in callbacks:
+        try:
+            callback(url, received, total)
+        except Exception as exc:
+            print('WARNING: Download progress callback failed -- {0}\n'
+                  '    Exception: {1}'.format(url, exc))
+
+
+_progress_reported = {}
+
+
+def log_download_progress(url, received, total):
+    """
+    Progress callback that prints the progress of each download to the run
+    log, at most once per `progressinterval` seconds.
+    """
+    now = time.time()
+    if now - _progress_reported.setdefault(url, now) < \
+            _engine['progressinterval']:
+        return
+    _progress_reported[url] = now
+    if total:
+        print('Downloading {0} of {1} bytes ({2:.0f}%) -- {3}'
+              .format(received, total, 100.0 * received / total, url))
+    else:
+        print('Downloading {0} bytes -- {1}'.format(received, url))
+
+
+_engine['progress'].append(log_download_progress)
+
+
+class _ScheduledResponse(object):
+    """
+    Response opened through the download engine. Reads are throttled and
+    reported as progress, and closing the response frees its connection
+    slot.
+    """
+    def __init__(self, response, url, host, total):
+        self.response = response
+        self.url = url
+        self.host = host
+        self.total = total
+
+    def read(self, size=-1):
+        _check_cancelled()
+        data = self.response.read() if size < 0 else self.response.read(size)
+        if data:
+            _throttle(len(data))
+            _report_progress(self.url, len(data), self.total)
+        return data
+
+    def close(self):
+        try:
+            self.response.close()
+        finally:
+            if self.host is not None:
+                _release_connection(self.host)
+                self.host = None
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+
+def _get_download_host(fetch, url):
+    """
+    Returns the host that `fetch` opens `url` from, to apply its limit.
+    """
+    if fetch is _open_s3_range:
+        return 's3://{0}'.format(parse_s3_url(url)[0])
+    if fetch is _open_mirror_range:
+        url = get_mirror_url(url)
+    return urlparse.urlparse(url).netloc
+
+
+def _schedule_fetch(fetch, priority=0):
+    """
+    Returns a version of `fetch`, e.g. `_open_http_range`, whose requests
+    are scheduled by the download engine with `priority`.
+    """
+    def scheduled(url, start=None, end=None, headers=None):
+        host = _get_download_host(fetch, url)
+        _acquire_connection(host, priority)
+        try:
+            result = fetch(url, start, end, headers)
+        except Exception:
+            _release_connection(host)
+            raise
+        response = _ScheduledResponse(result[0], url, host, result[1])
+        return (response,) + tuple(result[1:])
+    return scheduled
+
+
+
+def _get_status(exc):
+    """
+    Returns the HTTP status of a urllib2 or boto error, or None.
+    """
+    return getattr(exc, 'code', None) or getattr(exc, 'status', None)
+
+
+def _open_http_range(url, start=None, end=None, headers=None):
+    """
+    Opens a GET request for the bytes `start` to `end` of `url`, or for the
+    whole file if `start` is None.
+    :return: tuple, (response, size of the whole file or None if unknown,
+             whether the response is the requested range, ETag,
+             Last-Modified)
+    """
+    request = urllib2.Request(url)
+    for name, value in (headers or {}).items():
+        request.add_header(name, value)
+    if start is not None:
+        request.add_header('Range', 'bytes={0}-{1}'.format(start, end))
+    response = urllib2.urlopen(request, timeout=60)
+    info = response.info()
+    ranged = 206 == response.getcode()
+    if ranged:
+        size = int(info.getheader('Content-Range').split('/')[-1])
+    else:
+        size = info.getheader('Content-Length')
+        size = int(size) if size else None
+    return (response, size, ranged,
+            info.getheader('ETag'), info.getheader('Last-Modified'))
+
+
+def _open_s3_range(url, start=None, end=None, headers=None):
+    """
+    Opens a GET request for the bytes `start` to `end` of the S3 object at
+    `url`, or for the whole object if `start` is None.
+    :return: tuple, as returned by `_open_http_range`. the response is the
+             boto Key, which reads from the open request.
+    """
+    key = get_s3_key(*parse_s3_url(url))
+    headers = dict(headers or {})
+    if start is not None:
+        headers['Range'] = 'bytes={0}-{1}'.format(start, end)
+    key.open_read(headers=headers)
+    ranged = 206 == key.resp.status
+    if ranged:
+        size = int(key.resp.getheader('content-range').split('/')[-1])
+    else:
+        size = key.size
+    return key, size, ranged, key.etag, key.last_modified
+
+
+def _hash_file(filename, algorithms):
+    """
+    Returns the hex digests of the file `filename`, keyed by algorithm.
+    :param algorithms: list, hashlib names of the hash algorithms
+    :rtype : dict
+    """
+    hashes = dict((algorithm, hashlib.new(algorithm))
+                  for algorithm in algorithms)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            for digest in hashes.values():
+                digest.update(chunk)
+    return dict((algorithm, digest.hexdigest())
+                for algorithm, digest in hashes.items())
+
+
+def _open_mirror_range(url, start=None, end=None, headers=None):
+    """
+    Opens a GET request for the bytes `start` to `end` of `url` from the
+    mirror. See `_open_http_range`.
+    """
+    return _open_http_range(get_mirror_url(url), start, end, headers)
+
+
+def _copy_response(response, outfile, length=None, hashes=()):
+    """
+    Copies `length` bytes, or all of them if None, from `response` to
+    `outfile`, and updates each of `hashes` with the bytes as they are
+    copied.
+    :raise IOError: error raised if the response ends early
+    """
+    remaining = length
+    while remaining is None or remaining > 0:
+        data = response.read(1024 * 1024 if remaining is None
+                             else min(1024 * 1024, remaining))
+        if not data:
+            if remaining:
+                raise IOError('The connection closed with {0} bytes left '
+                              'to read.'.format(remaining))
+            break
+        outfile.write(data)
+        for digest in hashes:
+            digest.update(data)
+        if remaining is not None:
+            remaining -= len(data)
+
+
+def _partial_paths(url, filename):
+    """
+    Returns the paths of the partial file and of the record of its completed
+    chunks. These are kept in the cache, if there is one, so a later run can
+    resume the download.
+    :return: tuple, (partfile, statefile)
+    """
+    base = filename
+    if _cache['dir']:
+        base = os.sep.join((_cache['dir'], 'partial',
+                            hashlib.sha256(url.encode('utf-8')).hexdigest()))
+    return base + '.part', base + '.part.json'
+
+
+def _read_partial_state(partfile, statefile, url):
+    """
+    Returns the record of a partial download of `url`, or None if there is
+    no partial download that can be resumed.
+    """
+    try:
+        with open(statefile, 'r') as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if state.get('url') != url or \
+            state.get('chunksize') != _download['chunksize'] or \
+            not os.path.isfile(partfile):
+        return None
+    return state
+
+
+def _write_partial_state(statefile, state):
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(statefile) or '.')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmpfile, statefile)
+
+
+def _remove_partial(partfile, statefile):
+    for path in (partfile, statefile):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _download_chunk(fetch, url, partfile, start, end, etag):
+    """
+    Downloads the bytes `start` to `end` of `url` into `partfile`, retrying
+    with exponential backoff. The request is conditional on `etag`, so a file
+    that changes during the download is not mixed with its old version.
+    """
+    headers = {'If-Match': etag} if etag else {}
+    for attempt in range(_download['retries']):
+        try:
+            response, _, ranged, _, _ = fetch(url, start, end, headers)
+            try:
+                if not ranged:
+                    raise IOError('The source ignored the range request.')
+                with open(partfile, 'r+b') as f:
+                    f.seek(start)
+                    _copy_response(response, f, end - start + 1)
+            finally:
+                response.close()
+            return
+        except Exception as exc:
+            status = _get_status(exc)
+            # Client errors, such as a changed file, will not go away
+            retriable = status is None or status >= 500 or \
+                status in (408, 429)
+            if not retriable or attempt + 1 >= _download['retries'] or \
+                    _engine['cancelled']:
+                raise
+            delay = _download['backoff'] * (2 ** attempt + random.random())
+            print('WARNING: Retrying bytes {0}-{1} of {2} in {3:.1f}s -- {4}'
+                  .format(start, end, url, delay, exc))
+            time.sleep(delay)
+
+
+def _read_published_digest(fetch, url, entry=None):
+    """
+    Reads the hash file published next to `url`, named `<file>.SHA512` and
+    containing `<hexdigest> <file>`. See Utils/CreateHashFiles.md. A url
+    without a hash file is not asked again in this run, nor for a day if it
+    is cached.
+    :param entry: dict, the cache entry for `url`, or None
+    :return: tuple, (hashlib algorithm name, hex digest), or None if there is
+             no hash file
+    """
+    if url in _download['unpublished'] or \
+            entry and time.time() - entry.get('unpublished', 0) < \
+            _download['unpublishedttl']:
+        return None
+    algorithm, suffix = _published_digest
+    try:
+        response = fetch(url + suffix)[0]
+    except Exception as exc:
+        # A cancelled download is not a problem with the hash file
+        _check_cancelled()
+        if _get_status(exc) in (403, 404):
+            _download['unpublished'].add(url)
+        else:
+            print('WARNING: Could not read the hash file -- {0}\n'
+                  '    Exception: {1}'.format(url + suffix, exc))
+        return None
+    try:
+        fields = response.read(1024).split()
+    finally:
+        response.close()
+    length = hashlib.new(algorithm).digest_size * 2
+    if fields and re.match(r'^[0-9a-fA-F]{{{0}}}$'.format(length),
+                           fields[0]):
+        return algorithm, fields[0].lower()
+    print('WARNING: The hash file is not valid -- {0}'.format(url + suffix))
+    return None
+
+
+def _check_digests(url, digests, expected):
+    """
+    Raises an error if `digests` does not include the `expected` digest.
+    :param digests: dict, hex digests of the downloaded file
+    :param expected: tuple, as returned by `_read_published_digest`, or None
+    """
+    if expected and digests[expected[0]] != expected[1]:
+        raise SystemError('The downloaded file does not match its '
+                          'published {0} hash.\n'
+                          'url = {1}'.format(expected[0].upper(), url))
+
+
+def _download_ranged(fetch, url, filename, headers=None, expected=None):
+    """
+    Downloads `url` to `filename`, using `fetch` to open ranges of the file.
+    A file larger than one chunk is downloaded in parallel chunks, each with
+    its own retries. The chunks are written to a partial file, and each
+    completed chunk is recorded, so a failed download resumes where it left
+    off. The file is hashed as it is downloaded, and checked against the
+    `expected` hash.
+    :param fetch: function, `_open_http_range` or `_open_s3_range`
+    :param url: str, location of the file
+    :param filename: str, path to save the file
+    :param headers: dict, headers for the first request, such as the
+                    conditional headers that revalidate a cached file
+    :param expected: tuple, as returned by `_read_published_digest`, or None
+    :return: tuple, (ETag, Last-Modified, dict of hex digests) of the file
+    """
+    chunksize = _download['chunksize']
+    # SHA256 names the file in the cache
+    algorithms = set(['sha256'])
+    if expected:
+        algorithms.add(expected[0])
+    hashes = dict((algorithm, hashlib.new(algorithm))
+                  for algorithm in algorithms)
+    partfile, statefile = _partial_paths(url, filename)
+    state = _read_partial_state(partfile, statefile, url)
+
+    # Request the first missing chunk. The response also gives the size and
+    # version of the file.
+    first = 0
+    while state and first in state['done']:
+        first += 1
+    try:
+        response, size, ranged, etag, last_modified = fetch(
+            url, first * chunksize, (first + 1) * chunksize - 1, headers)
+    except Exception as exc:
+        # A range cannot be satisfied by an empty file, or past its end
+        if 416 != _get_status(exc):
+            raise
+        first = 0
+        state = None
+        response, size, ranged, etag, last_modified = fetch(
+            url, None, None, headers)
+
+    try:
+        if not ranged or (0 == first and size <= chunksize):
+            # The response holds the whole file
+            with open(filename, 'wb') as f:
+                _copy_response(response, f, size if ranged else None,
+                               hashes.values())
+            _remove_partial(partfile, statefile)
+            digests = dict((algorithm, digest.hexdigest())
+                           for algorithm, digest in hashes.items())
+            try:
+                _check_digests(url, digests, expected)
+            except SystemError:
+                os.remove(filename)
+                raise
+            return etag, last_modified, digests
+
+        if state is not None and \
+                (state['size'], state['etag']) == (size, etag):
+            print('Resuming download, {0} of {1} bytes done -- {2}'
+                  .format(len(state['done']) * chunksize, size, url))
+        else:
+            state = {
+                'url': url,
+                'size': size,
+                'etag': etag,
+                'last_modified': last_modified,
+                'chunksize': chunksize,
+                'done': [],
+            }
+            with open(partfile, 'wb') as f:
+                f.truncate(size)
+        try:
+            with open(partfile, 'r+b') as f:
+                f.seek(first * chunksize)
+                _copy_response(response, f,
+                               min(chunksize, size - first * chunksize))
+            state['done'].append(first)
+        except Exception as exc:
+            # Leave the chunk to be retried with the others
+            print('WARNING: Could not download the first chunk of {0} -- {1}'
+                  .format(url, exc))
+    finally:
+        response.close()
+
+    lock = threading.Lock()
+    hashed = [0]
+    _write_partial_state(statefile, state)
+
+    def hash_chunks():
+        # Hash the completed chunks in order, as soon as they are contiguous.
+        # They are read back while still in the page cache, so the file is
+        # not read again once the download finishes.
+        with open(partfile, 'rb') as f:
+            f.seek(hashed[0] * chunksize)
+            while hashed[0] in state['done']:
+                data = f.read(chunksize)
+                for digest in hashes.values():
+                    digest.update(data)
+                hashed[0] += 1
+
+    def download_chunk(n):
+        _download_chunk(fetch, url, partfile, n * chunksize,
+                        min(size, (n + 1) * chunksize) - 1, etag)
+        with lock:
+            state['done'].append(n)
+            _write_partial_state(statefile, state)
+            hash_chunks()
+
+    hash_chunks()
+    missing = [n for n in range((size + chunksize - 1) // chunksize)
+               if n not in state['done']]
+    if missing:
+        pool = ThreadPool(min(_download['workers'], len(missing)))
+        try:
+            pool.map(download_chunk, missing)
+        finally:
+            pool.close()
+            pool.join()
+
+    digests = dict((algorithm, digest.hexdigest())
+                   for algorithm, digest in hashes.items())
+    try:
+        _check_digests(url, digests, expected)
+    except SystemError:
+        _remove_partial(partfile, statefile)
+        raise
+    shutil.move(partfile, filename)
+    _remove_partial(partfile, statefile)
+    return etag, last_modified, digests
+
+
+def download_file(url, filename, sourceiss3bucket=None, priority=0):
     """
 Download the file from `url` and save it locally under `filename`.
+Uses the local artifact cache, if one is configured. See `configure_cache`.
+The download is timed and recorded in the phase log. See `timed_phase`.
+Its requests are scheduled by the download engine. See `configure_downloads`.
     :rtype : bool
     :param url:
     :param filename:
     :param sourceiss3bucket:
+    :param priority: int, lower priorities get connections first
+    """
+    with timed_phase('download_file', url=url, filename=filename) as phase:
+        phase['source'] = _download_file(url, filename, sourceiss3bucket,
+                                         priority)
+        phase['bytes'] = os.path.getsize(filename)
+    return True
+
+
+def _download_file(url, filename, sourceiss3bucket=None, priority=0):
+    """
+    Does the work of `download_file`. Files are downloaded from the mirror,
+    if one is configured, and from their source if the mirror fails.
+    :return: str, where the file came from. one of 'local', 'cache',
+             'mirror', 's3' or 'web'
+    """
+    entry = _cache_lookup(url) if _cache['dir'] else None
+
+    if _cache['dir'] and _cache['offline']:
+        if entry and _cache_restore(entry, filename):
+            return 'cache'
+        raise SystemError('Unable to find file in the cache, and the cache '
+                          'is offline.\n'
+                          'url = {0}\n'
+                          'filename = {1}'.format(url, filename))
+
+    if _mirror_available() and get_mirror_url(url):
+        try:
+            return _download_from(url, filename, entry, mirror=True,
+                                  priority=priority)
+        except SystemError as exc:
+            print('WARNING: Could not download file from the mirror, trying '
+                  'its source.\n'
+                  '    Exception: {0}'.format(exc))
+            _mirror_available(recheck=True)
+    return _download_from(url, filename, entry, sourceiss3bucket,
+                          priority=priority)
+
+
+def _download_from(url, filename, entry, sourceiss3bucket=None,
+                   mirror=False, priority=0):
+    """
+    Downloads `url` to `filename` from the mirror, from S3, or from a web
+    server.
+    :param entry: dict, the cache entry for `url`, or None
+    :return: str, as returned by `_download_file`
     """
-    conn = None
+    if mirror:
+        fetch = _open_mirror_range
+    elif sourceiss3bucket:
+        fetch = _open_s3_range
+    else:
+        fetch = _open_http_range
+    fetch = _schedule_fetch(fetch, priority)
+    with _engine['condition']:
+        _engine['transfers'].pop(url, None)
 
-    if sourceiss3bucket:
-        bucket_name = url.split('/')[3]
-        key_name = '/'.join(url.split('/')[4:])
+    # The published hash identifies the file, so a copy already on disk or in
+    # the cache is used without downloading it again
+    expected = _read_published_digest(fetch, url, entry)
+    if expected:
+        algorithm, hexdigest = expected
+        if os.path.isfile(filename) and \
+                _hash_file(filename, [algorithm])[algorithm] == hexdigest:
+            print('File already matches its published hash -- \n'
+                  '    url      = {0}\n'
+                  '    filename = {1}'.format(url, filename))
+            return 'local'
+        found = _cache_find_digest(url, algorithm, hexdigest) \
+            if _cache['dir'] else None
+        if found and _cache_restore(found, filename, expected):
+            return 'cache'
+
+    # Revalidate the cached file with a conditional GET
+    headers = {}
+    if entry and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+
+    if sourceiss3bucket and not mirror:
+        bucket_name, key_name = parse_s3_url(url)
         try:
-            conn = boto.connect_s3()
-            bucket = conn.get_bucket(bucket_name)
-            key = bucket.get_key(key_name)
-            key.get_contents_to_filename(filename=filename)
-        except (NameError, BotoClientError):
             try:
-                bucket_name = url.split('/')[2].split('.')[0]
-                key_name = '/'.join(url.split('/')[3:])
-                bucket = conn.get_bucket(bucket_name)
-                key = bucket.get_key(key_name)
-                key.get_contents_to_filename(filename=filename)
-            except Exception as exc:
-                raise SystemError('Unable to download file from S3 bucket.\n'
-                                  'url = {0}\n'
-                                  'bucket = {1}\n'
-                                  'key = {2}\n'
-                                  'file = {3}\n'
-                                  'Exception: {4}'
-                                  .format(url, bucket_name, key_name,
-                                          filename, exc))
+                etag, last_modified, digests = _download_ranged(
+                    fetch, url, filename, headers, expected)
+            except S3ResponseError as exc:
+                if 304 != exc.status:
+                    raise
+                if _cache_restore(entry, filename, expected):
+                    return 'cache'
+                # The cached file is gone or corrupt, so download it again
+                etag, last_modified, digests = _download_ranged(
+                    fetch, url, filename, None, expected)
         except Exception as exc:
             raise SystemError('Unable to download file from S3 bucket.\n'
                               'url = {0}\n'
@@ -226,20 +1398,501 @@ Download the file from `url` and save it locally under `filename`.
               '    url      = {0}\n'
               '    filename = {1}'.format(url, filename))
     else:
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
         try:
-            response = urllib2.urlopen(url)
-            with open(filename, 'wb') as outfile:
-                shutil.copyfileobj(response, outfile)
+            try:
+                etag, last_modified, digests = _download_ranged(
+                    fetch, url, filename, headers, expected)
+            except urllib2.HTTPError as exc:
+                if 304 != exc.code:
+                    raise
+                if _cache_restore(entry, filename, expected):
+                    return 'cache'
+                # The cached file is gone or corrupt, so download it again
+                etag, last_modified, digests = _download_ranged(
+                    fetch, url, filename, None, expected)
         except Exception as exc:
             #TODO: Update `except` logic
-            raise SystemError('Unable to download file from web server.\n'
+            raise SystemError('Unable to download file from {0}.\n'
+                              'url = {1}\n'
+                              'filename = {2}\n'
+                              'Exception: {3}'
+                              .format('mirror' if mirror else 'web server',
+                                      url, filename, exc))
+        print('Downloaded file from {0} -- \n'
+              '    url      = {1}\n'
+              '    filename = {2}'.format('mirror' if mirror else
+                                          'web server', url, filename))
+    if _cache['dir']:
+        _cache_store(url, filename, etag, last_modified, digests,
+                     expected is not None)
+    if mirror:
+        return 'mirror'
+    return 's3' if sourceiss3bucket else 'web'
+
+
+def get_artifacts_to_prefetch(scriptstoexecute, sourceiss3bucket):
+    """
+Returns a list of (url, sourceiss3bucket) tuples, one for each unique artifact
+that will be downloaded while executing `scriptstoexecute`. This includes the
+content scripts themselves, plus the salt content and salt formulas passed to
+the content scripts as parameters. The list is in the order the artifacts are
+needed: the content scripts first, then the salt content, then the formulas.
+    :param scriptstoexecute: tuple, as returned by `get_scripts_to_execute`
+    :param sourceiss3bucket: bool, whether the content scripts are hosted in an S3 bucket
+    :rtype : list
+    """
+    artifacts = []
+    for script in scriptstoexecute:
+        params = script['Parameters']
+        artifacts.append((0, script['ScriptSource'], sourceiss3bucket))
+        # A finalize run uses the salt content installed by a prebake run
+        if 'finalize' == str(params.get('provisionphase', 'full')).lower():
+            continue
+        # The salt content script honors `sourceiss3bucket` for the salt
+        # content, but always downloads formulas from a web server
+        if params.get('saltcontentsource'):
+            artifacts.append((
+                1,
+                params['saltcontentsource'],
+                'true' == str(params.get('sourceiss3bucket', 'false')).lower()
+            ))
+        # Parameters from the command line are comma-delimited strings
+        formulas = params.get('formulastoinclude') or []
+        if isinstance(formulas, basestring):
+            formulas = filter(None, (
+                x.strip() for x in
+                formulas.translate(None, '()[]').split(',')))
+        for formulasource in formulas:
+            artifacts.append((2, formulasource, False))
+
+    # Remove duplicate urls, preserving the order within each kind
+    seen = set()
+    uniqueartifacts = []
+    for _, url, iss3 in sorted(artifacts, key=lambda x: x[0]):
+        if url not in seen:
+            seen.add(url)
+            uniqueartifacts.append((url, iss3))
+
+    return uniqueartifacts
+
+
+def prefetch_artifacts(artifacts, workingdir, maxworkers=4, required=()):
+    """
+Downloads `artifacts` to `workingdir` in parallel, using a bounded pool of
+threads. The artifacts are prioritized in order, so the download engine gives
+the first ones connections before the later ones. An artifact that fails to
+download is reported and skipped, so the step that needs it will try again
+(and report the error in context). The run cannot go on without the
+`required` artifacts, so the first of them that fails cancels the other
+downloads, and raises an error.
+Returns a dictionary that maps each downloaded url to its local file path.
+    :param artifacts: list, (url, sourceiss3bucket) tuples, as returned by `get_artifacts_to_prefetch`
+    :param workingdir: str, the directory in which to save the artifacts
+    :param maxworkers: int, the maximum number of concurrent downloads
+    :param required: list, urls of the artifacts the run cannot go on without
+    :rtype : dict
+    :raise SystemError: error raised if a required artifact fails to download
+    """
+    # Assign each url a unique local filename
+    downloads = []
+    filenames = set()
+    for url, iss3 in artifacts:
+        filename = url.split('/')[-1]
+        if filename in filenames:
+            filename = '{0}-{1}'.format(len(downloads), filename)
+        filenames.add(filename)
+        downloads.append((len(downloads), url,
+                          os.sep.join((workingdir, filename)), iss3))
+
+    def _prefetch(download):
+        priority, url, filename, iss3 = download
+        try:
+            download_file(url, filename, iss3, priority)
+        except Exception as exc:
+            if url in required:
+                cancel_downloads('{0} -- {1}'.format(url, exc))
+            return url, None, exc
+        return url, filename, None
+
+    print('+-' * 40)
+    print('Prefetching {0} artifact(s) using up to {1} thread(s)...'
+          .format(len(downloads), maxworkers))
+    prefetched = {}
+    if downloads:
+        pool = ThreadPool(max(1, min(maxworkers, len(downloads))))
+        try:
+            results = pool.map(_prefetch, downloads)
+        finally:
+            pool.close()
+            pool.join()
+        failed = [(url, exc) for url, _, exc in results
+                  if exc is not None and url in required]
+        if failed:
+            raise SystemError('Unable to download a content script. Exiting '
+                              'with failure.\n'
                               'url = {0}\n'
-                              'filename = {1}\n'
-                              'Exception: {2}'
-                              .format(url, filename, exc))
-        print('Downloaded file from web server -- \n'
-              '    url      = {0}\n'
-              '    filename = {1}'.format(url, filename))
+                              'Exception: {1}'.format(*failed[0]))
+        for url, filename, exc in results:
+            if exc is None:
+                prefetched[url] = filename
+            else:
+                print('WARNING: Failed to prefetch artifact, it will be '
+                      'downloaded when needed.\n'
+                      '    url = {0}\n'
+                      '    Exception: {1}'.format(url, exc))
+    print('Prefetched {0} of {1} artifact(s).'
+          .format(len(prefetched), len(downloads)))
+    print('-+' * 40)
+    return prefetched
+
+
+_bundle_format = 1
+
+
+def unpack_bundle(bundlesource, workingdir, sourceiss3bucket=None):
+    """
+Downloads the bundle at `bundlesource` and unpacks its artifacts to
+`workingdir`. A bundle is a zip archive built by
+Utils/systemprep-buildbundle.py. It holds the content scripts, salt content and
+salt formulas, and a `manifest.json` that maps the url of each artifact to its
+member, with the size and SHA256 hash of the member. A member that is missing,
+or that does not match the manifest, is skipped, so its url is downloaded
+instead.
+Returns a dictionary that maps each unpacked url to its local file path, like
+`prefetch_artifacts`.
+    :param bundlesource: str, location of the bundle
+    :param workingdir: str, the directory in which to unpack the artifacts
+    :param sourceiss3bucket: bool, whether the bundle is hosted in an S3 bucket
+    :rtype : dict
+    """
+    bundlefile = os.sep.join((workingdir, bundlesource.split('/')[-1]))
+    download_file(bundlesource, bundlefile, sourceiss3bucket)
+    unpacked = {}
+    archive = zipfile.ZipFile(bundlefile)
+    try:
+        manifest = json.loads(archive.read('manifest.json'))
+        if _bundle_format != manifest.get('format'):
+            raise SystemError('Unsupported bundle format: {0}'
+                              .format(manifest.get('format')))
+        bundledir = os.sep.join((workingdir, 'bundle'))
+        for artifact in manifest['artifacts']:
+            try:
+                path = archive.extract(artifact['member'], bundledir)
+            except (KeyError, zipfile.BadZipfile) as exc:
+                print('WARNING: Could not unpack the artifact from the '
+                      'bundle, it will be downloaded.\n'
+                      '    url = {0}\n'
+                      '    Exception: {1}'.format(artifact['url'], exc))
+                continue
+            if artifact.get('size') != os.path.getsize(path) or \
+                    artifact.get('sha256') != \
+                    _hash_file(path, ['sha256'])['sha256']:
+                print('WARNING: The artifact in the bundle does not match '
+                      'the manifest, it will be downloaded.\n'
+                      '    url = {0}'.format(artifact['url']))
+                os.remove(path)
+                continue
+            unpacked[artifact['url']] = path
+    finally:
+        archive.close()
+    os.remove(bundlefile)
+    print('Unpacked {0} artifact(s) from bundle version {1} -- {2}'
+          .format(len(unpacked), manifest.get('version'), bundlesource))
+    return unpacked
+
+
+# Module state that content scripts run in-process share with the master.
+# The content scripts keep the same dicts, so the keys they use must match.
+_inprocess_state = ('_s3', '_cache', '_mirror', '_download', '_engine')
+
+
+def run_script(script, fullfilepath, inprocess=False):
+    """
+Executes a content script, passing it the parameters in script['Parameters'].
+By default, the script runs in a new python process, and the parameters are
+passed on the command line as `key='value'` strings. If `inprocess` is set,
+the script is instead imported as a module and its `main()` is called with
+the parameters as python objects, which avoids starting a new interpreter
+and the round trip of the parameters through strings. The script then
+downloads through the master's S3 connections, download engine, cache and
+mirror, so the connection and bandwidth limits cover both.
+    :param script: dict, an entry from `get_scripts_to_execute`
+    :param fullfilepath: str, path to the downloaded script
+    :param inprocess: bool, whether to run the script in this process
+    :raise SystemError: error raised if the script fails
+    """
+    print('Running script -- ' + script['ScriptSource'])
+    print('Sending parameters --')
+    for key, value in script['Parameters'].items():
+        print('    {0} = {1}'.format(key, value))
+
+    if not inprocess:
+        paramstring = ' '.join("%s='%s'" % (key, val) for (key, val) in script['Parameters'].iteritems())
+        fullcommand = 'python {0} {1}'.format(fullfilepath, paramstring)
+        result = os.system(fullcommand)
+        if result is not 0:
+            message = 'Encountered an unrecoverable error executing a ' \
+                      'content script. Exiting with failure.\n' \
+                      'Command executed: {0}' \
+                      .format(fullcommand)
+            raise SystemError(message)
+        return True
+
+    modulename = 'systemprep_content_' + re.sub(
+        r'\W', '_', os.path.splitext(os.path.basename(fullfilepath))[0])
+    try:
+        module = imp.load_source(modulename, fullfilepath)
+        # Let the content script reuse the pooled S3 connection, and download
+        # through the same engine, cache and mirror as the master
+        for name in _inprocess_state:
+            if hasattr(module, name):
+                setattr(module, name, globals()[name])
+        module.main(**script['Parameters'])
+    except SystemExit as exc:
+        # Map exit codes to the same semantics as running the script
+        if exc.code not in (None, 0):
+            raise SystemError('Encountered an unrecoverable error executing '
+                              'a content script. Exiting with failure.\n'
+                              'Script executed: {0}\n'
+                              'Exit code: {1}'
+                              .format(fullfilepath, exc.code))
+    except Exception as exc:
+        raise SystemError('Encountered an unrecoverable error executing a '
+                          'content script. Exiting with failure.\n'
+                          'Script executed: {0}\n'
+                          'Exception: {1}'
+                          .format(fullfilepath, exc))
+    return True
+
+
+def get_script_dependencies(scriptstoexecute):
+    """
+Returns the name of each script in `scriptstoexecute`, and the set of names
+of the scripts it depends on, in the same order as `scriptstoexecute`.
+    :param scriptstoexecute: tuple, as returned by `get_scripts_to_execute`
+    :rtype : list
+    :raise SystemError: error raised if a dependency is unknown or circular
+    """
+    names = [script.get('Name', script['ScriptSource'].split('/')[-1])
+             for script in scriptstoexecute]
+    if len(set(names)) != len(names):
+        raise SystemError('Content script names must be unique: {0}'
+                          .format(names))
+
+    dependencies = []
+    for index, script in enumerate(scriptstoexecute):
+        dependson = script.get('DependsOn')
+        if dependson is None:
+            # Without declared dependencies, keep the strict ordering
+            dependson = names[:index]
+        unknown = set(dependson) - set(names)
+        if unknown:
+            raise SystemError('Content script `{0}` depends on unknown '
+                              'script(s): {1}'
+                              .format(names[index], ', '.join(unknown)))
+        dependencies.append((names[index], set(dependson)))
+
+    # Resolve the graph once, to reject circular dependencies up front
+    resolved = set()
+    unresolved = list(dependencies)
+    while unresolved:
+        ready = [name for name, deps in unresolved if deps <= resolved]
+        if not ready:
+            raise SystemError('Content scripts have circular dependencies: '
+                              '{0}'.format(', '.join(
+                                  name for name, _ in unresolved)))
+        resolved.update(ready)
+        unresolved = [x for x in unresolved if x[0] not in resolved]
+
+    return dependencies
+
+
+def run_scripts(scriptstoexecute, fullfilepaths, inprocess=False,
+                maxworkers=4):
+    """
+Executes the content scripts in `scriptstoexecute`. Each script starts as
+soon as the scripts it depends on are complete, and up to `maxworkers`
+scripts run at the same time. If a script fails, no new scripts are started,
+the downloads of the download engine are cancelled, the scripts already
+running are allowed to finish, and a single error is raised that names every
+failed script and every script that did not run. Scripts run in-process share
+the engine, so their downloads fail, too.
+    :param scriptstoexecute: tuple, as returned by `get_scripts_to_execute`
+    :param fullfilepaths: list, path to each downloaded script
+    :param inprocess: bool, whether to run the scripts in this process
+    :param maxworkers: int, the maximum number of scripts to run at once
+    :raise SystemError: error raised if any script fails
+    """
+    dependencies = get_script_dependencies(scriptstoexecute)
+    results = Queue.Queue()
+
+    def _run(index):
+        try:
+            with timed_phase('run_script',
+                             content_script=dependencies[index][0]):
+                run_script(scriptstoexecute[index], fullfilepaths[index],
+                           inprocess)
+        except Exception as exc:
+            results.put((index, exc))
+        else:
+            results.put((index, None))
+
+    pending = list(range(len(scriptstoexecute)))
+    running = {}
+    completed = set()
+    failures = []
+    while pending or running:
+        # Start every script whose dependencies are complete
+        for index in list(pending):
+            if failures or len(running) >= max(1, maxworkers):
+                break
+            if dependencies[index][1] <= completed:
+                pending.remove(index)
+                running[index] = threading.Thread(target=_run, args=(index,))
+                running[index].start()
+        if not running:
+            break
+        index, exc = results.get()
+        running.pop(index).join()
+        if exc is None:
+            completed.add(dependencies[index][0])
+        else:
+            failures.append((dependencies[index][0], exc))
+            cancel_downloads('{0} -- {1}'.format(dependencies[index][0],
+                                                 exc))
+
+    if failures:
+        message = 'Encountered an unrecoverable error executing the ' \
+                  'content scripts. Exiting with failure.\n'
+        for name, exc in failures:
+            message += 'Failed script: {0}\n{1}\n'.format(name, exc)
+        if pending:
+            message += 'Scripts not executed: {0}'.format(', '.join(
+                dependencies[index][0] for index in pending))
+        raise SystemError(message)
+    return True
+
+
+def write_report(reportfile, phaselog, start, status):
+    """
+Collects the timing records that the master and content scripts wrote to
+`phaselog`, and saves them to `reportfile` as a single JSON document. The
+report includes every phase, the total time spent in each kind of phase, and
+the number of bytes downloaded.
+    :param reportfile: str, path where the report should be saved
+    :param phaselog: str, path to the phase log. it is removed once the report is saved
+    :param start: float, time the run started, in seconds since the epoch
+    :param status: str, 'succeeded' or 'failed'
+    :rtype : bool
+    """
+    phases = []
+    try:
+        with open(phaselog, 'r') as f:
+            for line in f:
+                try:
+                    phases.append(json.loads(line))
+                except ValueError:
+                    continue
+    except IOError:
+        pass
+    phases.sort(key=lambda x: x['start'])
+
+    totals = {}
+    for phase in phases:
+        totals[phase['name']] = totals.get(phase['name'], 0) + phase['duration']
+    downloads = [x for x in phases if 'download_file' == x['name']]
+    report = {
+        'status': status,
+        'start': start,
+        'duration': time.time() - start,
+        'downloads': {
+            'count': len(downloads),
+            'from_cache': len([x for x in downloads
+                               if 'cache' == x.get('source')]),
+            'bytes': sum(x.get('bytes') or 0 for x in downloads),
+            'seconds': sum(x['duration'] for x in downloads),
+        },
+        'phase_totals': totals,
+        'phases': phases,
+    }
+
+    try:
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(reportfile))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        os.rename(tmpfile, reportfile)
+        os.remove(phaselog)
+    except (IOError, OSError) as exc:
+        print('WARNING: Could not save the run report -- {0}\n'
+              '    Exception: {1}'.format(reportfile, exc))
+        return False
+
+    print('Saved the run report -- {0}'.format(reportfile))
+    return True
+
+
+def run_content_scripts(scriptstoexecute, systemparams, sourceiss3bucket,
+                        inprocess=False, params=None):
+    """
+Downloads the content scripts and their content, and executes the scripts.
+    :param scriptstoexecute: tuple, as returned by `get_scripts_to_execute`
+    :param systemparams: dict, as returned by `get_system_params`
+    :param sourceiss3bucket: bool, whether the content scripts are hosted in an S3 bucket
+    :param inprocess: bool, whether to run the scripts in this process
+    :param params: dict, parameters passed to the master script
+    :raise SystemError: error raised if any script fails
+    """
+    # Download the content scripts and their content up front, from the
+    # bundle if there is one, and in parallel otherwise. Content scripts find
+    # the local copies using the `prefetchindex` file.
+    prefetched = {}
+    params = params or {}
+    if params.get('bundlesource'):
+        try:
+            with timed_phase('unpack_bundle', url=params['bundlesource']):
+                prefetched = unpack_bundle(params['bundlesource'],
+                                           systemparams['workingdir'],
+                                           sourceiss3bucket)
+        except Exception as exc:
+            print('WARNING: Failed to unpack the bundle, the artifacts will '
+                  'be downloaded individually.\n'
+                  '    bundlesource = {0}\n'
+                  '    Exception: {1}'.format(params['bundlesource'], exc))
+    if 'false' != params.get('prefetch', 'true').lower():
+        artifacts = [x for x in get_artifacts_to_prefetch(scriptstoexecute,
+                                                          sourceiss3bucket)
+                     if x[0] not in prefetched]
+        with timed_phase('prefetch_artifacts'):
+            prefetched.update(prefetch_artifacts(
+                artifacts,
+                systemparams['workingdir'],
+                int(params.get('prefetchworkers', 4)),
+                [script['ScriptSource'] for script in scriptstoexecute]))
+    if prefetched:
+        prefetchindex = systemparams['workingdir'] + \
+            systemparams['pathseparator'] + 'prefetch.json'
+        with open(prefetchindex, 'w') as f:
+            json.dump(prefetched, f)
+        for script in scriptstoexecute:
+            script['Parameters']['prefetchindex'] = prefetchindex
+
+    #Loop through each 'script' in scriptstoexecute
+    fullfilepaths = []
+    for script in scriptstoexecute:
+        url = script['ScriptSource']
+        filename = url.split('/')[-1]
+        fullfilepath = prefetched.get(url)
+        if not fullfilepath:
+            fullfilepath = systemparams['workingdir'] + systemparams['pathseparator'] + filename
+            #Download each script, script['ScriptSource']
+            download_file(url, fullfilepath, sourceiss3bucket)
+        fullfilepaths.append(fullfilepath)
+
+    #Execute the scripts, in parallel where their dependencies allow
+    run_scripts(scriptstoexecute, fullfilepaths, inprocess,
+                int(params.get('scriptworkers', 4)))
     return True
 
 
@@ -281,6 +1934,12 @@ def main(noreboot = 'false', **kwargs):
     # Check special parameter types
     noreboot = 'true' == noreboot.lower()
     sourceiss3bucket = 'true' == kwargs.get('sourceiss3bucket', 'false').lower()
+    inprocess = 'true' == kwargs.get('inprocess', 'false').lower()
+    provisionphase = kwargs.get('provisionphase', 'full').lower()
+    if provisionphase not in ('full', 'prebake', 'finalize'):
+        raise SystemError('Unrecognized `provisionphase`! Must set '
+                          '`provisionphase` to "full", "prebake", or '
+                          '"finalize".')
 
     print('+' * 80)
     print('Entering script -- {0}'.format(scriptname))
@@ -289,37 +1948,68 @@ def main(noreboot = 'false', **kwargs):
     for key, value in kwargs.items():
         print('    {0} = {1}'.format(key, value))
 
+    # Configure the local artifact cache. The cache parameters are also
+    # relayed to the content scripts, so they all share the same cache.
+    configure_cache(kwargs.get('cachedir', '/var/cache/systemprep'),
+                    kwargs.get('cachemaxsize'),
+                    kwargs.get('cacheoffline'))
+    # Download from a content mirror, if one is given. `mirrorurl` is relayed
+    # to the content scripts with the other parameters.
+    configure_mirror(kwargs.get('mirrorurl'))
+    # Limit the connections and bandwidth of the downloads. These parameters
+    # are relayed to the content scripts, too.
+    configure_downloads(kwargs.get('downloadconnections'),
+                        kwargs.get('downloadhostlimit'),
+                        kwargs.get('downloadbandwidth'))
+
+    # Time each phase of the run. Content scripts append their timings to
+    # the same phase log, which is collected into the run report at the end.
+    start = time.time()
+    reportfile = kwargs.get('reportfile', '/var/log/systemprep.report.json')
+    phaselog = 'none'
+    if 'none' != reportfile.lower():
+        phaselog = reportfile + '.phases'
+        open(phaselog, 'w').close()
+    configure_phase_log(phaselog)
+
     system = platform.system()
-    systemparams = get_system_params(system)
+    with timed_phase('create_working_dir'):
+        systemparams = get_system_params(system)
+    # Detect the host facts once, and share them with the content scripts
+    hostfactsfile = kwargs.get('hostfactsfile',
+                               '/var/run/systemprep.facts.json')
+    if 'Linux' in system and 'none' != hostfactsfile.lower():
+        with timed_phase('host_facts'):
+            hostfacts = load_host_facts(system, hostfactsfile)
+        print('Host facts -- {0}'.format(hostfacts))
+    else:
+        hostfactsfile = 'none'
+    # The salt install records its settings here, and a finalize run reads
+    # them to skip the steps done when the system was prebaked
+    installrecordfile = kwargs.get('installrecordfile',
+                                   '/etc/salt/systemprep.install.json')
     scriptstoexecute = get_scripts_to_execute(system, systemparams['workingdir'], **kwargs)
-
-    #Loop through each 'script' in scriptstoexecute
     for script in scriptstoexecute:
-        url = script['ScriptSource']
-        filename = url.split('/')[-1]
-        fullfilepath = systemparams['workingdir'] + systemparams['pathseparator'] + filename
-        #Download each script, script['ScriptSource']
-        download_file(url, fullfilepath, sourceiss3bucket)
-        #Execute each script, passing it the parameters in script['Parameters']
-        #TODO: figure out if there's a better way to call and execute the script
-        print('Running script -- ' + script['ScriptSource'])
-        print('Sending parameters --')
-        for key, value in script['Parameters'].items():
-            print('    {0} = {1}'.format(key, value))
-        paramstring = ' '.join("%s='%s'" % (key, val) for (key, val) in script['Parameters'].iteritems())
-        fullcommand = 'python {0} {1}'.format(fullfilepath, paramstring)
-        result = os.system(fullcommand)
-        if result is not 0:
-            message = 'Encountered an unrecoverable error executing a ' \
-                      'content script. Exiting with failure.\n' \
-                      'Command executed: {0}' \
-                      .format(fullcommand)
-            raise SystemError(message)
+        script['Parameters']['phaselog'] = phaselog
+        script['Parameters']['hostfactsfile'] = hostfactsfile
+        script['Parameters']['installrecordfile'] = installrecordfile
+
+    status = 'failed'
+    try:
+        run_content_scripts(scriptstoexecute, systemparams, sourceiss3bucket,
+                            inprocess, kwargs)
+        status = 'succeeded'
+    finally:
+        if 'none' != phaselog:
+            write_report(reportfile, phaselog, start, status)
 
     cleanup(systemparams['workingdir'])
 
     if noreboot:
         print('Detected `noreboot` switch. System will not be rebooted.')
+    elif 'prebake' == provisionphase:
+        print('Detected the `prebake` provisionphase. System will not be '
+              'rebooted.')
     else:
         print('Reboot scheduled. System will reboot after the script exits.')
         os.system(systemparams['restart'])
@@ -0,0 +1,625 @@
+#!/usr/bin/env python
+"""
+Benchmarks the SystemPrep Linux pipeline against a local artifact server.
+
+The benchmark generates synthetic salt content, salt formulas and yum repo
+files, and serves them from a local HTTP server. The same server answers
+path-style S3 requests, `/<bucket>/<key>`, so it also stands in for S3 when
+`--source s3` is set. The master script is copied into a temporary root with
+its content script urls pointed at the local server, and run end to end in a
+chroot. The chroot shares the host's /usr through an overlay, so `yum`,
+`rpm` and `salt-call` are replaced by stubs without touching the host. The
+`salt-call` stub writes a synthetic state run for the installed formulas.
+
+For each run, the benchmark reports the wall time, the time of each phase
+from the master's run report, the bytes served, and the peak RSS of the
+master and the content scripts. The first run starts with an empty cache and
+formula root; later runs reuse them, to measure the fast paths. With
+`--mirror`, the artifacts are served through Utils/systemprep-mirror.py, as
+they would be to a fleet, and the bytes served count only what the mirror
+downloaded from the local server. With `--bundle`, the artifacts are packed
+into one bundle with Utils/systemprep-buildbundle.py, and the master
+downloads the bundle instead.
+
+Must be run as root, since it mounts the overlay and calls chroot.
+
+Example:
+    python systemprep-benchmark.py --formulas 10 --formula-size 4 --runs 3 \\
+        --output benchmark.json
+"""
+import argparse
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import imp
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+import email.utils
+
+_repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_master_script = os.sep.join((_repo_root, 'MasterScripts',
+                              'systemprep-linuxmaster.py'))
+_content_scripts = os.sep.join((_repo_root, 'ContentScripts'))
+_mirror_script = os.sep.join((_repo_root, 'Utils', 'systemprep-mirror.py'))
+_bundle_script = os.sep.join((_repo_root, 'Utils',
+                              'systemprep-buildbundle.py'))
+_script_url = 'https://systemprep.s3.amazonaws.com/'
+
+_salt_call_stub = '''#!{python}
+# salt-call stub installed by systemprep-benchmark.py
+import json
+import os
+import random
+import sys
+
+args = sys.argv[1:]
+if '--version' in args:
+    print('salt-call 2015.5.3 (Lithium)')
+    sys.exit(0)
+if 'state.highstate' in args or 'state.sls' in args:
+    outfile = args[args.index('--out-file') + 1]
+    formularoot = '/srv/salt/formulas'
+    formulas = sorted(x for x in os.listdir(formularoot)
+                      if not x.startswith('.')) \\
+        if os.path.isdir(formularoot) else []
+    states = {{}}
+    for formula in formulas:
+        for n in range({states}):
+            stateid = 'file_|-{{0}}-{{1}}_|-/tmp/{{0}}-{{1}}_|-managed' \\
+                .format(formula, n)
+            states[stateid] = {{
+                '__sls__': '{{0}}.state{{1}}'.format(formula, n),
+                'result': True,
+                'changes': {{}},
+                'comment': 'File is in the correct state',
+                'duration': round(random.uniform(1, 50), 3),
+                'start_time': '12:00:{{0:02d}}.000000'.format(n % 60),
+            }}
+    with open(outfile, 'a') as f:
+        json.dump({{'local': states}}, f, indent=4)
+sys.exit(0)
+'''
+
+_command_stub = '''#!/bin/sh
+# {name} stub installed by systemprep-benchmark.py
+echo "{name} $*" >> /var/log/systemprep-benchmark.stubs.log
+{body}
+'''
+
+_yum_stub = '''case " $* " in
+    *" install "*) touch /var/log/systemprep-benchmark.rpmdb ;;
+esac
+exit 0'''
+
+_rpm_stub = '''if [ ! -f /var/log/systemprep-benchmark.rpmdb ]; then
+    echo "package salt-minion is not installed"
+    exit 1
+fi
+# rpm -q --qf <format> <package>...
+shift 3
+for package in "$@"; do
+    echo "$package 2015.5.3"
+done'''
+
+_minion_conf = '''# Synthetic minion conf for systemprep-benchmark.py
+#master: salt
+
+#file_roots:
+#  base:
+#    - /srv/salt
+
+#pillar_roots:
+#  base:
+#    - /srv/pillar
+'''
+
+
+class ArtifactServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves the files under `root`. Answers conditional and Range GETs, so it
+    can stand in for both a web server and path-style S3, and exercises the
+    chunked and resumed downloads. Counts the requests, the Range requests
+    and the bytes served.
+    """
+    daemon_threads = True
+
+    def __init__(self, root):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           ArtifactHandler)
+        self.root = root
+        self.lock = threading.Lock()
+        self.bytes_served = 0
+        self.requests = 0
+        self.range_requests = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/'.format(self.server_address[1])
+
+
+class ArtifactHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_error_body(self, status, code):
+        body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Error><Code>{0}</Code></Error>'.format(code))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if 'HEAD' != self.command:
+            self.wfile.write(body)
+
+    def parse_range(self, size):
+        """
+        Returns the (first, last) bytes of the Range header, None if there is
+        no Range header, or False if the range cannot be satisfied.
+        """
+        header = self.headers.getheader('Range')
+        if not header or not header.startswith('bytes=') or ',' in header:
+            return None
+        first, _, last = header[len('bytes='):].partition('-')
+        try:
+            if not first:
+                # A suffix range, the last `last` bytes
+                first, last = max(0, size - int(last)), size - 1
+            else:
+                first = int(first)
+                last = min(int(last), size - 1) if last else size - 1
+        except ValueError:
+            return None
+        if first >= size or first > last:
+            return False
+        return first, last
+
+    def do_GET(self):
+        path = os.path.normpath(self.path.split('?')[0].lstrip('/'))
+        filename = os.path.join(self.server.root, path)
+        with self.server.lock:
+            self.server.requests += 1
+        if path.startswith('..') or not os.path.isfile(filename):
+            return self.send_error_body(404, 'NoSuchKey')
+
+        stat = os.stat(filename)
+        etag = '"{0:x}-{1:x}"'.format(int(stat.st_mtime), stat.st_size)
+        if etag == self.headers.getheader('If-None-Match'):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        ifmatch = self.headers.getheader('If-Match')
+        if ifmatch and ifmatch != etag:
+            return self.send_error_body(412, 'PreconditionFailed')
+
+        byterange = self.parse_range(stat.st_size)
+        if byterange is False:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */{0}'
+                             .format(stat.st_size))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        first, last = byterange or (0, stat.st_size - 1)
+        length = last - first + 1
+        self.send_response(206 if byterange else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(length))
+        if byterange:
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'
+                             .format(first, last, stat.st_size))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified',
+                         email.utils.formatdate(stat.st_mtime, usegmt=True))
+        self.end_headers()
+        if 'HEAD' == self.command:
+            return
+        with self.server.lock:
+            if byterange:
+                self.server.range_requests += 1
+        with open(filename, 'rb') as f:
+            f.seek(first)
+            remaining = length
+            while remaining > 0:
+                data = f.read(min(1024 * 1024, remaining))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+                with self.server.lock:
+                    self.server.bytes_served += len(data)
+
+    do_HEAD = do_GET
+
+
+def pseudo_random_bytes(size, seed):
+    """
+    Returns `size` bytes that do not compress, generated from `seed`.
+    """
+    blocks = []
+    for n in range(size // 32 + 1):
+        blocks.append(hashlib.sha256('{0}:{1}'.format(seed, n)).digest())
+    return ''.join(blocks)[:size]
+
+
+def write_synthetic_zip(filename, topdir, files, filesize, rng):
+    """
+    Writes a zip archive of `files` synthetic files, `filesize` bytes each,
+    under `topdir`. Half of each file is text, which compresses well, and
+    half is pseudo-random bytes, which do not.
+    """
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for n in range(files):
+            line = '# synthetic line {0}\n'.format(n)
+            text = line * (filesize // 2 // len(line) + 1)
+            data = text[:filesize // 2] + pseudo_random_bytes(
+                filesize - filesize // 2, rng.random())
+            archive.writestr('{0}/file{1}.sls'.format(topdir, n), data)
+
+
+def build_artifacts(servedir, args):
+    """
+    Generates the synthetic artifacts and copies the content scripts under
+    `servedir`, laid out as `<bucket>/<key>`.
+    :return: dict, the master parameters that point at the artifacts
+    """
+    rng = random.Random(args.seed)
+    url = args.server_url
+
+    scriptsdir = os.sep.join((servedir, 'systemprep', 'ContentScripts'))
+    os.makedirs(scriptsdir)
+    for name in os.listdir(_content_scripts):
+        if name.endswith('.py'):
+            shutil.copy(os.sep.join((_content_scripts, name)), scriptsdir)
+
+    contentdir = os.sep.join((servedir, 'systemprep-content'))
+    os.makedirs(contentdir)
+    contentsize = args.content_size * 1024 * 1024
+    write_synthetic_zip(os.sep.join((contentdir, 'salt-content.zip')),
+                        'states/base', args.files_per_archive,
+                        max(1, contentsize // args.files_per_archive), rng)
+
+    formulasdir = os.sep.join((servedir, 'salt-formulas'))
+    os.makedirs(formulasdir)
+    formulasize = args.formula_size * 1024 * 1024
+    formulas = []
+    for n in range(args.formulas):
+        base = 'bench{0}-formula-master'.format(n)
+        write_synthetic_zip(os.sep.join((formulasdir, base + '.zip')),
+                            '{0}/bench{1}'.format(base, n),
+                            args.files_per_archive,
+                            max(1, formulasize // args.files_per_archive),
+                            rng)
+        formulas.append('{0}salt-formulas/{1}.zip'.format(url, base))
+
+    reposdir = os.sep.join((servedir, 'systemprep-repo'))
+    os.makedirs(reposdir)
+    repos = []
+    for n in range(args.repos):
+        with open(os.sep.join((reposdir, 'bench{0}.repo'.format(n))),
+                  'w') as f:
+            f.write('[bench{0}]\nname=bench{0}\n'
+                    'baseurl=http://127.0.0.1/bench{0}\n'.format(n))
+        repos.append('{{url:{0}systemprep-repo/bench{1}.repo,dist:all}}'
+                     .format(url, n))
+
+    return {
+        'saltcontentsource': '{0}systemprep-content/salt-content.zip'
+                             .format(url),
+        'formulastoinclude': ','.join(formulas),
+        'yumrepomap': ', '.join(repos),
+    }
+
+
+class BenchmarkRoot(object):
+    """
+    A temporary root for the master to run in, sharing the host's /usr and
+    python installation through read-only mounts and an overlay.
+    """
+
+    def __init__(self, path, binds):
+        self.path = path
+        self.binds = binds
+        self.mounts = []
+
+    def mount(self, *args):
+        subprocess.check_call(['mount'] + list(args))
+        self.mounts.append(args[-1])
+
+    def setup(self, server_url, stubstates):
+        root = self.path
+        overlay = os.sep.join((root, '.overlay'))
+        for d in ('upper', 'work'):
+            os.makedirs(os.sep.join((overlay, d)))
+        os.makedirs(os.sep.join((root, 'usr')))
+        self.mount('-t', 'overlay', 'overlay', '-o',
+                   'lowerdir=/usr,upperdir={0}/upper,workdir={0}/work'
+                   .format(overlay), os.sep.join((root, 'usr')))
+
+        for d in ('bin', 'sbin', 'lib', 'lib64'):
+            host = os.sep + d
+            target = os.sep.join((root, d))
+            if os.path.islink(host):
+                os.symlink(os.readlink(host), target)
+            elif os.path.isdir(host):
+                os.makedirs(target)
+                self.mount('--bind', '-o', 'ro', host, target)
+
+        for d in ('dev', 'proc'):
+            os.makedirs(os.sep.join((root, d)))
+        self.mount('--bind', '/dev', os.sep.join((root, 'dev')))
+        self.mount('-t', 'proc', 'proc', os.sep.join((root, 'proc')))
+
+        # Bind the python installation, unless the overlay already has it
+        for host in sorted(set([sys.prefix, sys.exec_prefix] + self.binds)):
+            host = os.path.realpath(host)
+            if host.startswith('/usr/') or not os.path.isdir(host):
+                continue
+            target = root + host
+            if not os.path.isdir(target):
+                os.makedirs(target)
+                self.mount('--bind', '-o', 'ro', host, target)
+
+        for d in ('etc/salt', 'etc/yum.repos.d', 'srv', 'tmp', 'var/log',
+                  'var/run', 'var/cache', 'usr/tmp', 'systemprep'):
+            path = os.sep.join((root, d))
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        os.chmod(os.sep.join((root, 'tmp')), 0o1777)
+        for f in ('passwd', 'group', 'hosts', 'nsswitch.conf'):
+            if os.path.isfile('/etc/' + f):
+                shutil.copy('/etc/' + f, os.sep.join((root, 'etc', f)))
+        self.write('etc/system-release',
+                   'CentOS Linux release 7.2.1511 (Core)\n')
+        self.write('etc/salt/minion', _minion_conf)
+        self.write('etc/boto.cfg',
+                   '[Credentials]\n'
+                   'aws_access_key_id = benchmark\n'
+                   'aws_secret_access_key = benchmark\n'
+                   '[Boto]\n'
+                   'is_secure = False\n'
+                   '[s3]\n'
+                   'host = {0}\n'
+                   'calling_format = boto.s3.connection.OrdinaryCallingFormat\n'
+                   .format(server_url.split('/')[2]))
+
+        # The master runs the content scripts with `python`
+        python = os.sep.join((root, 'usr/bin/python'))
+        if not os.path.exists(python):
+            os.symlink(sys.executable, python)
+        self.write('usr/bin/salt-call',
+                   _salt_call_stub.format(python=sys.executable,
+                                          states=stubstates), 0o755)
+        # yum records an install, and rpm then reports every package queried
+        # as installed
+        self.write('usr/bin/yum',
+                   _command_stub.format(name='yum', body=_yum_stub), 0o755)
+        self.write('usr/bin/rpm',
+                   _command_stub.format(name='rpm', body=_rpm_stub), 0o755)
+
+    def write(self, relpath, content, mode=None):
+        path = os.sep.join((self.path, relpath))
+        with open(path, 'w') as f:
+            f.write(content)
+        if mode is not None:
+            os.chmod(path, mode)
+
+    def teardown(self):
+        for target in reversed(self.mounts):
+            subprocess.call(['umount', '-l', target])
+        self.mounts = []
+
+
+def install_master(root, server_url):
+    """
+    Copies the master script into the root, with its content script urls
+    pointed at the local server.
+    :return: str, path of the master script inside the root
+    """
+    with open(_master_script) as f:
+        master = f.read()
+    master = master.replace(_script_url, '{0}systemprep/'.format(server_url))
+    path = '/systemprep/systemprep-linuxmaster.py'
+    with open(root + path, 'w') as f:
+        f.write(master)
+    return path
+
+
+def run_master(root, master, params):
+    """
+    Runs the master script in the chroot, and waits for it to exit.
+    :return: dict, the wall time, exit status, and peak RSS in KB of the
+             master and its content scripts
+    """
+    def enter_root():
+        os.chroot(root)
+        os.chdir('/')
+
+    env = {
+        'PATH': '/usr/bin:/bin:/usr/sbin:/sbin',
+        'HOME': '/root',
+        'BOTO_CONFIG': '/etc/boto.cfg',
+    }
+    if os.environ.get('PYTHONPATH'):
+        env['PYTHONPATH'] = os.environ['PYTHONPATH']
+    command = [sys.executable, master] + \
+        ['{0}={1}'.format(k, v) for k, v in sorted(params.items())]
+    with open(os.sep.join((root, 'var/log/systemprep-benchmark.out')),
+              'a') as log:
+        start = time.time()
+        proc = subprocess.Popen(command, env=env, stdout=log,
+                                stderr=subprocess.STDOUT,
+                                preexec_fn=enter_root, close_fds=True)
+        # wait4 reports the usage of this run only, including the content
+        # scripts the master waited for
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = status
+        wall = time.time() - start
+    return {
+        'wall_seconds': round(wall, 3),
+        'exit_status': status,
+        'peak_rss_kb': usage.ru_maxrss,
+    }
+
+
+def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix='systemprep-benchmark-')
+    servedir = os.sep.join((workdir, 'serve'))
+    root = BenchmarkRoot(os.sep.join((workdir, 'root')), args.bind)
+    server = ArtifactServer(servedir)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    args.server_url = server.url
+    mirror = None
+    if args.mirror:
+        mirrormodule = imp.load_source('systemprep_mirror', _mirror_script)
+        mirror = mirrormodule.MirrorServer(
+            ('127.0.0.1', 0), os.sep.join((workdir, 'mirror')), 300,
+            [server.url.split('/')[2]], quiet=True)
+        thread = threading.Thread(target=mirror.serve_forever)
+        thread.daemon = True
+        thread.start()
+    results = {
+        'settings': dict((k, v) for k, v in vars(args).items()
+                         if k not in ('server_url', 'output', 'keep')),
+        'runs': [],
+    }
+    try:
+        os.makedirs(servedir)
+        params = build_artifacts(servedir, args)
+        params.update({
+            'noreboot': 'true',
+            'sourceiss3bucket': 'true' if 's3' == args.source else 'false',
+            'salt_results_log': '/var/log/saltcall.results.log',
+            'salt_debug_log': '/var/log/saltcall.debug.log',
+        })
+        if mirror is not None:
+            params['mirrorurl'] = mirror.url
+        params.update(dict(x.split('=', 1) for x in args.param))
+        os.makedirs(root.path)
+        root.setup(server.url, args.states_per_formula)
+        master = install_master(root.path, server.url)
+        if args.bundle:
+            bundledir = os.sep.join((servedir, 'systemprep-bundle'))
+            os.makedirs(bundledir)
+            builder = imp.load_source('systemprep_buildbundle',
+                                      _bundle_script)
+            builder.build_bundle(os.sep.join((bundledir, 'bundle.zip')),
+                                 'benchmark', params,
+                                 masterscript=root.path + master)
+            params['bundlesource'] = '{0}systemprep-bundle/bundle.zip' \
+                .format(server.url)
+
+        for n in range(args.runs):
+            before = (server.bytes_served, server.requests,
+                      server.range_requests)
+            run = run_master(root.path, master, params)
+            run['run'] = n + 1
+            run['bytes_served'] = server.bytes_served - before[0]
+            run['requests'] = server.requests - before[1]
+            run['range_requests'] = server.range_requests - before[2]
+            reportfile = os.sep.join((root.path,
+                                      'var/log/systemprep.report.json'))
+            try:
+                with open(reportfile) as f:
+                    report = json.load(f)
+                run['status'] = report.get('status')
+                run['phase_totals'] = report.get('phase_totals')
+                run['downloads'] = report.get('downloads')
+            except (IOError, OSError, ValueError):
+                run['status'] = 'no report'
+            results['runs'].append(run)
+            print_run(run)
+    finally:
+        server.shutdown()
+        if mirror is not None:
+            mirror.shutdown()
+        root.teardown()
+        if args.keep:
+            print('Kept the benchmark files in {0}'.format(workdir))
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def print_run(run):
+    print('Run {0}: {1}, {2:.3f} s, {3} bytes served in {4} requests '
+          '({5} ranged), peak RSS {6} KB'
+          .format(run['run'], run.get('status'), run['wall_seconds'],
+                  run['bytes_served'], run['requests'],
+                  run['range_requests'], run['peak_rss_kb']))
+    totals = run.get('phase_totals') or {}
+    for name, seconds in sorted(totals.items(), key=lambda x: x[1],
+                                reverse=True):
+        print('    {0:>10.3f} s  {1}'.format(seconds, name))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the SystemPrep Linux pipeline against a '
+                    'local artifact server.')
+    parser.add_argument('--source', choices=('web', 's3'), default='web',
+                        help='serve the content scripts and salt content as '
+                             'web or S3 downloads')
+    parser.add_argument('--formulas', type=int, default=5,
+                        help='number of salt formulas')
+    parser.add_argument('--formula-size', type=int, default=1,
+                        help='size of each formula archive, in MB')
+    parser.add_argument('--content-size', type=int, default=4,
+                        help='size of the salt content archive, in MB')
+    parser.add_argument('--files-per-archive', type=int, default=50,
+                        help='number of files in each archive')
+    parser.add_argument('--repos', type=int, default=3,
+                        help='number of yum repo files')
+    parser.add_argument('--states-per-formula', type=int, default=20,
+                        help='number of states the salt-call stub reports '
+                             'for each formula')
+    parser.add_argument('--runs', type=int, default=2,
+                        help='number of runs. the first run is cold, later '
+                             'runs reuse the cache and the salt content')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the synthetic content')
+    parser.add_argument('--mirror', action='store_true',
+                        help='serve the artifacts through a local '
+                             'systemprep-mirror.py')
+    parser.add_argument('--bundle', action='store_true',
+                        help='pack the artifacts into one bundle for the '
+                             'master to download')
+    parser.add_argument('--param', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='extra parameter for the master script')
+    parser.add_argument('--bind', action='append', default=[],
+                        metavar='DIR',
+                        help='extra host directory to mount in the root, '
+                             'e.g. a PYTHONPATH entry')
+    parser.add_argument('--output', help='file to save the results as JSON')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the root and the artifacts afterwards')
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        parser.error('must be run as root, to mount the benchmark root')
+
+    results = run_benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if any(run.get('status') != 'succeeded' for run in results['runs']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
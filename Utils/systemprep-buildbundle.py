@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+Builds a SystemPrep bundle, one archive holding the content scripts, salt
+content and salt formulas that the master script downloads, so an instance
+fetches all of them with a single request.
+
+The artifacts are resolved the way the master resolves them, by calling its
+`get_scripts_to_execute` with the given master parameters, and are
+downloaded with its `download_file`. The bundle is a zip archive. Each
+artifact is a member under `artifacts/`, stored without compression if it
+is already compressed, and `manifest.json` records the bundle format and
+version, and the url, member name, size and SHA256 hash of each artifact.
+A SHA512 hash file is written next to the bundle, to publish with it. See
+Utils/CreateHashFiles.md.
+
+Pass `bundlesource=<url of the bundle>` to the master script to use it. The
+master unpacks the artifacts whose urls match its own parameters, and
+downloads any others as usual, so a bundle built for other parameters still
+works.
+
+Example:
+    python systemprep-buildbundle.py --output systemprep-bundle.zip \\
+        --param formulastoinclude=https://example.com/a-formula-master.zip
+"""
+import argparse
+import hashlib
+import imp
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+_repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_master_script = os.sep.join((_repo_root, 'MasterScripts',
+                              'systemprep-linuxmaster.py'))
+_bundle_format = 1
+_compressed_suffixes = ('.zip', '.gz', '.tgz', '.bz2', '.tbz', '.xz')
+
+
+def hash_file(filename, algorithm='sha256'):
+    digest = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_bundle(filename, version, artifacts):
+    """
+    Writes the bundle archive, and its SHA512 hash file.
+    :param filename: str, path of the bundle
+    :param version: str, version of the bundle
+    :param artifacts: list, (url, path of the downloaded file) tuples
+    :return: dict, the manifest of the bundle
+    """
+    manifest = {
+        'format': _bundle_format,
+        'version': version,
+        'created': time.time(),
+        'artifacts': [],
+    }
+    tmpfile = '{0}.tmp'.format(filename)
+    with zipfile.ZipFile(tmpfile, 'w', allowZip64=True) as archive:
+        for n, (url, path) in enumerate(artifacts):
+            member = 'artifacts/{0:02d}-{1}'.format(n, url.split('/')[-1])
+            compression = zipfile.ZIP_STORED \
+                if path.lower().endswith(_compressed_suffixes) \
+                else zipfile.ZIP_DEFLATED
+            archive.write(path, member, compression)
+            manifest['artifacts'].append({
+                'url': url,
+                'member': member,
+                'size': os.path.getsize(path),
+                'sha256': hash_file(path),
+            })
+        archive.writestr('manifest.json',
+                         json.dumps(manifest, indent=2, sort_keys=True),
+                         zipfile.ZIP_DEFLATED)
+    os.rename(tmpfile, filename)
+    with open('{0}.SHA512'.format(filename), 'w') as f:
+        f.write('{0} {1}\n'.format(hash_file(filename, 'sha512'),
+                                   os.path.basename(filename)))
+    return manifest
+
+
+def build_bundle(filename, version, params, system='Linux',
+                 masterscript=_master_script):
+    """
+    Resolves and downloads the artifacts of the master script, and writes
+    them to the bundle `filename`.
+    :param params: dict, master parameters, as passed on its command line
+    :param system: str, the system type, as returned by `platform.system`
+    :param masterscript: str, path of the master script
+    :return: dict, the manifest of the bundle
+    :raise SystemError: error raised if any artifact cannot be downloaded
+    """
+    master = imp.load_source('systemprep_master', masterscript)
+    master.configure_cache('none')
+    sourceiss3bucket = 'true' == params.get('sourceiss3bucket',
+                                            'false').lower()
+    workdir = tempfile.mkdtemp(prefix='systemprep-bundle-')
+    try:
+        scripts = master.get_scripts_to_execute(system, workdir, **params)
+        artifacts = master.get_artifacts_to_prefetch(scripts,
+                                                     sourceiss3bucket)
+        fetched = master.prefetch_artifacts(artifacts, workdir)
+        missing = [url for url, _ in artifacts if url not in fetched]
+        if missing:
+            raise SystemError('Could not download the artifacts:\n    {0}'
+                              .format('\n    '.join(missing)))
+        return write_bundle(filename, version,
+                            [(url, fetched[url]) for url, _ in artifacts])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Builds a SystemPrep bundle of the content scripts, '
+                    'salt content and salt formulas.')
+    parser.add_argument('--output', required=True,
+                        help='path of the bundle to write')
+    parser.add_argument('--version',
+                        default=time.strftime('%Y%m%d%H%M%S', time.gmtime()),
+                        help='version of the bundle. defaults to the UTC '
+                             'time')
+    parser.add_argument('--system', default='Linux',
+                        help='system type to resolve the artifacts for')
+    parser.add_argument('--master', default=_master_script,
+                        help='path of the master script')
+    parser.add_argument('--param', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='master parameter that selects the artifacts, '
+                             'e.g. formulastoinclude')
+    args = parser.parse_args()
+
+    # Keys are lowercase, as on the master's command line
+    params = {}
+    for x in args.param:
+        if '=' not in x:
+            parser.error('--param must be of the form KEY=VALUE')
+        key, value = x.split('=', 1)
+        params[key.lower()] = value
+
+    try:
+        manifest = build_bundle(args.output, args.version, params,
+                                args.system, args.master)
+    except SystemError as exc:
+        print(exc)
+        sys.exit(1)
+    print('Wrote bundle {0}, version {1}, with {2} artifact(s):'
+          .format(args.output, manifest['version'],
+                  len(manifest['artifacts'])))
+    for artifact in manifest['artifacts']:
+        print('    {0}'.format(artifact['url']))
+
+
+if __name__ == '__main__':
+    main()
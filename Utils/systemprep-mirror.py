@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+"""
+Serves SystemPrep artifacts to a fleet of instances from one local cache.
+
+When an autoscale group launches many instances at once, each of them
+downloads the same content scripts, salt content, salt formulas and yum repo
+files. Run this mirror on a designated node, or anywhere in the VPC, and pass
+`mirrorurl=http://<mirror>:<port>` to the master script. The master and the
+content scripts then request each file from the mirror, as
+`<mirrorurl>/<scheme>/<host>/<path>`, and from its source if the mirror
+fails.
+
+The mirror downloads each file from its source once, keeps it under
+`--cache-dir`, and serves it to every instance. Concurrent requests for the
+same file wait for a single download. A cached file is revalidated with a
+conditional GET once it is older than `--ttl` seconds, and is served as it
+is if the source cannot be reached. Missing files, such as hash files that
+were never published, are remembered for `--ttl` seconds, too. The least
+recently served files are evicted to keep the cache under `--max-size` MB.
+
+Range requests, ETags and conditional GETs are answered, so the chunked,
+resumable downloads of the scripts work against the mirror as they do
+against S3.
+
+The mirror only downloads from hosts that match an `--allow-host` pattern,
+so it cannot be used to reach other hosts, such as the instance metadata
+service. At least one pattern is required. With `--s3`, files in the buckets
+named with `--allow-bucket` are downloaded with boto, using the mirror's
+credentials, so private buckets can be mirrored. Files in other buckets are
+downloaded anonymously.
+
+Example:
+    python systemprep-mirror.py --port 8080 \
+        --allow-host systemprep-content.s3.amazonaws.com
+    python systemprep-mirror.py --port 8080 --allow-host '*.amazonaws.com' \
+        --s3 --allow-bucket systemprep-content
+"""
+import argparse
+import BaseHTTPServer
+import SocketServer
+import contextlib
+import fnmatch
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import urllib2
+
+try:
+    import boto
+    from boto.exception import S3ResponseError
+except ImportError:
+    boto = None
+
+_match_s3_host = re.compile(r'^(?:(?P<bucket>.+?)\.)?s3(?:[.-][a-z0-9-]+)?'
+                            r'\.amazonaws\.com(?::\d+)?$')
+_match_range = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves the files of the allowed hosts from the cache in `cachedir`,
+    downloading them from their source as needed. Files in `allowedbuckets`
+    are downloaded with boto.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, cachedir, ttl, allowedhosts,
+                 allowedbuckets=(), maxsize=10240, quiet=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MirrorHandler)
+        self.cachedir = cachedir
+        self.ttl = ttl
+        self.maxbytes = maxsize * 1024 * 1024
+        self.quiet = quiet
+        self.allowedhosts = [x.lower() for x in allowedhosts]
+        self.allowedbuckets = set(allowedbuckets)
+        self.s3 = boto.connect_s3() if allowedbuckets else None
+        self.lock = threading.Lock()
+        self.locks = {}
+        for subdir in ('files', 'meta'):
+            path = os.sep.join((cachedir, subdir))
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.server_address)
+
+    def log(self, message):
+        if not self.quiet:
+            print(message)
+
+    @contextlib.contextmanager
+    def file_lock(self, name):
+        """
+        Serializes the downloads of the file `name`. The lock is dropped once
+        no request is waiting for it, so the locks do not pile up.
+        """
+        with self.lock:
+            entry = self.locks.setdefault(name, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[name]
+
+    def evict(self):
+        """
+        Removes the least recently served files until the cache is under
+        its size limit. Files that a request is using are skipped.
+        """
+        filedir = os.sep.join((self.cachedir, 'files'))
+        files = []
+        for name in os.listdir(filedir):
+            try:
+                stat = os.stat(os.sep.join((filedir, name)))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.maxbytes:
+                break
+            with self.lock:
+                if name in self.locks:
+                    continue
+                try:
+                    os.remove(os.sep.join((filedir, name)))
+                except OSError:
+                    continue
+            total -= size
+            self.log('Evicted file from cache -- {0}'.format(name))
+
+
+class MirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        if not self.server.quiet:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, *args)
+
+    def send_empty(self, status, *headers):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        # The scripts check that the mirror answers before using it
+        if '/' == path:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', '3')
+            self.end_headers()
+            if 'HEAD' != self.command:
+                self.wfile.write('ok\n')
+            return
+
+        parts = path.lstrip('/').split('/', 2)
+        if len(parts) < 3 or parts[0] not in ('http', 'https') or \
+                not parts[2] or '..' in parts[2].split('/'):
+            return self.send_empty(400)
+        scheme, host, keypath = parts
+        if not any(fnmatch.fnmatch(host.lower(), pattern)
+                   for pattern in self.server.allowedhosts):
+            return self.send_empty(403)
+
+        url = '{0}://{1}/{2}'.format(scheme, host, keypath)
+        try:
+            meta, f = open_cached_file(self.server, url)
+        except Exception as exc:
+            self.log_error('Could not download %s -- %s', url, exc)
+            return self.send_empty(502)
+        if f is None:
+            return self.send_empty(meta['status'])
+        try:
+            self.send_file(f, meta)
+        finally:
+            f.close()
+
+    do_HEAD = do_GET
+
+    def send_file(self, f, meta):
+        size = os.fstat(f.fileno()).st_size
+        etag = meta.get('etag')
+        last_modified = meta.get('last_modified')
+        validators = []
+        if etag:
+            validators.append(('ETag', etag))
+        if last_modified:
+            validators.append(('Last-Modified', last_modified))
+
+        if etag and etag == self.headers.getheader('If-None-Match') or \
+                not etag and last_modified and \
+                last_modified == self.headers.getheader('If-Modified-Since'):
+            return self.send_empty(304, *validators)
+        ifmatch = self.headers.getheader('If-Match')
+        if ifmatch and ifmatch != etag:
+            return self.send_empty(412)
+
+        byterange = parse_range(self.headers.getheader('Range'), size)
+        if byterange is False:
+            return self.send_empty(
+                416, ('Content-Range', 'bytes */{0}'.format(size)))
+        start, end = byterange or (0, size - 1)
+        self.send_response(206 if byterange else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        if byterange:
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'
+                             .format(start, end, size))
+        for name, value in validators:
+            self.send_header(name, value)
+        self.end_headers()
+        if 'HEAD' == self.command:
+            return
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = f.read(min(1024 * 1024, remaining))
+            if not data:
+                break
+            self.wfile.write(data)
+            remaining -= len(data)
+
+
+def parse_range(header, size):
+    """
+    Parses a Range header for a single range of a file of `size` bytes.
+    :return: tuple, (start, end) of the range. None to send the whole file,
+             or False if the range cannot be satisfied.
+    """
+    m = _match_range.match(header or '')
+    if m is None or ('', '') == m.groups():
+        return None
+    first, last = m.groups()
+    if not first:
+        # A suffix range, the last `last` bytes
+        if not int(last) or not size:
+            return False
+        return max(0, size - int(last)), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        return False
+    return start, end
+
+
+def read_meta(metafile):
+    try:
+        with open(metafile, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_meta(metafile, meta):
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(metafile))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(meta, f)
+    os.rename(tmpfile, metafile)
+
+
+def save_response(response, datafile):
+    """
+    Saves the body of `response` to `datafile`. The file is replaced with a
+    rename, so files being served keep their content.
+    """
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(datafile))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(response, f, 1024 * 1024)
+        os.rename(tmpfile, datafile)
+    except Exception:
+        os.remove(tmpfile)
+        raise
+
+
+def fetch_http(url, headers, datafile):
+    """
+    Downloads `url` to `datafile` with a GET, conditional on `headers`.
+    :return: dict, the status, ETag and Last-Modified of the response
+    """
+    request = urllib2.Request(url)
+    for name, value in headers.items():
+        request.add_header(name, value)
+    try:
+        response = urllib2.urlopen(request, timeout=60)
+    except urllib2.HTTPError as exc:
+        if exc.code in (304, 403, 404):
+            return {'status': exc.code}
+        raise
+    try:
+        save_response(response, datafile)
+    finally:
+        response.close()
+    info = response.info()
+    return {
+        'status': 200,
+        'etag': info.getheader('ETag'),
+        'last_modified': info.getheader('Last-Modified'),
+    }
+
+
+def parse_s3_url(url):
+    """
+    Splits a url on an S3 endpoint into its bucket and key.
+    :return: tuple, (bucket name, key path), or None if `url` is not on an S3
+             endpoint
+    """
+    host, keypath = url.split('://', 1)[1].split('/', 1)
+    m = _match_s3_host.match(host)
+    if m is None:
+        return None
+    if m.group('bucket') is None:
+        # A path style url, `<endpoint>/<bucket>/<key>`
+        return tuple(keypath.split('/', 1)) if '/' in keypath else None
+    return m.group('bucket'), keypath
+
+
+def fetch_s3(s3, url, headers, datafile):
+    """
+    Downloads the S3 object at `url` to `datafile` with boto, conditional on
+    `headers`.
+    :return: dict, as returned by `fetch_http`
+    """
+    bucket_name, keypath = parse_s3_url(url)
+    bucket = s3.get_bucket(bucket_name, validate=False)
+    key = bucket.new_key(urllib2.unquote(keypath))
+    try:
+        key.open_read(headers=headers)
+    except S3ResponseError as exc:
+        if exc.status in (304, 403, 404):
+            return {'status': exc.status}
+        raise
+    try:
+        save_response(key, datafile)
+    finally:
+        key.close()
+    return {
+        'status': 200,
+        'etag': key.etag,
+        'last_modified': key.last_modified,
+    }
+
+
+def open_cached_file(server, url):
+    """
+    Opens the cached copy of `url`, downloading it from its source first if
+    it is not cached, or revalidating it if it is older than the ttl.
+    :return: tuple, (metadata of the file, open file or None if the source
+             does not have the file)
+    """
+    name = hashlib.sha256(url).hexdigest()
+    datafile = os.sep.join((server.cachedir, 'files', name))
+    metafile = os.sep.join((server.cachedir, 'meta', name + '.json'))
+    downloaded = False
+    with server.file_lock(name):
+        meta = read_meta(metafile)
+        cached = meta is not None and 200 == meta['status'] and \
+            os.path.isfile(datafile)
+        # A cached file, or a cached answer that there is no such file
+        usable = cached or meta is not None and 200 != meta['status']
+        if meta is None or time.time() - meta['checked'] >= server.ttl or \
+                200 == meta['status'] and not cached:
+            headers = {}
+            if cached and meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if cached and meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+            s3url = parse_s3_url(url)
+            try:
+                if s3url and s3url[0] in server.allowedbuckets:
+                    result = fetch_s3(server.s3, url, headers, datafile)
+                else:
+                    result = fetch_http(url, headers, datafile)
+            except Exception as exc:
+                if not usable:
+                    raise
+                server.log('WARNING: Could not revalidate {0} with its '
+                           'source, serving the cached result -- {1}'
+                           .format(url, exc))
+                result = {'status': 304}
+            if 304 == result['status'] and usable:
+                meta['checked'] = time.time()
+            else:
+                meta = dict(result, url=url, checked=time.time())
+            write_meta(metafile, meta)
+            server.log('Checked {0} with its source -- {1}'
+                       .format(url, result['status']))
+            downloaded = 200 == result['status']
+        if 200 != meta['status']:
+            return meta, None
+        f = open(datafile, 'rb')
+        # Marks the file as recently served
+        os.utime(datafile, None)
+    if downloaded:
+        server.evict()
+    return meta, f
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serves SystemPrep artifacts to a fleet of instances '
+                    'from one local cache.')
+    parser.add_argument('--address', default='0.0.0.0',
+                        help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='port to listen on')
+    parser.add_argument('--cache-dir', default='/var/cache/systemprep-mirror',
+                        help='directory in which to cache the files')
+    parser.add_argument('--ttl', type=int, default=300,
+                        help='seconds before a cached file is revalidated '
+                             'with its source')
+    parser.add_argument('--max-size', type=int, default=10240,
+                        help='maximum size of the cache in MB. the least '
+                             'recently served files are evicted to stay '
+                             'under it')
+    parser.add_argument('--allow-host', action='append', default=[],
+                        metavar='PATTERN',
+                        help='host, or fnmatch pattern of hosts, from which '
+                             'files may be mirrored. required, may be '
+                             'repeated')
+    parser.add_argument('--quiet', action='store_true',
+                        help='do not log each request')
+    parser.add_argument('--s3', action='store_true',
+                        help='download files in the allowed buckets with '
+                             'boto, using the credentials of the mirror')
+    parser.add_argument('--allow-bucket', action='append', default=[],
+                        metavar='BUCKET',
+                        help='bucket that may be mirrored with the '
+                             'credentials of the mirror. required with '
+                             '--s3, may be repeated')
+    args = parser.parse_args()
+
+    if not args.allow_host:
+        parser.error('at least one --allow-host is required')
+    if args.s3 and not args.allow_bucket:
+        parser.error('--s3 requires at least one --allow-bucket')
+    if args.allow_bucket and not args.s3:
+        parser.error('--allow-bucket requires --s3')
+    if args.s3 and boto is None:
+        parser.error('--s3 requires boto')
+
+    server = MirrorServer((args.address, args.port), args.cache_dir,
+                          args.ttl, args.allow_host,
+                          args.allow_bucket if args.s3 else (),
+                          args.max_size, args.quiet)
+    print('Mirroring {0} on {1}'.format(', '.join(server.allowedhosts),
+                                        server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()